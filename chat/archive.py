@@ -0,0 +1,187 @@
+"""
+Cold storage for old one-to-one messages.
+
+``archive_messages`` moves messages older than MESSAGE_ARCHIVE_AFTER_DAYS
+out of chat_message into gzip-compressed JSON Lines segments under
+MESSAGE_ARCHIVE_ROOT, partitioned by conversation and month. Every batch
+writes new segment files named after the id range they hold::
+
+    <root>/<low user id>_<high user id>/<YYYY-MM>/<first id>-<last id>.jsonl.gz
+
+Segments are never appended to: each is written to a temporary file,
+synced and renamed into place, so concurrent runs can't interleave
+writes and readers never see half a segment. Rows are only deleted after
+their segment is in place. A run that dies between the two leaves rows
+that the next run archives again; the same batch finds its segment
+already written, and readers drop any other duplicate ids.
+
+``get_history`` pages backwards through a conversation. It reads the hot
+table first and continues into the archive once the hot window runs out,
+opening only the segments whose id range can hold the next page, so
+callers don't need to know where a message lives.
+"""
+import gzip
+import json
+import logging
+import os
+from collections import defaultdict
+from datetime import datetime, timedelta
+from pathlib import Path
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Q
+from django.utils import timezone
+
+from .models import Message
+
+logger = logging.getLogger(__name__)
+
+SEGMENT_SUFFIX = '.jsonl.gz'
+
+
+def conversation_key(user_id, other_id):
+    return f"{min(user_id, other_id)}_{max(user_id, other_id)}"
+
+
+def segment_path(key, timestamp, first_id, last_id):
+    return Path(settings.MESSAGE_ARCHIVE_ROOT) / key / f"{timestamp:%Y-%m}" / f"{first_id}-{last_id}{SEGMENT_SUFFIX}"
+
+
+def _write_segment(path, rows):
+    if path.exists():
+        # Left by a run that died before deleting these rows
+        return
+    path.parent.mkdir(parents=True, exist_ok=True)
+    partial = path.with_name(f".{path.name}.{os.getpid()}.tmp")
+    with open(partial, 'wb') as raw:
+        with gzip.GzipFile(fileobj=raw, mode='wb') as segment:
+            for row in rows:
+                segment.write((json.dumps(row) + '\n').encode())
+        raw.flush()
+        os.fsync(raw.fileno())
+    os.replace(partial, path)
+
+
+def _read_segment(path):
+    with gzip.open(path, 'rt') as segment:
+        return [json.loads(line) for line in segment if line.strip()]
+
+
+def _segments(key):
+    """Return (first id, last id, path) for each of a conversation's segments, newest range first."""
+    directory = Path(settings.MESSAGE_ARCHIVE_ROOT) / key
+    if not directory.is_dir():
+        return []
+    segments = []
+    for month in os.scandir(directory):
+        if not month.is_dir():
+            continue
+        for entry in os.scandir(month.path):
+            if entry.name.startswith('.') or not entry.name.endswith(SEGMENT_SUFFIX):
+                continue
+            first_id, last_id = entry.name[:-len(SEGMENT_SUFFIX)].split('-')
+            segments.append((int(first_id), int(last_id), Path(entry.path)))
+    return sorted(segments, key=lambda segment: segment[1], reverse=True)
+
+
+def archive_messages(older_than_days=None, batch_size=1000):
+    """
+    Move messages older than ``older_than_days`` into archive segments.
+
+    Args:
+        older_than_days: Age cutoff, MESSAGE_ARCHIVE_AFTER_DAYS by default
+        batch_size: Messages written and deleted per round
+
+    Returns:
+        int: Number of messages archived
+    """
+    days = settings.MESSAGE_ARCHIVE_AFTER_DAYS if older_than_days is None else older_than_days
+    cutoff = timezone.now() - timedelta(days=days)
+    archived = 0
+    while True:
+        rows = list(
+            Message.objects.filter(timestamp__lt=cutoff).order_by('id').values(
+                'id', 'sender_id', 'receiver_id', 'content', 'timestamp', 'client_msg_id'
+            )[:batch_size]
+        )
+        if not rows:
+            return archived
+
+        segments = defaultdict(list)
+        for row in rows:
+            key = conversation_key(row['sender_id'], row['receiver_id'])
+            segments[key, f"{row['timestamp']:%Y-%m}"].append(row)
+        for (key, _), segment_rows in segments.items():
+            first, last = segment_rows[0], segment_rows[-1]
+            _write_segment(
+                segment_path(key, first['timestamp'], first['id'], last['id']),
+                [{**row, 'timestamp': row['timestamp'].isoformat()} for row in segment_rows]
+            )
+
+        with transaction.atomic():
+            Message.objects.filter(id__in=[row['id'] for row in rows]).delete()
+        archived += len(rows)
+        logger.info(f"Archived {len(rows)} messages into {len(segments)} segment(s)")
+
+
+def _archived_messages(key, before_id, limit, users):
+    """Up to ``limit`` archived messages of a conversation below ``before_id``, newest first."""
+    rows = {}
+    for first_id, last_id, path in _segments(key):
+        if before_id is not None and first_id >= before_id:
+            continue
+        # Segments are visited by descending last id, so once a page is
+        # full no later segment can hold anything newer than its oldest row
+        if len(rows) >= limit and last_id < sorted(rows, reverse=True)[limit - 1]:
+            break
+        for row in _read_segment(path):
+            if before_id is None or row['id'] < before_id:
+                rows.setdefault(row['id'], row)
+
+    found = []
+    for message_id in sorted(rows, reverse=True)[:limit]:
+        row = rows[message_id]
+        message = Message(
+            id=row['id'],
+            sender_id=row['sender_id'],
+            receiver_id=row['receiver_id'],
+            content=row['content'],
+            timestamp=datetime.fromisoformat(row['timestamp']),
+            client_msg_id=row['client_msg_id'],
+        )
+        message.sender = users[row['sender_id']]
+        message.receiver = users[row['receiver_id']]
+        found.append(message)
+    return found
+
+
+def get_history(user, friend, before_id=None, limit=None):
+    """
+    One page of the conversation between ``user`` and ``friend``, reading
+    through to the archive when the hot table has nothing older.
+
+    Args:
+        user: The viewing user
+        friend: The other participant
+        before_id: Only messages with a smaller id (the previous page)
+        limit: Page size, CHAT_HISTORY_PAGE_SIZE by default
+
+    Returns:
+        tuple: (messages oldest first, has_more)
+    """
+    limit = limit or settings.CHAT_HISTORY_PAGE_SIZE
+    messages = Message.objects.filter(
+        Q(sender=user, receiver=friend) | Q(sender=friend, receiver=user)
+    ).select_related('sender').order_by('-id')
+    if before_id is not None:
+        messages = messages.filter(id__lt=before_id)
+    page = list(messages[:limit + 1])
+
+    if len(page) <= limit:
+        oldest = page[-1].id if page else before_id
+        users = {user.id: user, friend.id: friend}
+        page += _archived_messages(conversation_key(user.id, friend.id), oldest, limit + 1 - len(page), users)
+
+    has_more = len(page) > limit
+    return page[:limit][::-1], has_more
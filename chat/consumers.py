@@ -1,65 +1,231 @@
-import json
+import logging
+from collections import OrderedDict
+from asgiref.sync import sync_to_async
 from channels.generic.websocket import AsyncWebsocketConsumer
-from channels.db import database_sync_to_async
 from django.contrib.auth.models import User
-from .models import Message
+from django.db import IntegrityError, transaction
+from .models import Message, Membership, RoomMessage
+from .presence import heartbeat, mark_online, mark_offline
+from .read_state import mark_read, read_positions, unread_summary
+from .rooms import mark_room_read, room_group
+from .executor import DatabaseBusy
+from .protocol import JSON, FrameError, negotiate
+from .instrumentation import InstrumentedConsumerMixin, timed_database_sync_to_async
+from django.conf import settings
 from django.core.exceptions import ObjectDoesNotExist, ValidationError
 
-class ChatConsumer(AsyncWebsocketConsumer):
+logger = logging.getLogger(__name__)
+
+
+def inbox_group(user_id):
+    return f"inbox_{user_id}"
+
+
+class FramedConsumerMixin:
+    """Send frames as JSON or MessagePack, as negotiated at connect."""
+
+    codec = JSON
+
+    async def accept_negotiated(self):
+        self.codec = negotiate(self.scope.get('subprotocols'))
+        await self.accept(subprotocol=self.codec.subprotocol)
+
+    async def send_frame(self, frame):
+        """Send ``frame`` in the wire format negotiated at connect."""
+        text_data, bytes_data = self.codec.encode(frame)
+        await self.send(text_data=text_data, bytes_data=bytes_data)
+
+    async def send_error(self, message):
+        await self.send_frame({
+            'type': 'error',
+            'message': message
+        })
+
+    async def send_busy(self, frame):
+        # Echo the frame back so the client can resend it unchanged
+        self.record_error('busy')
+        await self.send_frame({
+            'type': 'error',
+            'code': 'busy',
+            'message': 'The server is busy, please retry',
+            'retry_after': settings.CONSUMER_DB_RETRY_AFTER,
+            'frame': frame
+        })
+
+
+class PresenceConsumerMixin:
+    """
+    Count the socket's user as online from connect until disconnect, and
+    keep them online on every ``ping`` frame. See chat.presence.
+    """
+
+    presence_counted = False
+
+    def scope_user_id(self):
+        user = self.scope.get('user')
+        if user is None or not user.is_authenticated:
+            return None
+        return user.id
+
+    async def open_presence(self):
+        """Return True if the socket's user was counted online."""
+        user_id = self.scope_user_id()
+        if user_id is None or self.presence_counted:
+            return False
+        self.presence_counted = True
+        await sync_to_async(mark_online, thread_sensitive=False)(user_id)
+        return True
+
+    async def close_presence(self):
+        """Return True if this was the user's last open socket."""
+        if not self.presence_counted:
+            return False
+        self.presence_counted = False
+        return await sync_to_async(mark_offline, thread_sensitive=False)(self.scope_user_id())
+
+    async def refresh_presence(self):
+        user_id = self.scope_user_id()
+        if user_id is not None:
+            await sync_to_async(heartbeat, thread_sensitive=False)(user_id)
+
+
+class ChatConsumer(FramedConsumerMixin, PresenceConsumerMixin, InstrumentedConsumerMixin, AsyncWebsocketConsumer):
     async def connect(self):
         try:
             self.room_name = self.scope['url_route']['kwargs']['room_name']
             self.room_group_name = f"chat_{self.room_name}"
+            # (sender, client_msg_id) -> ack frame for recently stored messages
+            self.recent_client_ids = OrderedDict()
             await self.channel_layer.group_add(self.room_group_name, self.channel_name)
-            await self.accept()
+            await self.accept_negotiated()
+            await self.set_presence(True)
         except Exception as e:
-            print(f"WebSocket connection error: {str(e)}")
+            logger.error(f"WebSocket connection error: {str(e)}")
+            self.record_error('connect')
             await self.close(code=4000)
 
     async def disconnect(self, close_code):
         try:
             await self.channel_layer.group_discard(self.room_group_name, self.channel_name)
+            await self.set_presence(False)
         except Exception as e:
-            print(f"WebSocket disconnect error: {str(e)}")
+            logger.error(f"WebSocket disconnect error: {str(e)}")
+            self.record_error('disconnect')
 
-    async def receive(self, text_data):
+    async def receive(self, text_data=None, bytes_data=None):
+        data = None
         try:
-            data = json.loads(text_data)
+            data = self.codec.decode(text_data, bytes_data)
             message_type = data.get('type', 'chat_message')
+
+            if message_type == 'sync':
+                await self.handle_sync(data)
+                return
+
+            if message_type == 'ping':
+                await self.refresh_presence()
+                await self.send_frame({'type': 'pong'})
+                return
+
+            if message_type == 'typing':
+                await self.handle_typing()
+                return
             
+            if message_type == 'read_receipt':
+                await self.handle_read_receipt(data)
+                return
+
             if not all(key in data for key in ['sender', 'receiver']):
                 await self.send_error("Missing required fields: sender and receiver")
                 return
                 
-            if message_type == 'read_receipt':
-                await self.handle_read_receipt(data)
-            else:
-                if 'message' not in data:
-                    await self.send_error("Message content is required")
-                    return
-                await self.handle_chat_message(data)
-        except json.JSONDecodeError:
-            await self.send_error("Invalid message format: Expected JSON")
+            if 'message' not in data:
+                await self.send_error("Message content is required")
+                return
+            await self.handle_chat_message(data)
+        except FrameError as e:
+            await self.send_error(str(e))
+        except DatabaseBusy:
+            await self.send_busy(data)
         except Exception as e:
-            print(f"WebSocket receive error: {str(e)}")
+            logger.exception(f"WebSocket receive error: {str(e)}")
+            self.record_error('receive')
             await self.send_error(f"An error occurred processing your message: {str(e)}")
 
     async def handle_read_receipt(self, data):
-        await self.channel_layer.group_send(
+        """
+        Mark the messages ``data['sender']`` sent in this room as read by the
+        socket's user. The reader always comes from the session, and the
+        sender must be the other participant of this room.
+        """
+        reader_id = self.scope_user_id()
+        sender_id = self.other_participant(data.get('sender'))
+        if sender_id is None:
+            await self.send_error("Read receipts are only accepted from this conversation's recipient")
+            return
+
+        await self.group_send(
             self.room_group_name,
             {
                 'type': 'read_receipt',
-                'sender': data['sender'],
-                'receiver': data['receiver']
+                'sender': str(sender_id),
+                'receiver': str(reader_id)
             }
         )
-        if 'receiver' in data and 'sender' in data:
-            await self.mark_messages_as_read(data['sender'], data['receiver'])
+        await self.mark_messages_as_read(sender_id, reader_id)
+        await self.group_send(
+            inbox_group(reader_id),
+            {'type': 'inbox_read', 'sender': str(sender_id)}
+        )
+
+    async def set_presence(self, online):
+        """Count the socket's user in or out and tell the room when they come or go."""
+        if online:
+            if not await self.open_presence():
+                return
+        elif not await self.close_presence():
+            return
+        await self.group_send(
+            self.room_group_name,
+            {'type': 'presence', 'user': str(self.scope_user_id()), 'online': online}
+        )
+
+    async def handle_typing(self):
+        # Relayed to the room only; typing state is never stored
+        user_id = self.scope_user_id()
+        if user_id is None:
+            return
+        await self.group_send(
+            self.room_group_name,
+            {'type': 'typing', 'sender': str(user_id)}
+        )
 
     async def handle_chat_message(self, data):
+        """
+        Store and deliver a message from the socket's user to the other
+        participant of this room. ``data['sender']`` must name the socket's
+        user and ``data['receiver']`` the other participant.
+        """
         try:
-            sender = await self.get_user(data['sender'])
-            receiver = await self.get_user(data['receiver'])
+            sender_id = self.scope_user_id()
+            receiver_id = self.other_participant(data['receiver'])
+            if receiver_id is None or str(data['sender']) != str(sender_id):
+                await self.send_error("Messages can only be sent to the other participant of this conversation")
+                return
+
+            client_msg_id = data.get('client_msg_id') or None
+            if client_msg_id is not None:
+                client_msg_id = str(client_msg_id)
+                if len(client_msg_id) > 64:
+                    await self.send_error("client_msg_id is too long (maximum 64 characters)")
+                    return
+                window_key = (sender_id, client_msg_id)
+                if window_key in self.recent_client_ids:
+                    await self.send_frame({**self.recent_client_ids[window_key], 'duplicate': True})
+                    return
+
+            sender = await self.get_user(sender_id)
+            receiver = await self.get_user(receiver_id)
             message = data['message'].strip()
             
             if not message:
@@ -70,58 +236,402 @@ class ChatConsumer(AsyncWebsocketConsumer):
                 await self.send_error("Message is too long (maximum 1000 characters)")
                 return
             
-            await self.save_message(sender, receiver, message)
-            
-            await self.channel_layer.group_send(
+            saved, created = await self.save_message(sender, receiver, message, client_msg_id)
+
+            if client_msg_id is not None:
+                ack = {
+                    'type': 'ack',
+                    'client_msg_id': client_msg_id,
+                    'id': saved.id,
+                    'timestamp': saved.timestamp.isoformat()
+                }
+                self.remember_client_id(window_key, ack)
+                await self.send_frame({**ack, 'duplicate': not created})
+            if not created:
+                return
+
+            await self.group_send(
                 self.room_group_name,
                 {
                     'type': 'chat_message',
+                    'id': saved.id,
+                    'client_msg_id': client_msg_id,
                     'message': message,
-                    'sender': data['sender'],
-                    'receiver': data['receiver']
+                    'sender': str(sender.id),
+                    'receiver': str(receiver.id),
+                    'timestamp': saved.timestamp.isoformat()
+                }
+            )
+            # The receiver's inbox sockets on other pages see it too
+            await self.group_send(
+                inbox_group(receiver.id),
+                {
+                    'type': 'inbox_message',
+                    'id': saved.id,
+                    'sender': str(sender.id),
+                    'message': message[:100],
+                    'timestamp': saved.timestamp.isoformat()
                 }
             )
         except ObjectDoesNotExist as e:
             await self.send_error("User not found")
         except ValidationError as e:
             await self.send_error(str(e))
+        except DatabaseBusy:
+            await self.send_busy(data)
         except Exception as e:
-            print(f"Chat message error: {str(e)}")
+            logger.exception(f"Chat message error: {str(e)}")
+            self.record_error('chat_message')
             await self.send_error("Failed to send message")
 
-    async def send_error(self, message):
-        await self.send(text_data=json.dumps({
-            'type': 'error',
-            'message': message
-        }))
+    def remember_client_id(self, window_key, ack):
+        self.recent_client_ids[window_key] = ack
+        self.recent_client_ids.move_to_end(window_key)
+        while len(self.recent_client_ids) > settings.CHAT_CLIENT_ID_WINDOW:
+            self.recent_client_ids.popitem(last=False)
+
+    def other_participant(self, user_id):
+        """
+        Return ``user_id`` as an int if it and the socket's user are the two
+        participants of this room, otherwise None.
+        """
+        participants = self.room_participants()
+        own_id = self.scope_user_id()
+        try:
+            user_id = int(user_id)
+        except (TypeError, ValueError):
+            return None
+        if own_id not in participants or user_id not in participants or user_id == own_id:
+            return None
+        return user_id
+
+    def room_participants(self):
+        """Return the two user ids encoded in the room name, e.g. ``3_7``."""
+        try:
+            return {int(user_id) for user_id in self.room_name.split('_')}
+        except ValueError:
+            return set()
+
+    async def handle_sync(self, data):
+        """
+        Replay the messages a reconnecting client missed, i.e. those with an
+        id above ``data['cursor']``, as batch frames of CHAT_SYNC_BATCH_SIZE,
+        then send a ``sync_complete`` frame with the new cursor and the
+        latest read message per sender. When more than CHAT_SYNC_MAX_MESSAGES
+        are missing, ``has_more`` tells the client to sync again from the
+        returned cursor.
+        """
+        user = self.scope.get('user')
+        participants = self.room_participants()
+        if user is None or not user.is_authenticated or user.id not in participants:
+            await self.send_error("You are not a participant in this chat")
+            return
+        try:
+            cursor = int(data.get('cursor') or 0)
+        except (TypeError, ValueError):
+            await self.send_error("Invalid sync cursor")
+            return
+
+        sent, has_more = 0, True
+        while has_more and sent < settings.CHAT_SYNC_MAX_MESSAGES:
+            limit = min(settings.CHAT_SYNC_BATCH_SIZE, settings.CHAT_SYNC_MAX_MESSAGES - sent)
+            frames = await self.get_messages_after(participants, cursor, limit + 1)
+            has_more = len(frames) > limit
+            frames = frames[:limit]
+            if frames:
+                cursor = frames[-1]['id']
+                sent += len(frames)
+                await self.send_frame({'type': 'batch', 'frames': frames})
+
+        read_up_to = await self.get_read_state(participants)
+        await self.send_frame({
+            'type': 'sync_complete',
+            'cursor': cursor,
+            'has_more': has_more,
+            'read_up_to': read_up_to
+        })
 
     async def chat_message(self, event):
-        await self.send(text_data=json.dumps({
+        self.observe_fanout(event)
+        await self.send_frame({
             'type': 'chat_message',
+            'id': event['id'],
+            'client_msg_id': event.get('client_msg_id'),
             'message': event['message'],
             'sender': event['sender'],
-            'receiver': event['receiver']
-        }))
+            'receiver': event['receiver'],
+            'timestamp': event['timestamp']
+        })
+
+    async def typing(self, event):
+        self.observe_fanout(event)
+        if event['sender'] != str(self.scope_user_id()):
+            await self.send_frame({'type': 'typing', 'sender': event['sender']})
+
+    async def presence(self, event):
+        self.observe_fanout(event)
+        if event['user'] != str(self.scope_user_id()):
+            await self.send_frame({'type': 'presence', 'user': event['user'], 'online': event['online']})
 
     async def read_receipt(self, event):
-        await self.send(text_data=json.dumps({
+        self.observe_fanout(event)
+        await self.send_frame({
             'type': 'read_receipt',
             'sender': event['sender'],
             'receiver': event['receiver']
-        }))
+        })
 
-    @database_sync_to_async
+    @timed_database_sync_to_async('get_user')
     def get_user(self, user_id):
         return User.objects.get(id=user_id)
 
-    @database_sync_to_async
-    def save_message(self, sender, receiver, message):
-        return Message.objects.create(sender=sender, receiver=receiver, content=message)
+    @timed_database_sync_to_async('save_message')
+    def save_message(self, sender, receiver, message, client_msg_id=None):
+        """
+        Store a message once per (sender, client_msg_id).
+
+        Returns:
+            tuple: (Message, created), where ``created`` is False when the
+            client resent a message that is already stored
+        """
+        if client_msg_id is None:
+            return Message.objects.create(sender=sender, receiver=receiver, content=message), True
+        existing = Message.objects.filter(sender=sender, client_msg_id=client_msg_id).first()
+        if existing is not None:
+            return existing, False
+        try:
+            with transaction.atomic():
+                return Message.objects.create(
+                    sender=sender, receiver=receiver, content=message, client_msg_id=client_msg_id
+                ), True
+        except (IntegrityError, ValidationError):
+            # A concurrent resend won the race; anything else is a real error
+            existing = Message.objects.filter(sender=sender, client_msg_id=client_msg_id).first()
+            if existing is None:
+                raise
+            return existing, False
 
-    @database_sync_to_async
+    @timed_database_sync_to_async('mark_messages_as_read')
     def mark_messages_as_read(self, sender_id, receiver_id):
-        return Message.objects.filter(
-            sender_id=sender_id,
-            receiver_id=receiver_id,
-            is_read=False
-        ).update(is_read=True) 
\ No newline at end of file
+        return mark_read(receiver_id, sender_id)
+
+    @timed_database_sync_to_async('get_messages_after')
+    def get_messages_after(self, participants, cursor, limit):
+        messages = Message.objects.filter(
+            sender_id__in=participants,
+            receiver_id__in=participants,
+            id__gt=cursor
+        ).order_by('id').values('id', 'sender_id', 'receiver_id', 'content', 'timestamp', 'client_msg_id')[:limit]
+        return [
+            {
+                'type': 'chat_message',
+                'id': message['id'],
+                'client_msg_id': message['client_msg_id'],
+                'message': message['content'],
+                'sender': str(message['sender_id']),
+                'receiver': str(message['receiver_id']),
+                'timestamp': message['timestamp'].isoformat()
+            }
+            for message in messages
+        ]
+
+    @timed_database_sync_to_async('get_read_state')
+    def get_read_state(self, participants):
+        return {str(sender_id): last_read for sender_id, last_read in read_positions(participants).items()}
+
+
+class InboxConsumer(FramedConsumerMixin, PresenceConsumerMixin, InstrumentedConsumerMixin, AsyncWebsocketConsumer):
+    """
+    Per-user inbox at ws/inbox/. On connect it sends one ``inbox`` frame
+    summarising unread conversations, then relays ``inbox_message`` and
+    ``inbox_read`` deltas that ChatConsumer publishes to the user's inbox
+    group, so pages other than the open chat can keep unread badges live.
+    Every page opens one, so it also keeps the user's presence alive.
+    """
+
+    async def connect(self):
+        user = self.scope.get('user')
+        if user is None or not user.is_authenticated:
+            await self.close(code=4001)
+            return
+        try:
+            self.group_name = inbox_group(user.id)
+            await self.channel_layer.group_add(self.group_name, self.channel_name)
+            await self.accept_negotiated()
+            await self.open_presence()
+            conversations = await self.get_unread_summary(user.id)
+            await self.send_frame({
+                'type': 'inbox',
+                'conversations': conversations,
+                'total': sum(conversation['unread'] for conversation in conversations)
+            })
+        except DatabaseBusy:
+            # The summary is only a hint; live deltas still arrive
+            self.record_error('busy')
+        except Exception as e:
+            logger.error(f"Inbox connection error: {str(e)}")
+            self.record_error('connect')
+            await self.close(code=4000)
+
+    async def disconnect(self, close_code):
+        if hasattr(self, 'group_name'):
+            await self.channel_layer.group_discard(self.group_name, self.channel_name)
+        try:
+            await self.close_presence()
+        except Exception as e:
+            logger.error(f"Inbox disconnect error: {str(e)}")
+            self.record_error('disconnect')
+
+    async def receive(self, text_data=None, bytes_data=None):
+        try:
+            data = self.codec.decode(text_data, bytes_data)
+        except FrameError as e:
+            await self.send_error(str(e))
+            return
+        if data.get('type') == 'ping':
+            await self.refresh_presence()
+            await self.send_frame({'type': 'pong'})
+
+    async def inbox_message(self, event):
+        self.observe_fanout(event)
+        await self.send_frame({
+            'type': 'inbox_message',
+            'id': event['id'],
+            'sender': event['sender'],
+            'message': event['message'],
+            'timestamp': event['timestamp']
+        })
+
+    async def inbox_read(self, event):
+        self.observe_fanout(event)
+        await self.send_frame({'type': 'inbox_read', 'sender': event['sender']})
+
+    @timed_database_sync_to_async('get_unread_summary')
+    def get_unread_summary(self, user_id):
+        summary = sorted(unread_summary(user_id).items(), key=lambda item: item[1][1], reverse=True)
+        return [
+            {'sender': str(sender_id), 'unread': unread, 'last_id': last_id}
+            for sender_id, (unread, last_id) in summary
+        ]
+
+
+class GroupChatConsumer(FramedConsumerMixin, InstrumentedConsumerMixin, AsyncWebsocketConsumer):
+    """
+    Group chat at ws/rooms/<room_id>/. Only members may connect; the sender
+    is always the connected user. Each message is stored once and fanned out
+    with one group_send, and ``read`` frames move the member's read cursor.
+    """
+
+    async def connect(self):
+        user = self.scope.get('user')
+        if user is None or not user.is_authenticated:
+            await self.close(code=4001)
+            return
+        try:
+            self.room_id = int(self.scope['url_route']['kwargs']['room_id'])
+            if not await self.is_member(self.room_id, user.id):
+                await self.close(code=4003)
+                return
+            self.room_group_name = room_group(self.room_id)
+            await self.channel_layer.group_add(self.room_group_name, self.channel_name)
+            await self.accept_negotiated()
+        except DatabaseBusy:
+            self.record_error('busy')
+            await self.close(code=4000)
+        except Exception as e:
+            logger.error(f"Group chat connection error: {str(e)}")
+            self.record_error('connect')
+            await self.close(code=4000)
+
+    async def disconnect(self, close_code):
+        if hasattr(self, 'room_group_name'):
+            await self.channel_layer.group_discard(self.room_group_name, self.channel_name)
+
+    async def receive(self, text_data=None, bytes_data=None):
+        data = None
+        try:
+            data = self.codec.decode(text_data, bytes_data)
+            message_type = data.get('type', 'chat_message')
+            user = self.scope['user']
+
+            if message_type == 'read':
+                try:
+                    cursor = int(data.get('cursor'))
+                except (TypeError, ValueError):
+                    await self.send_error("Invalid read cursor")
+                    return
+                cursor = await self.mark_read(cursor)
+                if cursor is not None:
+                    await self.group_send(
+                        self.room_group_name,
+                        {'type': 'read_cursor', 'user': str(user.id), 'cursor': cursor}
+                    )
+            elif message_type == 'typing':
+                await self.group_send(
+                    self.room_group_name,
+                    {'type': 'typing', 'sender': str(user.id)}
+                )
+            else:
+                message = str(data.get('message', '')).strip()
+                if not message:
+                    await self.send_error("Message cannot be empty")
+                    return
+                if len(message) > 1000:
+                    await self.send_error("Message is too long (maximum 1000 characters)")
+                    return
+                saved = await self.save_message(user.id, message)
+                await self.group_send(
+                    self.room_group_name,
+                    {
+                        'type': 'chat_message',
+                        'id': saved.id,
+                        'room': self.room_id,
+                        'message': message,
+                        'sender': str(user.id),
+                        'sender_name': user.username,
+                        'timestamp': saved.timestamp.isoformat()
+                    }
+                )
+        except FrameError as e:
+            await self.send_error(str(e))
+        except ValidationError as e:
+            await self.send_error(str(e))
+        except DatabaseBusy:
+            await self.send_busy(data)
+        except Exception as e:
+            logger.exception(f"Group chat receive error: {str(e)}")
+            self.record_error('receive')
+            await self.send_error("Failed to process your message")
+
+    async def chat_message(self, event):
+        self.observe_fanout(event)
+        await self.send_frame({
+            'type': 'chat_message',
+            'id': event['id'],
+            'room': event['room'],
+            'message': event['message'],
+            'sender': event['sender'],
+            'sender_name': event['sender_name'],
+            'timestamp': event['timestamp']
+        })
+
+    async def read_cursor(self, event):
+        self.observe_fanout(event)
+        await self.send_frame({'type': 'read_cursor', 'user': event['user'], 'cursor': event['cursor']})
+
+    async def typing(self, event):
+        self.observe_fanout(event)
+        if event['sender'] != str(self.scope['user'].id):
+            await self.send_frame({'type': 'typing', 'sender': event['sender']})
+
+    @timed_database_sync_to_async('is_member')
+    def is_member(self, room_id, user_id):
+        return Membership.objects.filter(room_id=room_id, user_id=user_id).exists()
+
+    @timed_database_sync_to_async('save_room_message')
+    def save_message(self, sender_id, message):
+        return RoomMessage.objects.create(room_id=self.room_id, sender_id=sender_id, content=message)
+
+    @timed_database_sync_to_async('mark_room_read')
+    def mark_read(self, cursor):
+        return mark_room_read(self.room_id, self.scope['user'].id, cursor)
@@ -1,7 +1,12 @@
+from django.conf import settings
+
 from .models import Notification
 
 def notifications_processor(request):
     if request.user.is_authenticated:
         unread_notifications = Notification.objects.filter(user=request.user, is_read=False).count()
-        return {'unread_notifications': unread_notifications}
+        return {
+            'unread_notifications': unread_notifications,
+            'presence_heartbeat': settings.PRESENCE_HEARTBEAT
+        }
     return {'unread_notifications': 0} 
\ No newline at end of file
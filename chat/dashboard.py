@@ -0,0 +1,53 @@
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.db.models import Count, Q
+
+from .models import Post, Comment
+from .rollups import get_daily_activity
+
+STATS_CACHE_KEY = 'dashboard:stats'
+ACTIVITY_CACHE_KEY = 'dashboard:activity:{days}'
+
+
+def get_platform_stats():
+    """
+    Return the headline counts shown on the admin dashboard.
+
+    Users are counted with a single conditional aggregate and the result
+    is cached for DASHBOARD_CACHE_SECONDS.
+    """
+    stats = cache.get(STATS_CACHE_KEY)
+    if stats is None:
+        user_counts = User.objects.aggregate(
+            total=Count('id'),
+            active=Count('id', filter=Q(is_active=True)),
+        )
+        stats = {
+            'total_users': user_counts['total'],
+            'active_users': user_counts['active'],
+            'blocked_users': user_counts['total'] - user_counts['active'],
+            'total_posts': Post.objects.count(),
+            'total_comments': Comment.objects.count(),
+        }
+        cache.set(STATS_CACHE_KEY, stats, settings.DASHBOARD_CACHE_SECONDS)
+    return stats
+
+
+def get_activity(days=7):
+    """
+    Return the per-day activity rollup for the last ``days`` days.
+
+    Only DailyActivity is read; the rollup_activity command keeps it up to
+    date from cron, so the dashboard never scans the raw tables.
+    """
+    key = ACTIVITY_CACHE_KEY.format(days=days)
+    activity = cache.get(key)
+    if activity is None:
+        activity = get_daily_activity(days)
+        cache.set(key, activity, settings.DASHBOARD_CACHE_SECONDS)
+    return activity
+
+
+def invalidate_dashboard_stats():
+    cache.delete_many([STATS_CACHE_KEY, ACTIVITY_CACHE_KEY.format(days=7)])
@@ -0,0 +1,62 @@
+"""
+Dedicated, bounded thread pool for WebSocket consumer DB work.
+
+Consumer DB calls run on CONSUMER_DB_WORKERS threads of their own instead
+of asgiref's shared executor, so chat traffic can't starve HTTP requests
+and the number of threads (and so DB connections) it uses is fixed. At
+most CONSUMER_DB_QUEUE_LIMIT calls may wait for a thread; beyond that
+``reserve()`` raises DatabaseBusy and the consumer tells the client to
+retry rather than queueing another coroutine.
+"""
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+
+from core.metrics import registry
+
+pending_calls = registry.gauge(
+    'ws_db_pending_calls', 'Consumer DB calls running or waiting for a worker thread'
+)
+rejected_calls = registry.counter(
+    'ws_db_rejected_total', 'Consumer DB calls refused because the queue was full, per operation'
+)
+
+_executor = None
+_pending = 0
+
+
+class DatabaseBusy(Exception):
+    """Raised when the consumer DB queue is full."""
+
+
+def get_executor():
+    global _executor
+    if _executor is None:
+        _executor = ThreadPoolExecutor(
+            max_workers=settings.CONSUMER_DB_WORKERS,
+            thread_name_prefix='consumer-db'
+        )
+    return _executor
+
+
+def reserve(operation):
+    """
+    Claim a place in the queue for one DB call.
+
+    Only called from the event loop thread, so the counter needs no lock.
+
+    Raises:
+        DatabaseBusy: If every worker is busy and the queue is full
+    """
+    global _pending
+    if _pending >= settings.CONSUMER_DB_WORKERS + settings.CONSUMER_DB_QUEUE_LIMIT:
+        rejected_calls.inc(operation=operation)
+        raise DatabaseBusy(f"Too many pending database calls for {operation}")
+    _pending += 1
+    pending_calls.inc()
+
+
+def release():
+    global _pending
+    _pending -= 1
+    pending_calls.dec()
@@ -1,6 +1,8 @@
 from django import forms
+from django.conf import settings
 from django.contrib.auth.models import User
 from .models import Profile, Post, Comment
+from .upload_handlers import ALLOWED_IMAGE_TYPES, IMAGE_TYPE_ERROR, image_size_error
 
 class RegisterForm(forms.ModelForm):
     password = forms.CharField(widget=forms.PasswordInput)
@@ -86,10 +88,11 @@ class PostForm(forms.ModelForm):
     def clean_image(self):
         image = self.cleaned_data.get('image')
         if image:
-            if image.size > 5*1024*1024:  # 5MB
-                raise forms.ValidationError("Image size should not exceed 5MB")
-            if not image.content_type in ['image/jpeg', 'image/png']:
-                raise forms.ValidationError("Only JPEG and PNG images are allowed")
+            if image.size > settings.MAX_IMAGE_UPLOAD_SIZE:
+                raise forms.ValidationError(image_size_error())
+            # content_type is sniffed from magic bytes by ImageUploadHandler
+            if image.content_type not in ALLOWED_IMAGE_TYPES:
+                raise forms.ValidationError(IMAGE_TYPE_ERROR)
         return image
 
 class CommentForm(forms.ModelForm):
@@ -0,0 +1,200 @@
+"""
+Two-tier cache for rendered post cards.
+
+The viewer-independent parts of a card (author header, content, image,
+counts and each comment's body) are rendered once and stored under
+``post-card:<id>:<version>``. Lookups go through a small per-process LRU
+first and the shared ``fragments`` cache second. The version is bumped
+whenever the post is edited, liked or commented on, so stale cards are
+never read again and simply age out. Version keys expire too, after
+FRAGMENT_VERSION_SECONDS; a post whose version has expired gets a fresh
+one, which only costs a re-render. Relative timestamps ("5 minutes ago")
+are frozen for at most FRAGMENT_CACHE_SECONDS.
+
+Viewer-specific bits (liked state, owner buttons, CSRF token) are layered
+on by ``chat/partials/post_card.html``, which only stitches the cached
+HTML together.
+"""
+import threading
+import time
+from collections import OrderedDict
+
+from django.conf import settings
+from django.core.cache import caches
+from django.db import DEFAULT_DB_ALIAS, transaction
+from django.db.models import Count, Prefetch, Q
+from django.template.loader import get_template
+from django.utils.connection import ConnectionProxy
+from django.utils.safestring import mark_safe
+
+from .models import Post, Comment
+
+VERSION_KEY = 'post-version:{post_id}'
+CARD_KEY = 'post-card:{post_id}:{version}'
+
+
+class LocalLRU:
+    """Thread-safe, size-bounded LRU with a per-entry expiry."""
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            expires_at, value = entry
+            if expires_at < time.monotonic():
+                del self.entries[key]
+                return None
+            self.entries.move_to_end(key)
+            return value
+
+    def set(self, key, value, timeout):
+        with self.lock:
+            self.entries[key] = (time.monotonic() + timeout, value)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+
+local_cards = LocalLRU(settings.FRAGMENT_LRU_SIZE)
+cache = ConnectionProxy(caches, 'fragments')
+
+
+def _new_version():
+    # Unique across processes, so a version key that was evicted from the
+    # shared cache can never be recreated with an old card's version
+    return time.time_ns()
+
+
+def get_post_versions(post_ids):
+    """
+    Return {post_id: version}, creating versions for posts that have none.
+    """
+    keys = {post_id: VERSION_KEY.format(post_id=post_id) for post_id in post_ids}
+    found = cache.get_many(list(keys.values()))
+    versions, created = {}, {}
+    for post_id, key in keys.items():
+        if key in found:
+            versions[post_id] = found[key]
+        else:
+            versions[post_id] = created[key] = _new_version()
+    if created:
+        cache.set_many(created, timeout=settings.FRAGMENT_VERSION_SECONDS)
+    return versions
+
+
+def bump_post_versions(post_ids):
+    """
+    Invalidate the cached cards for ``post_ids`` once the current
+    transaction commits, so a concurrent render can't cache pre-commit data
+    under the new version.
+    """
+    post_ids = list(post_ids)
+    if not post_ids:
+        return
+    transaction.on_commit(lambda: cache.set_many(
+        {VERSION_KEY.format(post_id=post_id): _new_version() for post_id in post_ids},
+        timeout=settings.FRAGMENT_VERSION_SECONDS,
+    ))
+
+
+def bump_post_version(post_id):
+    bump_post_versions([post_id])
+
+
+def invalidate_user_cards(user_id):
+    """Invalidate cards showing ``user_id``'s name or picture."""
+    post_ids = Post.objects.filter(
+        Q(user_id=user_id) | Q(comments__user_id=user_id)
+    ).values_list('id', flat=True).distinct()
+    bump_post_versions(post_ids)
+
+
+def render_card(post):
+    """Render the viewer-independent parts of one post card."""
+    post_body = get_template('chat/partials/post_body.html')
+    comment_body = get_template('chat/partials/comment_body.html')
+    return {
+        'id': post.id,
+        'user_id': post.user_id,
+        'likes_count': post.likes_count,
+        'comments_count': post.comments_count,
+        'body': post_body.render({'post': post}),
+        'comments': [
+            {
+                'id': comment.id,
+                'user_id': comment.user_id,
+                'body': comment_body.render({'comment': comment}),
+            }
+            for comment in post.comments.all()
+        ],
+    }
+
+
+def get_post_cards(post_ids):
+    """
+    Return {post_id: card} for ``post_ids``, rendering only the cards found
+    in neither the local LRU nor the shared cache.
+
+    Args:
+        post_ids: Iterable of post ids
+
+    Returns:
+        dict: Card dicts with ``body`` and per-comment ``body`` HTML
+    """
+    versions = get_post_versions(post_ids)
+    keys = {post_id: CARD_KEY.format(post_id=post_id, version=version) for post_id, version in versions.items()}
+    timeout = settings.FRAGMENT_CACHE_SECONDS
+
+    cards = {}
+    for post_id, key in keys.items():
+        card = local_cards.get(key)
+        if card is not None:
+            cards[post_id] = card
+
+    missing = [post_id for post_id in keys if post_id not in cards]
+    if missing:
+        shared = cache.get_many([keys[post_id] for post_id in missing])
+        for post_id in missing:
+            card = shared.get(keys[post_id])
+            if card is not None:
+                cards[post_id] = card
+                local_cards.set(keys[post_id], card, timeout)
+
+    missing = [post_id for post_id in keys if post_id not in cards]
+    if missing:
+        # Render from the primary: a lagging replica could otherwise cache
+        # pre-edit data under the freshly bumped version
+        posts = Post.objects.using(DEFAULT_DB_ALIAS).filter(id__in=missing).select_related('user__profile').prefetch_related(
+            Prefetch('comments', queryset=Comment.objects.select_related('user__profile').order_by('timestamp'))
+        ).annotate(
+            likes_count=Count('likes', distinct=True),
+            comments_count=Count('comments', distinct=True),
+        )
+        rendered = {}
+        for post in posts:
+            card = cards[post.id] = render_card(post)
+            rendered[keys[post.id]] = card
+            local_cards.set(keys[post.id], card, timeout)
+        cache.set_many(rendered, timeout)
+
+    return cards
+
+
+def layer_viewer_state(card, is_liked):
+    """Copy of ``card`` with the viewer's like state and safe HTML bodies."""
+    return {
+        **card,
+        'is_liked': is_liked,
+        'body': mark_safe(card['body']),
+        'comments': [{**comment, 'body': mark_safe(comment['body'])} for comment in card['comments']],
+    }
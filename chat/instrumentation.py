@@ -0,0 +1,138 @@
+import functools
+import time
+
+from channels.db import database_sync_to_async
+
+from core.metrics import registry
+
+from .executor import get_executor, release, reserve
+
+open_sockets = registry.gauge(
+    'ws_open_sockets', 'WebSocket connections currently open, per consumer'
+)
+# Labelled by consumer rather than room: one series per conversation would
+# grow without bound
+connects_total = registry.counter(
+    'ws_connects_total', 'Accepted WebSocket connections, per consumer'
+)
+disconnects_total = registry.counter(
+    'ws_disconnects_total', 'Closed WebSocket connections, per consumer and close code'
+)
+frames_received = registry.counter(
+    'ws_frames_received_total', 'Frames received from clients, per consumer'
+)
+frames_sent = registry.counter(
+    'ws_frames_sent_total', 'Frames sent to clients, per consumer'
+)
+bytes_sent = registry.counter(
+    'ws_bytes_sent_total', 'Payload bytes sent to clients, per consumer'
+)
+receive_seconds = registry.histogram(
+    'ws_receive_seconds', 'Time spent handling one received frame, per consumer'
+)
+group_send_seconds = registry.histogram(
+    'ws_group_send_seconds', 'Time spent in channel_layer.group_send, per event type'
+)
+fanout_seconds = registry.histogram(
+    'ws_fanout_latency_seconds', 'Delay between group_send and delivery to a member, per event type'
+)
+db_wait_seconds = registry.histogram(
+    'ws_db_wait_seconds', 'Time a consumer DB call waited for a worker thread, per operation'
+)
+db_seconds = registry.histogram(
+    'ws_db_seconds', 'Time a consumer DB call spent running, per operation'
+)
+errors_total = registry.counter(
+    'ws_errors_total', 'Errors raised while handling WebSocket events, per stage'
+)
+
+
+def timed_database_sync_to_async(operation):
+    """
+    database_sync_to_async on the consumer DB executor that records thread
+    wait time and run time. Raises DatabaseBusy when the queue is full.
+
+    Usage:
+        @timed_database_sync_to_async('save_message')
+        def save_message(self, sender, receiver, message): ...
+    """
+    def decorator(func):
+        def run(*args, submitted_at, **kwargs):
+            started = time.perf_counter()
+            db_wait_seconds.observe(started - submitted_at, operation=operation)
+            try:
+                return func(*args, **kwargs)
+            finally:
+                db_seconds.observe(time.perf_counter() - started, operation=operation)
+
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            reserve(operation)
+            try:
+                run_async = database_sync_to_async(run, thread_sensitive=False, executor=get_executor())
+                return await run_async(*args, submitted_at=time.perf_counter(), **kwargs)
+            finally:
+                release()
+        return wrapper
+    return decorator
+
+
+class InstrumentedConsumerMixin:
+    """
+    Metrics for AsyncWebsocketConsumer subclasses.
+
+    Counts connects and disconnects per consumer, tracks open sockets, times
+    each received frame and counts sent frames and bytes. Consumers
+    broadcast through ``self.group_send`` so fan-out is timed, and call
+    ``self.observe_fanout(event)`` from their group event handlers.
+    """
+
+    metrics_name = None
+
+    @property
+    def metrics_consumer(self):
+        return self.metrics_name or type(self).__name__
+
+    async def accept(self, *args, **kwargs):
+        await super().accept(*args, **kwargs)
+        self.metrics_accepted = True
+        open_sockets.inc(consumer=self.metrics_consumer)
+        connects_total.inc(consumer=self.metrics_consumer)
+
+    async def websocket_disconnect(self, message):
+        if getattr(self, 'metrics_accepted', False):
+            self.metrics_accepted = False
+            open_sockets.dec(consumer=self.metrics_consumer)
+            disconnects_total.inc(consumer=self.metrics_consumer, code=message.get('code', ''))
+        await super().websocket_disconnect(message)
+
+    async def websocket_receive(self, message):
+        frames_received.inc(consumer=self.metrics_consumer)
+        started = time.perf_counter()
+        try:
+            await super().websocket_receive(message)
+        finally:
+            receive_seconds.observe(time.perf_counter() - started, consumer=self.metrics_consumer)
+
+    async def send(self, text_data=None, bytes_data=None, close=False):
+        payload = text_data if text_data is not None else bytes_data
+        if payload is not None:
+            frames_sent.inc(consumer=self.metrics_consumer)
+            size = len(payload.encode()) if isinstance(payload, str) else len(payload)
+            bytes_sent.inc(size, consumer=self.metrics_consumer)
+        await super().send(text_data=text_data, bytes_data=bytes_data, close=close)
+
+    async def group_send(self, group, event):
+        event = {**event, 'sent_at': time.time()}
+        started = time.perf_counter()
+        try:
+            await self.channel_layer.group_send(group, event)
+        finally:
+            group_send_seconds.observe(time.perf_counter() - started, type=event['type'])
+
+    def observe_fanout(self, event):
+        if 'sent_at' in event:
+            fanout_seconds.observe(max(time.time() - event['sent_at'], 0), type=event['type'])
+
+    def record_error(self, stage):
+        errors_total.inc(consumer=self.metrics_consumer, stage=stage)
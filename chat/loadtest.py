@@ -0,0 +1,381 @@
+"""
+Synthetic load for the HTTP and WebSocket paths.
+
+HTTP workers pick operations from a weighted mix (feed reads, likes,
+comments) and chat rooms exchange messages through ws/chat/<room>/. The
+target is either ``core.asgi.application`` driven in-process or a running
+server such as a local Daphne. Whatever DATABASES and CHANNEL_LAYERS are
+configured (SQLite, Postgres, Redis) are used as-is.
+
+Several comma-separated targets spread HTTP workers across them and open
+each chat room's two sockets on different servers, so every message has to
+cross the channel layer between processes. Those deliveries are reported
+as ``ws:cross``, next to same-server ``ws:deliver``. For two local Daphne
+workers sharing a Redis channel layer::
+
+    export CHANNEL_REDIS_URLS=redis://localhost:6379 SECURE_SSL_REDIRECT=False
+    daphne -p 8001 core.asgi:application &
+    daphne -p 8002 core.asgi:application &
+    python manage.py loadtest --target http://localhost:8001,http://localhost:8002
+"""
+import asyncio
+import json
+import random
+import time
+from dataclasses import dataclass, field
+from urllib.parse import urlsplit
+
+from django.contrib.auth.models import User
+from django.db import connections
+from django.test import Client
+from django.utils.crypto import get_random_string
+
+from .models import Profile, FriendRequest, Post
+
+DEFAULT_MIX = {'feed': 70, 'like': 20, 'comment': 10}
+
+
+def parse_mix(value):
+    """Parse 'feed=70,like=20,comment=10' into {'feed': 70, ...}."""
+    mix = {}
+    for part in value.split(','):
+        name, _, weight = part.partition('=')
+        if name.strip() not in DEFAULT_MIX:
+            raise ValueError(f"Unknown operation '{name}'. Choose from {', '.join(DEFAULT_MIX)}")
+        mix[name.strip()] = int(weight)
+    return mix
+
+
+def percentile(samples, fraction):
+    if not samples:
+        return 0.0
+    ordered = sorted(samples)
+    return ordered[min(int(len(ordered) * fraction), len(ordered) - 1)]
+
+
+@dataclass
+class OperationStats:
+    latencies: list = field(default_factory=list)
+    errors: int = 0
+
+    def record(self, latency, ok):
+        if ok:
+            self.latencies.append(latency)
+        else:
+            self.errors += 1
+
+
+@dataclass
+class LoadSession:
+    user: User
+    session_key: str
+    csrf_token: str = field(default_factory=lambda: get_random_string(32))
+
+    @property
+    def cookie(self):
+        return f"sessionid={self.session_key}; csrftoken={self.csrf_token}"
+
+
+class InProcessTransport:
+    """Call the ASGI application directly, without a network hop."""
+
+    host = 'localhost'
+
+    def __init__(self):
+        from core.asgi import application
+        self.application = application
+
+    async def http(self, method, path, session, body=b'', content_type=None):
+        headers = [
+            (b'host', self.host.encode()),
+            (b'cookie', session.cookie.encode()),
+            (b'x-csrftoken', session.csrf_token.encode()),
+            (b'referer', f'https://{self.host}/'.encode()),
+            (b'x-requested-with', b'XMLHttpRequest'),
+        ]
+        if content_type:
+            headers.append((b'content-type', content_type.encode()))
+        scope = {
+            'type': 'http',
+            'asgi': {'version': '3.0'},
+            'http_version': '1.1',
+            'method': method,
+            'scheme': 'https',
+            'path': path,
+            'raw_path': path.encode(),
+            'query_string': b'',
+            'root_path': '',
+            'headers': headers,
+            'client': ('127.0.0.1', 0),
+            'server': (self.host, 443),
+        }
+        pending = [{'type': 'http.request', 'body': body, 'more_body': False}]
+        disconnected = asyncio.Event()
+        status = {}
+
+        async def receive():
+            if pending:
+                return pending.pop(0)
+            await disconnected.wait()
+            return {'type': 'http.disconnect'}
+
+        async def send(message):
+            if message['type'] == 'http.response.start':
+                status['code'] = message['status']
+
+        await self.application(scope, receive, send)
+        disconnected.set()
+        return status.get('code', 500)
+
+    async def open_socket(self, path, session):
+        from channels.testing import WebsocketCommunicator
+
+        communicator = WebsocketCommunicator(self.application, path, headers=[
+            (b'host', self.host.encode()),
+            (b'origin', f'http://{self.host}'.encode()),
+            (b'cookie', session.cookie.encode()),
+        ])
+        connected, _ = await communicator.connect()
+        if not connected:
+            raise ConnectionError(f"WebSocket connection to {path} was rejected")
+        return InProcessSocket(communicator)
+
+
+class InProcessSocket:
+    def __init__(self, communicator):
+        self.communicator = communicator
+
+    async def send(self, text):
+        await self.communicator.send_to(text_data=text)
+
+    async def recv(self, timeout):
+        return await self.communicator.receive_from(timeout=timeout)
+
+    async def close(self):
+        await self.communicator.disconnect()
+
+
+class RemoteTransport:
+    """Talk to a running server, e.g. ``daphne core.asgi:application``."""
+
+    def __init__(self, base_url):
+        import requests
+
+        self.base_url = base_url.rstrip('/')
+        parts = urlsplit(self.base_url)
+        self.ws_base = ('wss' if parts.scheme == 'https' else 'ws') + '://' + parts.netloc
+        self.origin = f"{parts.scheme}://{parts.netloc}"
+        self.http_session = requests.Session()
+
+    async def http(self, method, path, session, body=b'', content_type=None):
+        headers = {
+            'Cookie': session.cookie,
+            'X-CSRFToken': session.csrf_token,
+            'Referer': self.origin + '/',
+            'X-Requested-With': 'XMLHttpRequest',
+        }
+        if content_type:
+            headers['Content-Type'] = content_type
+        response = await asyncio.to_thread(
+            self.http_session.request, method, self.base_url + path,
+            data=body, headers=headers, allow_redirects=False, timeout=30
+        )
+        return response.status_code
+
+    async def open_socket(self, path, session):
+        from websockets.asyncio.client import connect
+
+        connection = await connect(
+            self.ws_base + path,
+            origin=self.origin,
+            additional_headers={'Cookie': session.cookie},
+        )
+        return RemoteSocket(connection)
+
+
+class RemoteSocket:
+    def __init__(self, connection):
+        self.connection = connection
+
+    async def send(self, text):
+        await self.connection.send(text)
+
+    async def recv(self, timeout):
+        return await asyncio.wait_for(self.connection.recv(), timeout)
+
+    async def close(self):
+        await self.connection.close()
+
+
+def prepare_sessions(user_count, posts_per_user=2):
+    """
+    Create (or reuse) loadtest users, each paired with a friend, with a few
+    posts to read and like. Returns a logged-in LoadSession per user.
+    """
+    sessions = []
+    users = []
+    for i in range(user_count):
+        user, created = User.objects.get_or_create(
+            username=f'loadtest{i}',
+            defaults={'email': f'loadtest{i}@nuv.ac.in'}
+        )
+        if created:
+            Profile.objects.create(user=user, full_name=f'Load Test {i}')
+            Post.objects.bulk_create([
+                Post(user=user, content=f'Load test post {n}') for n in range(posts_per_user)
+            ])
+        users.append(user)
+
+    for a, b in zip(users[::2], users[1::2]):
+        if not FriendRequest.objects.filter(from_user=a, to_user=b).exists():
+            FriendRequest.objects.create(from_user=a, to_user=b, is_accepted=True)
+
+    client = Client()
+    for user in users:
+        client.force_login(user)
+        sessions.append(LoadSession(user=user, session_key=client.session.session_key))
+        client.cookies.clear()
+    return sessions
+
+
+class LoadRunner:
+    def __init__(self, transports, sessions, post_ids, mix, http_workers, rooms, chat_interval, duration):
+        self.transports = transports
+        self.sessions = sessions
+        self.post_ids = post_ids
+        self.mix = mix
+        self.http_workers = http_workers
+        self.rooms = rooms
+        self.chat_interval = chat_interval
+        self.duration = duration
+        self.stats = {}
+        self.deadline = 0
+
+    def stats_for(self, name):
+        return self.stats.setdefault(name, OperationStats())
+
+    async def timed(self, name, coroutine):
+        started = time.perf_counter()
+        try:
+            status = await coroutine
+            ok = status < 400
+        except Exception:
+            ok = False
+        self.stats_for(name).record(time.perf_counter() - started, ok)
+
+    async def http_worker(self, worker_id):
+        rng = random.Random(worker_id)
+        transport = self.transports[worker_id % len(self.transports)]
+        operations = list(self.mix)
+        weights = [self.mix[name] for name in operations]
+        while time.perf_counter() < self.deadline:
+            session = rng.choice(self.sessions)
+            operation = rng.choices(operations, weights)[0]
+            if operation == 'feed':
+                await self.timed('http:feed', transport.http('GET', '/', session))
+            elif operation == 'like':
+                path = f'/like-post/{rng.choice(self.post_ids)}/'
+                await self.timed('http:like', transport.http('POST', path, session))
+            elif operation == 'comment':
+                path = f'/post/{rng.choice(self.post_ids)}/comment/'
+                body = json.dumps({'content': 'Load test comment'}).encode()
+                await self.timed('http:comment', transport.http('POST', path, session, body, 'application/json'))
+
+    async def chat_room(self, room_index, first, second):
+        room = f"{min(first.user.id, second.user.id)}_{max(first.user.id, second.user.id)}"
+        path = f'/ws/chat/{room}/'
+        # With several targets the two ends of a room sit on different servers
+        transports = [
+            self.transports[room_index % len(self.transports)],
+            self.transports[(room_index + 1) % len(self.transports)],
+        ]
+        try:
+            sockets = [
+                await transports[0].open_socket(path, first),
+                await transports[1].open_socket(path, second),
+            ]
+        except Exception:
+            self.stats_for('ws:connect').errors += 1
+            return
+
+        async def listen(index):
+            while time.perf_counter() < self.deadline + 1:
+                try:
+                    frame = json.loads(await sockets[index].recv(timeout=1))
+                except asyncio.TimeoutError:
+                    continue
+                except Exception:
+                    self.stats_for('ws:deliver').errors += 1
+                    return
+                if frame.get('type') == 'chat_message' and frame['message'].startswith('lt:'):
+                    sent_by, _, sent_at = frame['message'][3:].partition(':')
+                    crossed = transports[int(sent_by)] is not transports[index]
+                    self.stats_for('ws:cross' if crossed else 'ws:deliver').record(time.time() - float(sent_at), True)
+                elif frame.get('type') == 'error':
+                    self.stats_for('ws:deliver').errors += 1
+
+        listeners = [asyncio.create_task(listen(index)) for index in range(len(sockets))]
+        turn = 0
+        while time.perf_counter() < self.deadline:
+            sender, receiver = (first, second) if turn % 2 == 0 else (second, first)
+            # Every send should show up once in ws:deliver and, across
+            # servers, once in ws:cross
+            started = time.perf_counter()
+            await sockets[turn % 2].send(json.dumps({
+                'type': 'chat_message',
+                'message': f'lt:{turn % 2}:{time.time()}',
+                'sender': sender.user.id,
+                'receiver': receiver.user.id,
+            }))
+            self.stats_for('ws:send').record(time.perf_counter() - started, True)
+            turn += 1
+            await asyncio.sleep(self.chat_interval)
+
+        await asyncio.gather(*listeners, return_exceptions=True)
+        for socket in sockets:
+            await socket.close()
+
+    async def run(self):
+        self.deadline = time.perf_counter() + self.duration
+        started = time.perf_counter()
+        tasks = [self.http_worker(i) for i in range(self.http_workers)]
+        pairs = list(zip(self.sessions[::2], self.sessions[1::2]))
+        for room in range(self.rooms):
+            first, second = pairs[room % len(pairs)]
+            tasks.append(self.chat_room(room, first, second))
+        await asyncio.gather(*tasks)
+        return time.perf_counter() - started
+
+    def report(self, elapsed):
+        lines = [f"{'operation':<14}{'ok':>8}{'errors':>8}{'req/s':>10}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}"]
+        for name, stats in sorted(self.stats.items()):
+            ok = len(stats.latencies)
+            lines.append(
+                f"{name:<14}{ok:>8}{stats.errors:>8}{ok / elapsed:>10.1f}"
+                f"{percentile(stats.latencies, 0.50) * 1000:>10.1f}"
+                f"{percentile(stats.latencies, 0.95) * 1000:>10.1f}"
+                f"{percentile(stats.latencies, 0.99) * 1000:>10.1f}"
+            )
+        total = sum(len(stats.latencies) + stats.errors for stats in self.stats.values())
+        errors = sum(stats.errors for stats in self.stats.values())
+        error_rate = errors / total * 100 if total else 0
+        lines.append(f"{total} operations in {elapsed:.1f}s, error rate {error_rate:.2f}%")
+        return '\n'.join(lines)
+
+
+def run_load(target, users, mix, http_workers, rooms, chat_interval, duration):
+    """
+    Prepare data, run the load and return the report text. ``target`` may
+    list several comma-separated servers.
+    """
+    sessions = prepare_sessions(users)
+    post_ids = list(Post.objects.filter(user__username__startswith='loadtest').values_list('id', flat=True))
+    # Don't hold one of the DB_POOL_SIZE slots while the load runs
+    connections.close_all()
+    if target:
+        transports = [RemoteTransport(url) for url in target.split(',')]
+    else:
+        transports = [InProcessTransport()]
+    runner = LoadRunner(transports, sessions, post_ids, mix, http_workers, rooms, chat_interval, duration)
+    elapsed = asyncio.run(runner.run())
+    return runner.report(elapsed)
@@ -0,0 +1,14 @@
+from django.core.management.base import BaseCommand
+
+from core.sessions import clear_expired_sessions
+
+
+class Command(BaseCommand):
+    help = 'Delete expired database sessions in small batches'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--chunk-size', type=int, default=1000, help='Rows deleted per transaction')
+
+    def handle(self, *args, **options):
+        deleted = clear_expired_sessions(options['chunk_size'])
+        self.stdout.write(self.style.SUCCESS(f"Deleted {deleted} expired session(s)"))
@@ -0,0 +1,40 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from chat.loadtest import DEFAULT_MIX, parse_mix, run_load
+
+
+class Command(BaseCommand):
+    help = 'Generate synthetic feed, like, comment and chat load and report throughput and latency'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--target', help='Base URL of a running server, e.g. http://localhost:8000, or '
+                                             'several comma-separated to chat across workers. '
+                                             'Omit to drive core.asgi.application in-process.')
+        parser.add_argument('--users', type=int, default=20, help='Number of loadtest users to create or reuse')
+        parser.add_argument('--mix', default=','.join(f'{k}={v}' for k, v in DEFAULT_MIX.items()),
+                            help='Weighted HTTP operations, e.g. feed=70,like=20,comment=10')
+        parser.add_argument('--http-workers', type=int, default=10, help='Concurrent HTTP clients')
+        parser.add_argument('--rooms', type=int, default=5, help='Concurrent chat rooms (two sockets each)')
+        parser.add_argument('--chat-interval', type=float, default=0.2, help='Seconds between messages per room')
+        parser.add_argument('--duration', type=float, default=30, help='Seconds to run')
+
+    def handle(self, *args, **options):
+        try:
+            mix = parse_mix(options['mix'])
+        except ValueError as e:
+            raise CommandError(str(e))
+        if options['users'] < 2:
+            raise CommandError('At least two users are needed to pair chat rooms')
+
+        target = options['target'] or 'in-process ASGI application'
+        self.stdout.write(f"Running load against {target} for {options['duration']}s...")
+        report = run_load(
+            options['target'],
+            options['users'],
+            mix,
+            options['http_workers'],
+            options['rooms'],
+            options['chat_interval'],
+            options['duration'],
+        )
+        self.stdout.write(report)
@@ -0,0 +1,13 @@
+from django.core.management.base import BaseCommand
+from django.db import DEFAULT_DB_ALIAS, connections
+
+from chat.search import install_search_index
+
+
+class Command(BaseCommand):
+    help = 'Recreate the message search index (and its SQLite triggers) and reindex every message'
+
+    def handle(self, *args, **options):
+        connection = connections[DEFAULT_DB_ALIAS]
+        install_search_index(connection)
+        self.stdout.write(self.style.SUCCESS(f"Message search index ready on {connection.vendor}"))
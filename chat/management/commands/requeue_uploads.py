@@ -0,0 +1,14 @@
+from django.core.management.base import BaseCommand
+
+from chat.uploads import requeue_staged_uploads
+
+
+class Command(BaseCommand):
+    help = 'Process staged image uploads left behind by a restarted worker'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--retry-failed', action='store_true', help='Also retry uploads whose processing failed')
+
+    def handle(self, *args, **options):
+        count = requeue_staged_uploads(retry_failed=options['retry_failed'])
+        self.stdout.write(self.style.SUCCESS(f"Requeued {count} staged upload(s)"))
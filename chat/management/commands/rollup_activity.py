@@ -0,0 +1,14 @@
+from django.core.management.base import BaseCommand
+
+from chat.rollups import update_daily_activity
+
+
+class Command(BaseCommand):
+    help = ('Roll up posts, comments, likes, messages and signups created since the last run. '
+            'Run it from cron; the admin dashboard only reads the rollup.')
+
+    def handle(self, *args, **options):
+        processed = update_daily_activity()
+        for column, count in processed.items():
+            self.stdout.write(f"{column}: {count} new row(s)")
+        self.stdout.write(self.style.SUCCESS("Daily activity rollup complete"))
@@ -0,0 +1,59 @@
+# Generated by Django 5.0.2 on 2026-10-19 19:37
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+def seed_read_cursors(apps, schema_editor):
+    """Start each cursor at the newest message already flagged as read."""
+    Message = apps.get_model('chat', 'Message')
+    ReadCursor = apps.get_model('chat', 'ReadCursor')
+    rows = Message.objects.filter(is_read=True).order_by().values('receiver_id', 'sender_id').annotate(
+        last_read=models.Max('id')
+    )
+    ReadCursor.objects.bulk_create(
+        [
+            ReadCursor(reader_id=row['receiver_id'], peer_id=row['sender_id'], last_read_message_id=row['last_read'])
+            for row in rows.iterator()
+        ],
+        batch_size=1000,
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0021_chat_rooms'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ReadCursor',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('last_read_message_id', models.BigIntegerField(default=0)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+                ('peer', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to=settings.AUTH_USER_MODEL)),
+                ('reader', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='read_cursors', to=settings.AUTH_USER_MODEL)),
+            ],
+        ),
+        migrations.AddConstraint(
+            model_name='readcursor',
+            constraint=models.UniqueConstraint(fields=('reader', 'peer'), name='unique_read_cursor'),
+        ),
+        migrations.RunPython(seed_read_cursors, migrations.RunPython.noop),
+        migrations.RemoveIndex(
+            model_name='message',
+            name='chat_messag_receive_14362e_idx',
+        ),
+        migrations.RemoveField(
+            model_name='message',
+            name='is_read',
+        ),
+        migrations.AddIndex(
+            model_name='message',
+            index=models.Index(fields=['receiver', 'sender', 'id'], name='chat_messag_receive_0ff59f_idx'),
+        ),
+    ]
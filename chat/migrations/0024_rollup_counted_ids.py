@@ -0,0 +1,43 @@
+# Generated by Django 5.0.2 on 2026-10-19 20:22
+
+from django.conf import settings
+from django.db import migrations, models
+
+# Rollup column -> model, as in chat.rollups.ROLLUP_SOURCES at this point
+SOURCES = {
+    'posts': ('chat', 'Post'),
+    'comments': ('chat', 'Comment'),
+    'likes': ('chat', 'Like'),
+    'messages': ('chat', 'Message'),
+    'signups': ('auth', 'User'),
+}
+
+
+def seed_counted_ids(apps, schema_editor):
+    # Earlier runs recounted every row in the safety window, so every row
+    # present there now is already in DailyActivity
+    RollupWatermark = apps.get_model('chat', 'RollupWatermark')
+    for watermark in RollupWatermark.objects.filter(source__in=SOURCES):
+        model = apps.get_model(*SOURCES[watermark.source])
+        watermark.counted_ids = list(model.objects.filter(
+            id__gt=watermark.last_id - settings.ROLLUP_SAFETY_WINDOW,
+            id__lte=watermark.last_id,
+        ).order_by('id').values_list('id', flat=True))
+        watermark.save(update_fields=['counted_ids'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0023_message_search'),
+        ('auth', '0012_alter_user_first_name_max_length'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='rollupwatermark',
+            name='counted_ids',
+            field=models.JSONField(default=list),
+        ),
+        migrations.RunPython(seed_counted_ids, migrations.RunPython.noop),
+    ]
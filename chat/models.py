@@ -5,12 +5,16 @@ from django.core.exceptions import ValidationError
 import random
 from django.utils import timezone
 from datetime import timedelta
-from django.db.models import Q
+from django.db.models import BooleanField, ExpressionWrapper, OuterRef, Q, Subquery
+from django.db.models.functions import Coalesce
+from django.conf import settings
+
+from .upload_handlers import image_size_error
 
 def validate_file_size(value):
     filesize = value.size
-    if filesize > 5 * 1024 * 1024:  # 5MB limit
-        raise ValidationError("The maximum file size that can be uploaded is 5MB")
+    if filesize > settings.MAX_IMAGE_UPLOAD_SIZE:
+        raise ValidationError(image_size_error())
     return value
 
 class Profile(models.Model):
@@ -90,20 +94,37 @@ class FriendRequest(models.Model):
     def __str__(self):
         return f"{self.from_user} → {self.to_user}"
 
+class MessageQuerySet(models.QuerySet):
+    def with_read_state(self):
+        """Annotate ``is_read`` from the receiver's read cursor for each sender."""
+        cursor = ReadCursor.objects.filter(
+            reader_id=OuterRef('receiver_id'), peer_id=OuterRef('sender_id')
+        ).values('last_read_message_id')[:1]
+        return self.annotate(is_read=ExpressionWrapper(
+            Q(id__lte=Coalesce(Subquery(cursor), 0)), output_field=BooleanField()
+        ))
+
 class Message(models.Model):
     sender = models.ForeignKey(User, on_delete=models.CASCADE, related_name='sent_messages')
     receiver = models.ForeignKey(User, on_delete=models.CASCADE, related_name='received_messages')
     content = models.TextField(max_length=1000)
     timestamp = models.DateTimeField(auto_now_add=True, db_index=True)
-    is_read = models.BooleanField(default=False, db_index=True)
+    # Optional idempotency key generated by the client, so a resent frame
+    # can't store the same message twice
+    client_msg_id = models.CharField(max_length=64, null=True, blank=True)
+
+    objects = MessageQuerySet.as_manager()
 
     class Meta:
         ordering = ['timestamp']
         indexes = [
             models.Index(fields=['sender', 'receiver']),
-            models.Index(fields=['receiver', 'is_read']),
+            models.Index(fields=['receiver', 'sender', 'id']),
             models.Index(fields=['timestamp']),
         ]
+        constraints = [
+            models.UniqueConstraint(fields=['sender', 'client_msg_id'], name='unique_client_msg_id_per_sender'),
+        ]
 
     def clean(self):
         if self.sender == self.receiver:
@@ -117,9 +138,92 @@ class Message(models.Model):
         self.full_clean()
         super().save(*args, **kwargs)
 
+    @property
+    def is_read(self):
+        """
+        Whether the receiver has read this message, from their read cursor.
+        Use ``Message.objects.with_read_state()`` when listing messages to
+        avoid a query per message.
+        """
+        if not hasattr(self, '_is_read'):
+            cursor = ReadCursor.objects.filter(
+                reader_id=self.receiver_id, peer_id=self.sender_id
+            ).values_list('last_read_message_id', flat=True).first() or 0
+            self._is_read = self.id is not None and self.id <= cursor
+        return self._is_read
+
+    @is_read.setter
+    def is_read(self, value):
+        self._is_read = value
+
     def __str__(self):
         return f"{self.sender} → {self.receiver}: {self.content[:30]}"
 
+class ReadCursor(models.Model):
+    """How far ``reader`` has read the messages ``peer`` sent them."""
+    reader = models.ForeignKey(User, on_delete=models.CASCADE, related_name='read_cursors')
+    peer = models.ForeignKey(User, on_delete=models.CASCADE, related_name='+')
+    last_read_message_id = models.BigIntegerField(default=0)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['reader', 'peer'], name='unique_read_cursor'),
+        ]
+
+    def __str__(self):
+        return f"{self.reader} read {self.peer} up to {self.last_read_message_id}"
+
+class ChatRoom(models.Model):
+    """A group conversation. Messages are stored once per room, not per member."""
+    name = models.CharField(max_length=100)
+    created_by = models.ForeignKey(User, null=True, on_delete=models.SET_NULL, related_name='created_chat_rooms')
+    created_at = models.DateTimeField(auto_now_add=True)
+    members = models.ManyToManyField(User, through='Membership', related_name='chat_rooms')
+
+    def __str__(self):
+        return self.name
+
+class Membership(models.Model):
+    room = models.ForeignKey(ChatRoom, on_delete=models.CASCADE, related_name='memberships')
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='chat_memberships')
+    joined_at = models.DateTimeField(auto_now_add=True)
+    # Read cursor: every RoomMessage up to this id has been read
+    last_read_message_id = models.BigIntegerField(default=0)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['room', 'user'], name='unique_room_membership'),
+        ]
+
+    def __str__(self):
+        return f"{self.user} in {self.room}"
+
+class RoomMessage(models.Model):
+    room = models.ForeignKey(ChatRoom, on_delete=models.CASCADE, related_name='messages')
+    sender = models.ForeignKey(User, on_delete=models.CASCADE, related_name='sent_room_messages')
+    content = models.TextField(max_length=1000)
+    timestamp = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        ordering = ['id']
+        indexes = [
+            models.Index(fields=['room', 'id']),
+        ]
+
+    def clean(self):
+        if len(self.content.strip()) == 0:
+            raise ValidationError("Message content cannot be empty.")
+        if len(self.content) > 1000:
+            raise ValidationError("Message content cannot exceed 1000 characters.")
+
+    def save(self, *args, **kwargs):
+        self.full_clean()
+        super().save(*args, **kwargs)
+
+    def __str__(self):
+        return f"{self.sender} in {self.room}: {self.content[:30]}"
+
 class Post(models.Model):
     user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='posts')
     content = models.TextField()
@@ -180,4 +284,29 @@ class EmailVerification(models.Model):
     created_at = models.DateTimeField(auto_now_add=True)
 
     def is_expired(self):
-        return timezone.now() > self.created_at + timedelta(minutes=3)
\ No newline at end of file
+        return timezone.now() > self.created_at + timedelta(minutes=3)
+
+class DailyActivity(models.Model):
+    date = models.DateField(unique=True)
+    posts = models.PositiveIntegerField(default=0)
+    comments = models.PositiveIntegerField(default=0)
+    likes = models.PositiveIntegerField(default=0)
+    messages = models.PositiveIntegerField(default=0)
+    signups = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        ordering = ['date']
+        verbose_name_plural = 'daily activity'
+
+    def __str__(self):
+        return f"Activity on {self.date}"
+
+class RollupWatermark(models.Model):
+    source = models.CharField(max_length=50, unique=True)
+    last_id = models.BigIntegerField(default=0)
+    # Ids within ROLLUP_SAFETY_WINDOW of last_id that are already counted
+    counted_ids = models.JSONField(default=list)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return f"{self.source} rolled up to id {self.last_id}"
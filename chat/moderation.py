@@ -0,0 +1,71 @@
+import logging
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.db import transaction
+
+from core.metrics import registry
+
+from .models import Post, Like, Comment, Notification
+
+logger = logging.getLogger(__name__)
+
+# Chunks run while the response streams, after QueryMetricsMiddleware has
+# recorded the request, so they are counted here
+moderation_chunks = registry.counter(
+    'moderation_chunks_total', 'Bulk moderation chunks, per action and outcome (ok or error)'
+)
+
+
+def chunked(ids, size):
+    for start in range(0, len(ids), size):
+        yield ids[start:start + size]
+
+
+def bulk_delete_posts(post_ids, chunk_size=None):
+    """
+    Delete posts and their likes, comments and notifications in chunks.
+
+    Each chunk runs in its own transaction, so locks are held for at most
+    ``chunk_size`` posts at a time. Dependents are removed with direct
+    DELETE ... WHERE post_id IN (...) statements before the posts.
+
+    Yields:
+        dict: Progress after each chunk ({'processed', 'deleted', 'total'})
+    """
+    chunk_size = chunk_size or settings.MODERATION_CHUNK_SIZE
+    post_ids = sorted(set(post_ids))
+    deleted = 0
+    processed = 0
+    for chunk in chunked(post_ids, chunk_size):
+        with transaction.atomic():
+            Notification.objects.filter(post_id__in=chunk).delete()
+            Like.objects.filter(post_id__in=chunk).delete()
+            Comment.objects.filter(post_id__in=chunk).delete()
+            count, _ = Post.objects.filter(id__in=chunk).delete()
+        deleted += count
+        processed += len(chunk)
+        logger.info(f"Bulk post delete: {processed}/{len(post_ids)} processed")
+        yield {'processed': processed, 'deleted': deleted, 'total': len(post_ids)}
+
+
+def bulk_set_user_active(user_ids, is_active, chunk_size=None):
+    """
+    Block or unblock users in chunks. Superusers are never changed.
+
+    Yields:
+        dict: Progress after each chunk ({'processed', 'updated', 'total'})
+    """
+    chunk_size = chunk_size or settings.MODERATION_CHUNK_SIZE
+    user_ids = sorted(set(user_ids))
+    updated = 0
+    processed = 0
+    for chunk in chunked(user_ids, chunk_size):
+        with transaction.atomic():
+            updated += User.objects.filter(
+                id__in=chunk,
+                is_superuser=False
+            ).update(is_active=is_active)
+        processed += len(chunk)
+        logger.info(f"Bulk user update: {processed}/{len(user_ids)} processed")
+        yield {'processed': processed, 'updated': updated, 'total': len(user_ids)}
@@ -0,0 +1,77 @@
+"""
+Online presence kept in the ``presence`` cache, never in the database.
+
+Every chat and inbox socket counts as one connection for its user, and a
+user is online while their count is above zero. Opening a socket
+increments the count and closing it decrements it, so closing one tab
+leaves the user online while another is still open. Clients send a
+``ping`` frame every PRESENCE_HEARTBEAT seconds, which keeps the key alive
+for another PRESENCE_TTL seconds; a user whose sockets all went away
+without a clean disconnect simply expires.
+"""
+from django.conf import settings
+from django.core.cache import caches
+from django.utils.connection import ConnectionProxy
+
+PRESENCE_KEY = 'presence:{user_id}'
+
+cache = ConnectionProxy(caches, 'presence')
+
+
+def mark_online(user_id):
+    """
+    Count one more open socket for ``user_id``.
+
+    Returns:
+        int: The user's open socket count after this one
+    """
+    key = PRESENCE_KEY.format(user_id=user_id)
+    cache.add(key, 0, settings.PRESENCE_TTL)
+    try:
+        count = cache.incr(key)
+    except ValueError:
+        # Expired between add() and incr()
+        cache.set(key, 1, settings.PRESENCE_TTL)
+        return 1
+    cache.touch(key, settings.PRESENCE_TTL)
+    return count
+
+
+def mark_offline(user_id):
+    """
+    Count one fewer open socket for ``user_id``.
+
+    Returns:
+        bool: True if that was the user's last socket
+    """
+    key = PRESENCE_KEY.format(user_id=user_id)
+    try:
+        count = cache.decr(key)
+    except ValueError:
+        return True
+    if count <= 0:
+        cache.delete(key)
+        return True
+    return False
+
+
+def heartbeat(user_id):
+    """Keep ``user_id`` online for another PRESENCE_TTL seconds."""
+    key = PRESENCE_KEY.format(user_id=user_id)
+    if not cache.touch(key, settings.PRESENCE_TTL):
+        cache.add(key, 1, settings.PRESENCE_TTL)
+
+
+def get_presence(user_ids):
+    """
+    Return {user_id: is_online} for ``user_ids`` with one cache round trip.
+
+    Args:
+        user_ids: Iterable of user ids
+
+    Returns:
+        dict: True for users with a live heartbeat
+    """
+    keys = {user_id: PRESENCE_KEY.format(user_id=user_id) for user_id in user_ids}
+    found = cache.get_many(list(keys.values()))
+    return {user_id: key in found for user_id, key in keys.items()}
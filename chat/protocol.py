@@ -0,0 +1,141 @@
+"""
+Wire formats for chat WebSocket frames.
+
+JSON text frames are the default. Clients that offer the ``MSGPACK_SUBPROTOCOL``
+subprotocol at connect get binary MessagePack frames instead, shaped as
+``[type_code, {short_key: value}]`` so the type and field names that repeat
+on every frame cost a byte or two each. Frame types or fields without a
+code are sent as-is, so new frame types work before they are given one.
+"""
+import json
+
+import msgpack
+
+MSGPACK_SUBPROTOCOL = 'chat.msgpack.v1'
+
+FRAME_TYPES = {
+    'chat_message': 1,
+    'read_receipt': 2,
+    'error': 3,
+    'batch': 4,
+    'sync': 5,
+    'sync_complete': 6,
+    'ack': 7,
+    'ping': 8,
+    'pong': 9,
+    'typing': 10,
+    'presence': 11,
+    'inbox': 12,
+    'inbox_message': 13,
+    'inbox_read': 14,
+    'read': 15,
+    'read_cursor': 16,
+}
+FIELDS = {
+    'message': 'm',
+    'sender': 's',
+    'receiver': 'r',
+    'code': 'c',
+    'retry_after': 'a',
+    'frame': 'f',
+    'frames': 'fs',
+    'id': 'i',
+    'timestamp': 't',
+    'cursor': 'k',
+    'has_more': 'h',
+    'read_up_to': 'ru',
+    'client_msg_id': 'cm',
+    'duplicate': 'd',
+    'user': 'u',
+    'online': 'o',
+    'conversations': 'cv',
+    'unread': 'n',
+    'total': 'tt',
+    'last_id': 'l',
+    'room': 'rm',
+    'sender_name': 'sn',
+}
+# Fields holding nested frames, packed recursively
+NESTED_FRAME = 'frame'
+NESTED_FRAMES = 'frames'
+
+_TYPE_NAMES = {code: name for name, code in FRAME_TYPES.items()}
+_FIELD_NAMES = {short: name for name, short in FIELDS.items()}
+
+
+class FrameError(ValueError):
+    """Raised when an incoming frame can't be decoded."""
+
+
+class JSONCodec:
+    name = 'json'
+    subprotocol = None
+
+    def encode(self, frame):
+        """Return (text_data, bytes_data) for AsyncWebsocketConsumer.send."""
+        return json.dumps(frame), None
+
+    def decode(self, text_data=None, bytes_data=None):
+        if text_data is None:
+            raise FrameError("Invalid message format: Expected JSON")
+        try:
+            frame = json.loads(text_data)
+        except json.JSONDecodeError:
+            raise FrameError("Invalid message format: Expected JSON")
+        if not isinstance(frame, dict):
+            raise FrameError("Invalid message format: Expected a JSON object")
+        return frame
+
+
+class MessagePackCodec:
+    name = 'msgpack'
+    subprotocol = MSGPACK_SUBPROTOCOL
+
+    def pack(self, frame):
+        fields = {}
+        for name, value in frame.items():
+            if name == 'type':
+                continue
+            if name == NESTED_FRAME and isinstance(value, dict):
+                value = self.pack(value)
+            elif name == NESTED_FRAMES:
+                value = [self.pack(item) for item in value]
+            fields[FIELDS.get(name, name)] = value
+        return [FRAME_TYPES.get(frame.get('type'), frame.get('type')), fields]
+
+    def unpack(self, packed):
+        if not isinstance(packed, (list, tuple)) or len(packed) != 2 or not isinstance(packed[1], dict):
+            raise FrameError("Invalid message format: Expected [type, fields]")
+        code, fields = packed
+        frame = {'type': _TYPE_NAMES.get(code, code)}
+        for short, value in fields.items():
+            name = _FIELD_NAMES.get(short, short)
+            if name == NESTED_FRAME:
+                value = self.unpack(value)
+            elif name == NESTED_FRAMES:
+                value = [self.unpack(item) for item in value]
+            frame[name] = value
+        return frame
+
+    def encode(self, frame):
+        return None, msgpack.packb(self.pack(frame), use_bin_type=True)
+
+    def decode(self, text_data=None, bytes_data=None):
+        if bytes_data is None:
+            raise FrameError("Invalid message format: Expected MessagePack")
+        try:
+            packed = msgpack.unpackb(bytes_data, raw=False, strict_map_key=False)
+        except (ValueError, msgpack.UnpackException) as e:
+            raise FrameError(f"Invalid message format: {str(e)}")
+        return self.unpack(packed)
+
+
+JSON = JSONCodec()
+MESSAGEPACK = MessagePackCodec()
+
+
+def negotiate(subprotocols):
+    """Pick the codec for a connection from the subprotocols it offered."""
+    if MSGPACK_SUBPROTOCOL in (subprotocols or []):
+        return MESSAGEPACK
+    return JSON
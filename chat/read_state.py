@@ -0,0 +1,91 @@
+"""
+Read cursors for one-to-one conversations.
+
+Instead of flipping ``is_read`` on every message, each reader keeps one
+ReadCursor row per peer holding the id of the last message from that peer
+they have read. Marking a conversation read moves that single row forward,
+and a message is unread when its id is above the receiver's cursor for its
+sender. ``Message.is_read`` is still available for templates: querysets
+annotate it with ``Message.objects.with_read_state()``, and single
+instances look their cursor up on first access.
+"""
+from django.db import IntegrityError, transaction
+from django.db.models import Count, F, Max, OuterRef, Subquery
+from django.db.models.functions import Coalesce
+
+from .models import Message, ReadCursor
+
+
+def cursor_subquery(reader, peer):
+    """Last-read id of ``reader`` for messages from ``peer`` (expressions), or 0."""
+    return Coalesce(
+        Subquery(
+            ReadCursor.objects.filter(reader_id=reader, peer_id=peer).values('last_read_message_id')[:1]
+        ),
+        0
+    )
+
+
+def unread_messages(reader_id):
+    """Messages received by ``reader_id`` above their read cursor for the sender."""
+    return Message.objects.filter(receiver_id=reader_id).alias(
+        read_cursor=cursor_subquery(reader_id, OuterRef('sender_id'))
+    ).filter(id__gt=F('read_cursor'))
+
+
+def unread_summary(reader_id, sender_ids=None):
+    """
+    Return {sender_id: (unread count, last unread id)} for ``reader_id``.
+
+    Args:
+        reader_id: The reading user's id
+        sender_ids: Optionally limit the summary to these senders
+
+    Returns:
+        dict: Only senders with unread messages
+    """
+    messages = unread_messages(reader_id)
+    if sender_ids is not None:
+        messages = messages.filter(sender_id__in=sender_ids)
+    rows = messages.order_by().values('sender_id').annotate(unread=Count('id'), last_id=Max('id'))
+    return {row['sender_id']: (row['unread'], row['last_id']) for row in rows}
+
+
+def mark_read(reader_id, peer_id, message_id=None):
+    """
+    Move ``reader_id``'s cursor for ``peer_id`` forward to ``message_id``,
+    or to the newest message from the peer when it isn't given. The cursor
+    never moves backwards.
+
+    Returns:
+        bool: True if the cursor moved
+    """
+    if message_id is None:
+        message_id = Message.objects.filter(
+            sender_id=peer_id, receiver_id=reader_id
+        ).aggregate(last=Max('id'))['last']
+        if message_id is None:
+            return False
+    cursors = ReadCursor.objects.filter(reader_id=reader_id, peer_id=peer_id)
+    if cursors.filter(last_read_message_id__lt=message_id).update(last_read_message_id=message_id):
+        return True
+    if cursors.exists():
+        return False
+    try:
+        with transaction.atomic():
+            ReadCursor.objects.create(reader_id=reader_id, peer_id=peer_id, last_read_message_id=message_id)
+        return True
+    except IntegrityError:
+        # Created concurrently; move it forward if we're ahead
+        return cursors.filter(last_read_message_id__lt=message_id).update(last_read_message_id=message_id) > 0
+
+
+def read_positions(user_ids):
+    """
+    Return {sender_id: last read id} between the users in ``user_ids``,
+    i.e. how far each sender's messages have been read by the others.
+    """
+    rows = ReadCursor.objects.filter(
+        reader_id__in=user_ids, peer_id__in=user_ids
+    ).values_list('peer_id', 'last_read_message_id')
+    return {peer_id: last_read for peer_id, last_read in rows}
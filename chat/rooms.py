@@ -0,0 +1,102 @@
+"""
+Group chat rooms.
+
+A room's messages are stored once in RoomMessage and delivered with a
+single group_send to ``room_<id>``, however many members it has. Each
+Membership keeps a read cursor (the last RoomMessage id the member has
+read), so marking a room read updates one row and unread counts are
+derived as ``id > cursor``.
+"""
+import logging
+
+from django.core.exceptions import ValidationError
+from django.db import transaction
+from django.db.models import Count, OuterRef, Q, Subquery
+from django.db.models.functions import Coalesce
+
+from .models import ChatRoom, FriendRequest, Membership, RoomMessage
+
+logger = logging.getLogger(__name__)
+
+
+def room_group(room_id):
+    return f"room_{room_id}"
+
+
+def friend_ids(user):
+    ids = set()
+    for from_id, to_id in FriendRequest.objects.filter(
+        Q(from_user=user) | Q(to_user=user),
+        is_accepted=True
+    ).values_list('from_user_id', 'to_user_id'):
+        ids.add(to_id if from_id == user.id else from_id)
+    return ids
+
+
+def create_room(creator, name, member_ids):
+    """
+    Create a room with ``creator`` and those of ``member_ids`` who are the
+    creator's friends.
+
+    Args:
+        creator: User creating the room
+        name: Room name
+        member_ids: Iterable of user ids to add
+
+    Returns:
+        ChatRoom: The new room
+    """
+    name = name.strip()
+    if not name:
+        raise ValidationError("Room name is required.")
+    if len(name) > 100:
+        raise ValidationError("Room name cannot exceed 100 characters.")
+    members = set(member_ids) & friend_ids(creator)
+    if not members:
+        raise ValidationError("Add at least one friend to the room.")
+    with transaction.atomic():
+        room = ChatRoom.objects.create(name=name, created_by=creator)
+        Membership.objects.bulk_create(
+            [Membership(room=room, user_id=user_id) for user_id in members | {creator.id}]
+        )
+    logger.info(f"{creator.username} created room {room.id} with {len(members) + 1} members")
+    return room
+
+
+def get_rooms_with_unread(user):
+    """
+    Return the user's memberships, newest room first, each annotated with
+    ``unread`` (messages past the read cursor), in one query.
+    """
+    # A correlated count over the (room, id) index, not a join that would
+    # multiply messages by members
+    unread = RoomMessage.objects.filter(
+        room=OuterRef('room'),
+        id__gt=OuterRef('last_read_message_id')
+    ).order_by().values('room').annotate(count=Count('id')).values('count')
+    return list(
+        Membership.objects.filter(user=user).select_related('room').annotate(
+            unread=Coalesce(Subquery(unread), 0),
+            member_count=Count('room__memberships'),
+        ).order_by('-room__created_at')
+    )
+
+
+def mark_room_read(room_id, user_id, message_id):
+    """
+    Move the member's read cursor forward to ``message_id``, clamped to the
+    room's newest message so a client can't skip messages not sent yet.
+
+    Returns:
+        int: The new cursor, or None if it didn't move
+    """
+    latest_id = RoomMessage.objects.filter(room_id=room_id).order_by('-id').values_list('id', flat=True).first()
+    if latest_id is None:
+        return None
+    cursor = min(message_id, latest_id)
+    moved = Membership.objects.filter(
+        room_id=room_id,
+        user_id=user_id,
+        last_read_message_id__lt=cursor
+    ).update(last_read_message_id=cursor)
+    return cursor if moved else None
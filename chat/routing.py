@@ -3,4 +3,6 @@ from . import consumers
 
 websocket_urlpatterns = [
     re_path(r'ws/chat/(?P<room_name>[\w_]+)/$', consumers.ChatConsumer.as_asgi()),
+    re_path(r'ws/inbox/$', consumers.InboxConsumer.as_asgi()),
+    re_path(r'ws/rooms/(?P<room_id>\d+)/$', consumers.GroupChatConsumer.as_asgi()),
 ] 
\ No newline at end of file
@@ -0,0 +1,205 @@
+"""
+Full-text search over the requesting user's chat messages.
+
+PostgreSQL indexes a generated ``search_vector`` tsvector column on
+chat_message with a GIN index; SQLite keeps an FTS5 table over the same
+rows, filled by triggers. Either way the index is updated as messages are
+saved or deleted, with no extra work in the ORM. Other databases fall back
+to a scoped ``icontains`` scan.
+
+Results are limited to conversations the user is part of, newest first,
+paginated by message id and highlighted with ``<mark>``. Each query gets
+MESSAGE_SEARCH_TIMEOUT_MS; a search that runs over it returns what it has
+(nothing) with ``timed_out`` set rather than holding a connection.
+"""
+import logging
+import re
+import time
+
+from django.conf import settings
+from django.db import OperationalError, connections, router, transaction
+from django.db.models import Q
+from django.utils.html import escape
+from django.utils.safestring import mark_safe
+
+from core.metrics import registry
+
+from .models import Message
+
+logger = logging.getLogger(__name__)
+
+search_seconds = registry.histogram('message_search_seconds', 'Message search query time, per backend')
+search_timeouts = registry.counter('message_search_timeouts_total', 'Message searches cut off by the time budget')
+
+SEARCH_CONFIG = 'simple'
+MAX_TERMS = 8
+# Highlight markers; control characters can't be typed into a chat message,
+# and are swapped for <mark> only after the snippet is HTML-escaped
+MARK_START = '\x02'
+MARK_END = '\x03'
+
+POSTGRES_SCHEMA = [
+    f"ALTER TABLE chat_message ADD COLUMN IF NOT EXISTS search_vector tsvector "
+    f"GENERATED ALWAYS AS (to_tsvector('{SEARCH_CONFIG}', coalesce(content, ''))) STORED",
+    "CREATE INDEX IF NOT EXISTS chat_message_search_idx ON chat_message USING GIN (search_vector)",
+]
+SQLITE_SCHEMA = [
+    "CREATE VIRTUAL TABLE IF NOT EXISTS chat_message_fts USING fts5("
+    "content, content='chat_message', content_rowid='id', tokenize='unicode61 remove_diacritics 2')",
+    "CREATE TRIGGER IF NOT EXISTS chat_message_fts_ai AFTER INSERT ON chat_message BEGIN "
+    "INSERT INTO chat_message_fts(rowid, content) VALUES (new.id, new.content); END",
+    "CREATE TRIGGER IF NOT EXISTS chat_message_fts_ad AFTER DELETE ON chat_message BEGIN "
+    "INSERT INTO chat_message_fts(chat_message_fts, rowid, content) VALUES ('delete', old.id, old.content); END",
+    "CREATE TRIGGER IF NOT EXISTS chat_message_fts_au AFTER UPDATE OF content ON chat_message BEGIN "
+    "INSERT INTO chat_message_fts(chat_message_fts, rowid, content) VALUES ('delete', old.id, old.content); "
+    "INSERT INTO chat_message_fts(rowid, content) VALUES (new.id, new.content); END",
+    "INSERT INTO chat_message_fts(chat_message_fts) VALUES ('rebuild')",
+]
+
+
+def install_search_index(connection):
+    """
+    Create the search index for ``connection``'s backend and index existing
+    rows. Safe to re-run; on SQLite it also restores the triggers, which a
+    migration that rebuilds chat_message drops along with the old table.
+    """
+    statements = {'postgresql': POSTGRES_SCHEMA, 'sqlite': SQLITE_SCHEMA}.get(connection.vendor, [])
+    with connection.cursor() as cursor:
+        for statement in statements:
+            cursor.execute(statement)
+
+
+def search_terms(query):
+    """Split user input into plain word terms; search syntax is never passed through."""
+    return re.findall(r'\w+', query.lower())[:MAX_TERMS]
+
+
+def highlight(snippet):
+    return mark_safe(escape(snippet).replace(MARK_START, '<mark>').replace(MARK_END, '</mark>'))
+
+
+def _scope_sql(user_id, with_user_id, before_id):
+    sql = " AND (m.sender_id = %s OR m.receiver_id = %s)"
+    params = [user_id, user_id]
+    if with_user_id is not None:
+        sql += " AND (m.sender_id = %s OR m.receiver_id = %s)"
+        params += [with_user_id, with_user_id]
+    if before_id is not None:
+        sql += " AND m.id < %s"
+        params.append(before_id)
+    return sql, params
+
+
+def _search_postgresql(connection, terms, scope_sql, scope_params, limit, timeout_ms):
+    tsquery = ' & '.join(f'{term}:*' for term in terms)
+    options = f'StartSel={MARK_START}, StopSel={MARK_END}, MaxFragments=2, MaxWords=20, MinWords=5'
+    sql = (
+        "SELECT m.id, ts_headline(%s, m.content, q, %s) "
+        "FROM chat_message m, to_tsquery(%s, %s) q "
+        "WHERE m.search_vector @@ q" + scope_sql +
+        " ORDER BY m.id DESC LIMIT %s"
+    )
+    with transaction.atomic(using=connection.alias):
+        with connection.cursor() as cursor:
+            cursor.execute("SET LOCAL statement_timeout = %s", [timeout_ms])
+            cursor.execute(sql, [SEARCH_CONFIG, options, SEARCH_CONFIG, tsquery, *scope_params, limit])
+            return cursor.fetchall()
+
+
+def _search_sqlite(connection, terms, scope_sql, scope_params, limit, timeout_ms):
+    # Every term must match; the last one may be a prefix of a word being typed
+    match = ' '.join(f'"{term}"' for term in terms) + '*'
+    sql = (
+        "SELECT m.id, snippet(chat_message_fts, 0, %s, %s, '…', 16) "
+        "FROM chat_message_fts JOIN chat_message m ON m.id = chat_message_fts.rowid "
+        "WHERE chat_message_fts MATCH %s" + scope_sql +
+        " ORDER BY m.id DESC LIMIT %s"
+    )
+    deadline = time.monotonic() + timeout_ms / 1000
+    connection.ensure_connection()
+    # Returning non-zero aborts the statement with "interrupted"
+    connection.connection.set_progress_handler(lambda: int(time.monotonic() > deadline), 1000)
+    try:
+        with connection.cursor() as cursor:
+            cursor.execute(sql, [MARK_START, MARK_END, match, *scope_params, limit])
+            return cursor.fetchall()
+    finally:
+        connection.connection.set_progress_handler(None, 0)
+
+
+def _search_fallback(connection, terms, user_id, with_user_id, before_id, limit):
+    messages = Message.objects.using(connection.alias).filter(Q(sender_id=user_id) | Q(receiver_id=user_id))
+    if with_user_id is not None:
+        messages = messages.filter(Q(sender_id=with_user_id) | Q(receiver_id=with_user_id))
+    if before_id is not None:
+        messages = messages.filter(id__lt=before_id)
+    for term in terms:
+        messages = messages.filter(content__icontains=term)
+    pattern = re.compile('|'.join(re.escape(term) for term in terms), re.IGNORECASE)
+    return [
+        (message_id, pattern.sub(lambda match: f'{MARK_START}{match.group(0)}{MARK_END}', content))
+        for message_id, content in messages.order_by('-id').values_list('id', 'content')[:limit]
+    ]
+
+
+def search_messages(user, query, with_user_id=None, before_id=None, page_size=None):
+    """
+    Search ``user``'s one-to-one conversations.
+
+    Args:
+        user: The searching user; only messages they sent or received match
+        query: Free text; every word must appear, the last as a prefix
+        with_user_id: Optionally limit to the conversation with this user
+        before_id: Return results older than this message id (next page)
+        page_size: Results per page, MESSAGE_SEARCH_PAGE_SIZE by default
+
+    Returns:
+        dict: ``results`` (message, other user and highlighted snippet,
+        newest first), ``next_before`` for the following page or None, and
+        ``timed_out``
+    """
+    page = {'results': [], 'next_before': None, 'timed_out': False}
+    terms = search_terms(query)
+    if not terms:
+        return page
+    page_size = page_size or settings.MESSAGE_SEARCH_PAGE_SIZE
+    timeout_ms = settings.MESSAGE_SEARCH_TIMEOUT_MS
+    connection = connections[router.db_for_read(Message)]
+    scope_sql, scope_params = _scope_sql(user.id, with_user_id, before_id)
+
+    started = time.perf_counter()
+    try:
+        if connection.vendor == 'postgresql':
+            rows = _search_postgresql(connection, terms, scope_sql, scope_params, page_size + 1, timeout_ms)
+        elif connection.vendor == 'sqlite':
+            rows = _search_sqlite(connection, terms, scope_sql, scope_params, page_size + 1, timeout_ms)
+        else:
+            rows = _search_fallback(connection, terms, user.id, with_user_id, before_id, page_size + 1)
+    except OperationalError as e:
+        # SQLite's progress handler reports "interrupted", Postgres "statement timeout"
+        if 'interrupted' not in str(e) and 'statement timeout' not in str(e):
+            raise
+        logger.warning(f"Message search for user {user.id} stopped after {timeout_ms}ms: {str(e)}")
+        search_timeouts.inc()
+        page['timed_out'] = True
+        return page
+    finally:
+        search_seconds.observe(time.perf_counter() - started, backend=connection.vendor)
+
+    rows = rows[:page_size + 1]
+    if len(rows) > page_size:
+        rows = rows[:page_size]
+        page['next_before'] = rows[-1][0]
+    messages = Message.objects.using(connection.alias).select_related('sender', 'receiver').in_bulk(
+        [message_id for message_id, _ in rows]
+    )
+    for message_id, snippet in rows:
+        message = messages.get(message_id)
+        if message is None:
+            continue
+        page['results'].append({
+            'message': message,
+            'other_user': message.receiver if message.sender_id == user.id else message.sender,
+            'snippet': highlight(snippet),
+        })
+    return page
@@ -1,3 +1,1292 @@
-from django.test import TestCase
+"""
+Query-count and wall-time regression suite for every route in chat.urls.
 
-# Create your tests here.
+A realistic dataset is seeded once per test class with bulk inserts, then
+each route is requested and checked against a query budget and a time
+ceiling. A view that starts issuing a query per post, friend or message
+blows through its budget on this dataset and fails the test.
+
+Run with:
+    DEBUG=True python manage.py test chat
+
+PERF_SCALE scales the dataset (default 1.0, roughly 2,000 users) and
+PERF_MAX_SECONDS sets the per-view wall-time ceiling.
+"""
+import json
+import os
+import random
+import tempfile
+import time
+from datetime import timedelta
+from io import BytesIO
+from unittest import mock, skipUnless
+
+from asgiref.sync import async_to_sync
+from PIL import Image
+from channels.layers import get_channel_layer
+from channels.routing import URLRouter
+from channels.testing import WebsocketCommunicator
+from django.conf import settings
+from django.contrib.auth.hashers import make_password
+from django.contrib.auth.models import User
+from django.contrib.sessions.models import Session
+from django.core.cache import caches
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.db import DatabaseError, OperationalError, connection, router, transaction
+from django.http import HttpResponse
+from django.test import RequestFactory, SimpleTestCase, TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from django.utils import timezone
+
+from core.cache import cache_hits, cache_misses
+from core.db import ReplicaRoutingMiddleware, replica_reads
+from core.middleware import query_budget_exceeded, request_queries, requests_total
+from core.pool import BoundedConnectionMixin
+from core.sessions import clear_expired_sessions
+
+from . import archive, executor, protocol, routing, uploads, urls as chat_urls
+from .archive import archive_messages, get_history
+from .consumers import InboxConsumer
+from .dashboard import get_activity, get_platform_stats
+from .moderation import bulk_delete_posts
+from .rollups import rollup_source
+from .loadtest import InProcessTransport, LoadRunner, prepare_sessions
+from .fragments import local_cards
+from .presence import get_presence
+from .models import (
+    Profile, FriendRequest, Message, Post, Like, Comment, Notification, ReadCursor, RoomMessage, DailyActivity,
+    Membership,
+)
+from .read_state import mark_read, unread_summary
+from .rooms import create_room, get_rooms_with_unread
+from .search import search_messages
+from .upload_handlers import IMAGE_TYPE_ERROR, image_size_error
+
+PERF_SCALE = float(os.getenv('PERF_SCALE', '1.0'))
+PERF_MAX_SECONDS = float(os.getenv('PERF_MAX_SECONDS', '3.0'))
+
+
+class DatasetFactory:
+    """
+    Bulk-create users, profiles, friendships, posts, likes, comments,
+    messages and notifications around a single ``viewer`` user.
+    """
+
+    def __init__(self, scale=PERF_SCALE, seed=42):
+        self.random = random.Random(seed)
+        self.users = int(2000 * scale)
+        self.friends_per_user = 4
+        self.viewer_friends = int(50 * scale) or 1
+        self.posts = int(2000 * scale)
+        self.likes = int(8000 * scale)
+        self.comments = int(4000 * scale)
+        self.messages = int(8000 * scale)
+
+    def build(self):
+        password = make_password('password')
+        User.objects.bulk_create([
+            User(username=f'user{i}', email=f'user{i}@nuv.ac.in', password=password)
+            for i in range(self.users)
+        ])
+        users = list(User.objects.order_by('id'))
+        viewer = users[0]
+        viewer.is_staff = True
+        viewer.save(update_fields=['is_staff'])
+
+        Profile.objects.bulk_create([
+            Profile(user=user, full_name=f'User {i}', branch='CSE', year=1 + i % 4, bio='Hello!')
+            for i, user in enumerate(users)
+        ])
+
+        # Friendships: the viewer has a known circle, everyone else a few random friends
+        pairs = set()
+        friends = users[1:self.viewer_friends + 1]
+        for friend in friends:
+            pairs.add((viewer.id, friend.id))
+        for user in users[1:]:
+            for other in self.random.sample(users[1:], self.friends_per_user):
+                if other.id != user.id and (other.id, user.id) not in pairs:
+                    pairs.add((user.id, other.id))
+        FriendRequest.objects.bulk_create([
+            FriendRequest(from_user_id=a, to_user_id=b, is_accepted=True) for a, b in pairs
+        ])
+
+        Post.objects.bulk_create([
+            Post(user=self.random.choice(users), content=f'Post number {i}')
+            for i in range(self.posts)
+        ])
+        post_ids = list(Post.objects.values_list('id', flat=True))
+
+        likes = set()
+        while len(likes) < self.likes:
+            likes.add((self.random.choice(users).id, self.random.choice(post_ids)))
+        Like.objects.bulk_create([Like(user_id=u, post_id=p) for u, p in likes])
+
+        Comment.objects.bulk_create([
+            Comment(user=self.random.choice(users), post_id=self.random.choice(post_ids), content=f'Comment {i}')
+            for i in range(self.comments)
+        ])
+
+        # Half of the messages are between the viewer and their friends
+        messages = []
+        for i in range(self.messages):
+            if i % 2:
+                friend = self.random.choice(friends)
+                sender, receiver = (viewer, friend) if i % 4 == 1 else (friend, viewer)
+            else:
+                sender, receiver = self.random.sample(users[1:], 2)
+            messages.append(Message(sender=sender, receiver=receiver, content=f'Message {i}'))
+        Message.objects.bulk_create(messages)
+        # The viewer has read roughly the first half of each conversation
+        halfway = Message.objects.order_by('id').values_list('id', flat=True)[self.messages // 2]
+        ReadCursor.objects.bulk_create([
+            ReadCursor(reader=viewer, peer=friend, last_read_message_id=halfway) for friend in friends
+        ])
+
+        Notification.objects.bulk_create([
+            Notification(
+                user=viewer,
+                sender=self.random.choice(users[1:]),
+                notif_type='like',
+                message='liked your post',
+                post_id=self.random.choice(post_ids),
+            )
+            for _ in range(int(200 * PERF_SCALE) or 1)
+        ])
+
+        return {
+            'viewer': viewer,
+            'friend': friends[0],
+            'stranger': users[-1],
+        }
+
+
+class RouteQueryCountTests(TestCase):
+    """Every route in chat.urls, with a query budget and a time ceiling."""
+
+    # url name -> (method, user, max queries), measured with cold caches
+    ROUTES = {
+        'index': ('get', 'viewer', 7),
+        'register': ('get', None, 2),
+        'login': ('get', None, 2),
+        'logout': ('get', 'viewer', 5),
+        'profile': ('get', 'viewer', 8),
+        'user_profile': ('get', 'viewer', 12),
+        'friends': ('get', 'viewer', 9),
+        'find_friends': ('get', 'viewer', 9),
+        'chat_with_friend': ('get', 'viewer', 9),
+        'chat_history': ('get', 'viewer', 6),
+        'chat_rooms': ('get', 'viewer', 8),
+        'group_chat': ('get', 'viewer', 8),
+        'send_request': ('post', 'viewer', 15),
+        'cancel_request': ('post', 'viewer', 6),
+        'accept_request': ('post', 'viewer', 19),
+        'decline_request': ('post', 'viewer', 9),
+        'remove_friend': ('post', 'viewer', 7),
+        'notifications': ('get', 'viewer', 7),
+        'privacy_settings': ('get', 'viewer', 6),
+        'about': ('get', 'viewer', 5),
+        'faq': ('get', 'viewer', 5),
+        'terms': ('get', 'viewer', 5),
+        'privacy': ('get', 'viewer', 5),
+        'contact': ('get', 'viewer', 5),
+        'complete_profile': ('get', 'viewer', 6),
+        'like_post': ('post', 'viewer', 12),
+        'edit_post': ('get', 'viewer', 6),
+        'delete_post': ('post', 'viewer', 9),
+        'add_comment': ('post', 'viewer', 11),
+        'delete_comment': ('post', 'viewer', 8),
+        'admin_dashboard': ('get', 'viewer', 12),
+        'messages': ('get', 'viewer', 8),
+        'search_messages': ('get', 'viewer', 6),
+        'account': ('get', 'viewer', 5),
+        'admin_dashboard_alt': ('get', 'viewer', 12),
+        'toggle_block_user': ('post', 'viewer', 6),
+        'delete_post_admin': ('post', 'viewer', 9),
+        'bulk_delete_posts_admin': ('post', 'viewer', 14),
+        'bulk_block_users': ('post', 'viewer', 7),
+        'bulk_unblock_users': ('post', 'viewer', 7),
+        'delete_notification': ('post', 'viewer', 6),
+        'clear_all_notifications': ('post', 'viewer', 5),
+        'verify_otp': ('get', None, 2),
+        'resend_otp': ('post', None, 2),
+    }
+
+    @classmethod
+    def setUpTestData(cls):
+        data = DatasetFactory().build()
+        cls.viewer = data['viewer']
+        cls.friend = data['friend']
+        cls.stranger = data['stranger']
+
+        cls.own_post = Post.objects.create(user=cls.viewer, content='My post')
+        cls.own_comment = Comment.objects.create(user=cls.viewer, post=cls.own_post, content='My comment')
+        cls.pending_request = FriendRequest.objects.create(from_user=cls.stranger, to_user=cls.viewer)
+        cls.request_notification = Notification.objects.create(
+            user=cls.viewer,
+            sender=cls.stranger,
+            notif_type='friend_request',
+            message='sent you a friend request.'
+        )
+        cls.room = create_room(cls.viewer, 'Study group', [cls.friend.id])
+        RoomMessage.objects.create(room=cls.room, sender=cls.friend, content='Hello group')
+        cls.other_post_ids = list(Post.objects.exclude(user=cls.viewer).values_list('id', flat=True)[:100])
+
+    def clear_caches(self):
+        for cache in caches.all():
+            cache.clear()
+        local_cards.clear()
+
+    def route_request(self, name):
+        """Return (args, extra client kwargs) for a route."""
+        json_ids = lambda ids: {'data': json.dumps({'ids': ids}), 'content_type': 'application/json'}
+        routes = {
+            'user_profile': ([self.friend.id], {}),
+            'chat_with_friend': ([self.friend.id], {}),
+            'chat_history': ([self.friend.id], {}),
+            'group_chat': ([self.room.id], {}),
+            'search_messages': ([], {'data': {'q': 'Message 1'}}),
+            'send_request': ([self.stranger.id - 1], {}),
+            'cancel_request': ([self.stranger.id], {}),
+            'accept_request': ([self.request_notification.id], {}),
+            'decline_request': ([self.request_notification.id], {}),
+            'remove_friend': ([self.friend.id], {}),
+            'complete_profile': ([self.viewer.id], {}),
+            'like_post': ([self.other_post_ids[0]], {}),
+            'edit_post': ([self.own_post.id], {}),
+            'delete_post': ([self.own_post.id], {}),
+            'add_comment': ([self.other_post_ids[0]], {
+                'data': json.dumps({'content': 'Nice post'}), 'content_type': 'application/json'
+            }),
+            'delete_comment': ([self.own_comment.id], {}),
+            'toggle_block_user': ([self.stranger.id], {}),
+            'delete_post_admin': ([self.other_post_ids[0]], {}),
+            'bulk_delete_posts_admin': ([], json_ids(self.other_post_ids)),
+            'bulk_block_users': ([], json_ids([self.stranger.id])),
+            'bulk_unblock_users': ([], json_ids([self.stranger.id])),
+            'delete_notification': ([self.request_notification.id], {}),
+        }
+        return routes.get(name, ([], {}))
+
+    def test_every_route_is_covered(self):
+        names = {pattern.name for pattern in chat_urls.urlpatterns}
+        self.assertEqual(names - set(self.ROUTES), set(), "Add new routes to RouteQueryCountTests.ROUTES")
+
+    def test_route_query_counts(self):
+        for name, (method, user, max_queries) in self.ROUTES.items():
+            with self.subTest(route=name):
+                # Each budget covers the route alone, not a cache warmed by the one before
+                self.clear_caches()
+                args, extra = self.route_request(name)
+                if user:
+                    self.client.force_login(getattr(self, user))
+                else:
+                    self.client.logout()
+
+                savepoint = transaction.savepoint()
+                try:
+                    with CaptureQueriesContext(connection) as queries:
+                        started = time.perf_counter()
+                        response = getattr(self.client, method)(
+                            reverse(name, args=args),
+                            secure=True,
+                            HTTP_X_REQUESTED_WITH='XMLHttpRequest' if method == 'post' else '',
+                            **extra
+                        )
+                        if response.streaming:
+                            b''.join(response)
+                        elapsed = time.perf_counter() - started
+                finally:
+                    transaction.savepoint_rollback(savepoint)
+
+                self.assertLess(response.status_code, 500)
+                self.assertLessEqual(
+                    len(queries), max_queries,
+                    f"{name} ran {len(queries)} queries:\n" +
+                    '\n'.join(query['sql'][:200] for query in queries.captured_queries)
+                )
+                self.assertLess(elapsed, PERF_MAX_SECONDS, f"{name} took {elapsed:.2f}s")
+
+
+class PostCardCacheTests(TestCase):
+    """The feed reuses cached post cards and layers viewer state on top."""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.author = User.objects.create_user('author', 'author@nuv.ac.in', 'password')
+        cls.reader = User.objects.create_user('reader', 'reader@nuv.ac.in', 'password')
+        Profile.objects.create(user=cls.author, full_name='Post Author')
+        Profile.objects.create(user=cls.reader, full_name='Post Reader')
+        cls.posts = Post.objects.bulk_create([Post(user=cls.author, content=f'Post {i}') for i in range(20)])
+        Comment.objects.bulk_create([Comment(user=cls.author, post=post, content='First!') for post in cls.posts])
+
+    def setUp(self):
+        for cache in caches.all():
+            cache.clear()
+        local_cards.clear()
+
+    def get_feed(self, user):
+        self.client.force_login(user)
+        return self.client.get(reverse('index'), secure=True)
+
+    def test_warm_feed_skips_card_queries(self):
+        with CaptureQueriesContext(connection) as cold:
+            self.get_feed(self.reader)
+        local_cards.clear()
+        with CaptureQueriesContext(connection) as warm:
+            response = self.get_feed(self.reader)
+        self.assertLess(len(warm), len(cold))
+        self.assertContains(response, 'Post Author', count=40)
+
+    def test_owner_buttons_and_like_state_are_per_viewer(self):
+        Like.objects.create(user=self.reader, post=self.posts[0])
+        self.get_feed(self.author)
+        response = self.get_feed(self.reader)
+        self.assertContains(response, 'action-btn liked', count=1)
+        self.assertNotContains(response, 'onclick="deletePost(')
+        self.assertNotContains(response, 'onclick="deleteComment(')
+        response = self.get_feed(self.author)
+        self.assertContains(response, 'onclick="deletePost(', count=20)
+        self.assertContains(response, 'onclick="deleteComment(', count=20)
+        self.assertNotContains(response, 'action-btn liked')
+
+    def test_like_and_comment_invalidate_the_card(self):
+        post = self.posts[0]
+        self.get_feed(self.reader)
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.post(reverse('like_post', args=[post.id]), secure=True)
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.post(
+                reverse('add_comment', args=[post.id]),
+                data=json.dumps({'content': 'Fresh comment'}),
+                content_type='application/json',
+                secure=True,
+            )
+        response = self.get_feed(self.reader)
+        self.assertContains(response, '1 Likes')
+        self.assertContains(response, 'Fresh comment')
+
+    def test_unlike_shows_the_lower_count(self):
+        post = self.posts[0]
+        Like.objects.create(user=self.reader, post=post)
+        real_delete = Like.delete
+
+        def delete_after_render(like, *args, **kwargs):
+            # A feed render landing between the toggle and the delete
+            self.get_feed(self.author)
+            return real_delete(like, *args, **kwargs)
+
+        self.get_feed(self.reader)
+        with mock.patch('chat.fragments.transaction.on_commit', lambda callback: callback()), \
+                mock.patch.object(Like, 'delete', delete_after_render):
+            self.client.force_login(self.reader)
+            response = self.client.post(reverse('like_post', args=[post.id]), secure=True)
+        self.assertEqual(response.json()['action'], 'unliked')
+        response = self.get_feed(self.reader)
+        self.assertContains(response, '0 Likes', count=20)
+        self.assertNotContains(response, '1 Likes')
+
+
+class CacheNamespaceTests(TestCase):
+    """Each namespace is a separate store with its own hit/miss counters."""
+
+    def test_namespaces_are_isolated_and_counted(self):
+        fragments, counters = caches['fragments'], caches['counters']
+        fragments.clear()
+        counters.clear()
+        hits = cache_hits.samples.get((('namespace', 'fragments'),), 0)
+        misses = cache_misses.samples.get((('namespace', 'fragments'),), 0)
+
+        fragments.set('key', 'value')
+        self.assertIsNone(counters.get('key'))
+        self.assertEqual(fragments.get('key'), 'value')
+        self.assertEqual(fragments.get_many(['key', 'other']), {'key': 'value'})
+
+        self.assertEqual(cache_hits.samples[(('namespace', 'fragments'),)], hits + 2)
+        self.assertEqual(cache_misses.samples[(('namespace', 'fragments'),)], misses + 1)
+
+
+class SessionEngineTests(TestCase):
+    """Cached sessions skip django_session; expired rows are cleared in chunks."""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user('sessions', 'sessions@nuv.ac.in', 'password')
+        Profile.objects.create(user=cls.user, full_name='Session User')
+
+    @override_settings(SESSION_ENGINE='django.contrib.sessions.backends.cached_db')
+    def test_cached_db_session_is_read_from_cache(self):
+        caches['sessions'].clear()
+        self.client.force_login(self.user)
+        self.client.get(reverse('about'), secure=True)
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(reverse('about'), secure=True)
+        self.assertEqual(response.status_code, 200)
+        self.assertFalse([q for q in queries.captured_queries if 'django_session' in q['sql']])
+
+    def test_clear_expired_sessions_in_chunks(self):
+        expired = timezone.now() - timedelta(days=1)
+        Session.objects.bulk_create([
+            Session(session_key=f'expired{i}', session_data='', expire_date=expired) for i in range(25)
+        ])
+        Session.objects.create(session_key='current', session_data='', expire_date=timezone.now() + timedelta(days=1))
+        self.assertEqual(clear_expired_sessions(chunk_size=10), 25)
+        self.assertEqual(list(Session.objects.values_list('session_key', flat=True)), ['current'])
+
+
+@override_settings(DATABASE_REPLICAS=['replica1'])
+class ReplicaRoutingTests(SimpleTestCase):
+    """Marked views read from a replica unless the client just wrote."""
+
+    def setUp(self):
+        self.factory = RequestFactory()
+        self.seen = []
+
+        @replica_reads
+        def listing(request):
+            self.seen.append(router.db_for_read(Post))
+            return HttpResponse()
+
+        def unmarked(request):
+            self.seen.append(router.db_for_read(Post))
+            return HttpResponse()
+
+        self.views = {'listing': listing, 'unmarked': unmarked}
+
+    def run_request(self, request, view):
+        view = self.views[view]
+        middleware = ReplicaRoutingMiddleware(lambda request: middleware.process_view(request, view, (), {}) or view(request))
+        return middleware(request)
+
+    def test_marked_get_reads_from_replica(self):
+        self.run_request(self.factory.get('/'), 'listing')
+        self.run_request(self.factory.get('/'), 'unmarked')
+        self.assertEqual(self.seen, ['replica1', 'default'])
+        self.assertEqual(router.db_for_read(Post), 'default')
+
+    def test_writes_pin_reads_to_primary(self):
+        response = self.run_request(self.factory.post('/'), 'listing')
+        self.assertEqual(self.seen, ['default'])
+        self.assertIn(settings.REPLICA_PIN_COOKIE, response.cookies)
+
+        request = self.factory.get('/')
+        request.COOKIES[settings.REPLICA_PIN_COOKIE] = '1'
+        self.run_request(request, 'listing')
+        self.assertEqual(self.seen, ['default', 'default'])
+
+
+class StubConnection:
+    alias = 'pooltest'
+    connection = None
+
+    def connect(self):
+        self.connection = object()
+
+    def close(self):
+        self.connection = None
+
+
+class PooledStubConnection(BoundedConnectionMixin, StubConnection):
+    pass
+
+
+@override_settings(DB_POOL_SIZE=1, DB_POOL_TIMEOUT=0.05)
+class ConnectionPoolTests(SimpleTestCase):
+    """DB_POOL_SIZE bounds the connections a process holds open."""
+
+    def test_connect_waits_for_a_free_slot(self):
+        first, second = PooledStubConnection(), PooledStubConnection()
+        first.connect()
+        with self.assertRaises(OperationalError):
+            second.connect()
+        first.close()
+        second.connect()
+        self.assertIsNotNone(second.connection)
+        second.close()
+
+
+@override_settings(CONSUMER_DB_WORKERS=1, CONSUMER_DB_QUEUE_LIMIT=1)
+class ConsumerExecutorTests(SimpleTestCase):
+    """Consumer DB calls beyond the workers plus the queue limit are refused."""
+
+    def test_reserve_refuses_when_queue_is_full(self):
+        executor.reserve('test')
+        executor.reserve('test')
+        try:
+            with self.assertRaises(executor.DatabaseBusy):
+                executor.reserve('test')
+        finally:
+            executor.release()
+            executor.release()
+        executor.reserve('test')
+        executor.release()
+
+    def test_consumer_sends_busy_when_saturated(self):
+        frame = {'type': 'chat_message', 'message': 'hi', 'sender': '1', 'receiver': '2'}
+
+        async def exchange():
+            communicator = WebsocketCommunicator(URLRouter(routing.websocket_urlpatterns), '/ws/chat/1_2/')
+            communicator.scope['user'] = User(id=1, username='alice')
+            await communicator.connect()
+            executor.reserve('test')
+            executor.reserve('test')
+            try:
+                await communicator.send_json_to(frame)
+                reply = await communicator.receive_json_from()
+            finally:
+                executor.release()
+                executor.release()
+            await communicator.disconnect()
+            return reply
+
+        self.assertEqual(async_to_sync(exchange)(), {
+            'type': 'error', 'code': 'busy', 'message': 'The server is busy, please retry',
+            'retry_after': settings.CONSUMER_DB_RETRY_AFTER, 'frame': frame,
+        })
+
+
+class MessagePackProtocolTests(SimpleTestCase):
+    """Clients offering the MessagePack subprotocol get compact binary frames."""
+
+    def test_codec_round_trip(self):
+        frame = {
+            'type': 'error', 'code': 'busy', 'message': 'retry', 'retry_after': 1,
+            'frame': {'type': 'chat_message', 'message': 'hi', 'sender': '1', 'receiver': '2'},
+        }
+        _, packed = protocol.MESSAGEPACK.encode(frame)
+        self.assertEqual(protocol.MESSAGEPACK.decode(bytes_data=packed), frame)
+        self.assertLess(len(packed), len(protocol.JSON.encode(frame)[0]))
+
+    def test_negotiated_at_connect(self):
+        async def exchange(subprotocols, **payload):
+            communicator = WebsocketCommunicator(
+                URLRouter(routing.websocket_urlpatterns), '/ws/chat/1_2/', subprotocols=subprotocols,
+            )
+            connected, subprotocol = await communicator.connect()
+            await communicator.send_to(**payload)
+            reply = await communicator.receive_output()
+            await communicator.disconnect()
+            return subprotocol, reply
+
+        subprotocol, reply = async_to_sync(exchange)(
+            [protocol.MSGPACK_SUBPROTOCOL], bytes_data=protocol.MESSAGEPACK.encode({'type': 'chat_message'})[1],
+        )
+        self.assertEqual(subprotocol, protocol.MSGPACK_SUBPROTOCOL)
+        error = protocol.MESSAGEPACK.decode(bytes_data=reply['bytes'])
+        self.assertEqual(error, {'type': 'error', 'message': 'Missing required fields: sender and receiver'})
+
+        subprotocol, reply = async_to_sync(exchange)([], text_data=json.dumps({'type': 'chat_message'}))
+        self.assertIsNone(subprotocol)
+        self.assertEqual(json.loads(reply['text'])['type'], 'error')
+
+
+@override_settings(CHAT_SYNC_BATCH_SIZE=2, CHAT_SYNC_MAX_MESSAGES=3)
+class ChatSyncTests(TransactionTestCase):
+    """A reconnecting client gets only the messages after its cursor, in batches."""
+
+    def test_sync_replays_missed_messages(self):
+        alice = User.objects.create_user('alice', password='x')
+        bob = User.objects.create_user('bob', password='x')
+        sent = [
+            Message.objects.create(sender=alice, receiver=bob, content=f'message {i}')
+            for i in range(6)
+        ]
+        mark_read(bob.id, alice.id, sent[1].id)
+
+        async def sync(cursor):
+            communicator = WebsocketCommunicator(
+                URLRouter(routing.websocket_urlpatterns), f'/ws/chat/{alice.id}_{bob.id}/',
+            )
+            communicator.scope['user'] = bob
+            await communicator.connect()
+            await communicator.send_json_to({'type': 'sync', 'cursor': cursor})
+            frames = []
+            while not frames or frames[-1]['type'] != 'sync_complete':
+                frames.append(await communicator.receive_json_from())
+            await communicator.disconnect()
+            return frames
+
+        frames = async_to_sync(sync)(sent[0].id)
+        self.assertEqual([frame['type'] for frame in frames], ['batch', 'batch', 'sync_complete'])
+        replayed = [message['id'] for frame in frames[:-1] for message in frame['frames']]
+        self.assertEqual(replayed, [message.id for message in sent[1:4]])
+        self.assertEqual(frames[-1]['cursor'], sent[3].id)
+        self.assertTrue(frames[-1]['has_more'])
+        self.assertEqual(frames[-1]['read_up_to'], {str(alice.id): sent[1].id})
+
+        frames = async_to_sync(sync)(sent[3].id)
+        self.assertEqual([message['id'] for message in frames[0]['frames']], [sent[4].id, sent[5].id])
+        self.assertFalse(frames[-1]['has_more'])
+
+
+class IdempotentSendTests(TransactionTestCase):
+    """Resending a frame with the same client_msg_id stores and broadcasts it once."""
+
+    def test_resend_is_acknowledged_without_a_second_insert(self):
+        alice = User.objects.create_user('alice', password='x')
+        bob = User.objects.create_user('bob', password='x')
+        frame = {
+            'type': 'chat_message', 'client_msg_id': 'c-1', 'message': 'hello',
+            'sender': str(alice.id), 'receiver': str(bob.id),
+        }
+
+        async def send(times):
+            communicator = WebsocketCommunicator(
+                URLRouter(routing.websocket_urlpatterns), f'/ws/chat/{alice.id}_{bob.id}/',
+            )
+            communicator.scope['user'] = alice
+            await communicator.connect()
+            replies = []
+            for _ in range(times):
+                await communicator.send_json_to(frame)
+                replies.append(await communicator.receive_json_from())
+                if not replies[-1].get('duplicate'):
+                    replies.append(await communicator.receive_json_from())
+            self.assertTrue(await communicator.receive_nothing())
+            await communicator.disconnect()
+            return replies
+
+        # The first connection hits the in-memory window, the second the unique constraint
+        first = async_to_sync(send)(2)
+        second = async_to_sync(send)(1)
+        self.assertEqual([reply['type'] for reply in first], ['ack', 'chat_message', 'ack'])
+        self.assertEqual([reply.get('duplicate') for reply in first + second], [False, None, True, True])
+        self.assertEqual({reply['id'] for reply in first + second}, {Message.objects.get().id})
+
+
+class PresenceTests(SimpleTestCase):
+    """Presence and typing go through the cache and the room group, not the database."""
+
+    def setUp(self):
+        caches['presence'].clear()
+
+    def test_presence_and_typing(self):
+        alice, bob = User(id=1, username='alice'), User(id=2, username='bob')
+
+        async def session():
+            sockets = []
+            for user in (alice, bob):
+                communicator = WebsocketCommunicator(URLRouter(routing.websocket_urlpatterns), '/ws/chat/1_2/')
+                communicator.scope['user'] = user
+                await communicator.connect()
+                sockets.append(communicator)
+            first, second = sockets
+            self.assertEqual(await first.receive_json_from(), {'type': 'presence', 'user': '2', 'online': True})
+            self.assertEqual(get_presence([1, 2, 3]), {1: True, 2: True, 3: False})
+
+            await second.send_json_to({'type': 'typing'})
+            self.assertEqual(await first.receive_json_from(), {'type': 'typing', 'sender': '2'})
+            await second.send_json_to({'type': 'ping'})
+            self.assertEqual(await second.receive_json_from(), {'type': 'pong'})
+
+            await second.disconnect()
+            self.assertEqual(await first.receive_json_from(), {'type': 'presence', 'user': '2', 'online': False})
+            self.assertTrue(await first.receive_nothing())
+            await first.disconnect()
+
+        async_to_sync(session)()
+        self.assertEqual(get_presence([1, 2]), {1: False, 2: False})
+
+    def test_online_until_last_socket_closes(self):
+        alice, bob = User(id=1, username='alice'), User(id=2, username='bob')
+
+        async def session():
+            watcher = WebsocketCommunicator(URLRouter(routing.websocket_urlpatterns), '/ws/chat/1_2/')
+            watcher.scope['user'] = alice
+            await watcher.connect()
+            tabs = []
+            for path in ('/ws/chat/1_2/', '/ws/chat/1_2/', '/ws/inbox/'):
+                communicator = WebsocketCommunicator(URLRouter(routing.websocket_urlpatterns), path)
+                communicator.scope['user'] = bob
+                await communicator.connect()
+                tabs.append(communicator)
+            first_tab, second_tab, inbox = tabs
+            self.assertEqual((await inbox.receive_json_from())['type'], 'inbox')
+            for _ in range(2):
+                self.assertEqual(await watcher.receive_json_from(), {'type': 'presence', 'user': '2', 'online': True})
+
+            # Neither chat tab was bob's last socket: the inbox one on
+            # every other page still counts
+            await first_tab.disconnect()
+            await second_tab.disconnect()
+            self.assertTrue(await watcher.receive_nothing())
+            self.assertEqual(get_presence([2]), {2: True})
+            await inbox.send_json_to({'type': 'ping'})
+            self.assertEqual(await inbox.receive_json_from(), {'type': 'pong'})
+
+            await inbox.disconnect()
+            self.assertEqual(get_presence([2]), {2: False})
+            await watcher.disconnect()
+
+        with mock.patch.object(InboxConsumer, 'get_unread_summary', mock.AsyncMock(return_value=[])):
+            async_to_sync(session)()
+
+
+class InboxTests(TransactionTestCase):
+    """ws/inbox/ sends an unread summary on connect and live deltas afterwards."""
+
+    def test_summary_then_deltas(self):
+        alice = User.objects.create_user('alice', password='x')
+        bob = User.objects.create_user('bob', password='x')
+        carol = User.objects.create_user('carol', password='x')
+        for sender in (alice, alice, carol):
+            Message.objects.create(sender=sender, receiver=bob, content='hi')
+
+        async def session():
+            inbox = WebsocketCommunicator(URLRouter(routing.websocket_urlpatterns), '/ws/inbox/')
+            inbox.scope['user'] = bob
+            await inbox.connect()
+            summary = await inbox.receive_json_from()
+
+            carol_inbox = WebsocketCommunicator(URLRouter(routing.websocket_urlpatterns), '/ws/inbox/')
+            carol_inbox.scope['user'] = carol
+            await carol_inbox.connect()
+            await carol_inbox.receive_json_from()
+
+            sockets = []
+            for user in (alice, bob):
+                communicator = WebsocketCommunicator(URLRouter(routing.websocket_urlpatterns), f'/ws/chat/{alice.id}_{bob.id}/')
+                communicator.scope['user'] = user
+                await communicator.connect()
+                # Let the presence broadcast land before the next socket joins
+                self.assertTrue(await communicator.receive_nothing())
+                sockets.append(communicator)
+            alice_chat, chat = sockets
+            await alice_chat.receive_json_from()
+
+            await alice_chat.send_json_to({'type': 'chat_message', 'message': 'new', 'sender': alice.id, 'receiver': bob.id})
+            delta = await inbox.receive_json_from()
+            await alice_chat.receive_json_from()
+            await chat.receive_json_from()
+            # Neither the receiver nor the sender can be forged: carol's
+            # inbox hears nothing and bob can't speak for alice
+            await alice_chat.send_json_to({'type': 'chat_message', 'message': 'fake', 'sender': alice.id, 'receiver': carol.id})
+            self.assertEqual((await alice_chat.receive_json_from())['type'], 'error')
+            await chat.send_json_to({'type': 'chat_message', 'message': 'fake', 'sender': alice.id, 'receiver': bob.id})
+            self.assertEqual((await chat.receive_json_from())['type'], 'error')
+            self.assertTrue(await carol_inbox.receive_nothing())
+            self.assertTrue(await inbox.receive_nothing())
+
+            # The reader is the session user, whatever the frame claims
+            await chat.send_json_to({'type': 'read_receipt', 'sender': alice.id, 'receiver': carol.id})
+            self.assertEqual(
+                await chat.receive_json_from(),
+                {'type': 'read_receipt', 'sender': str(alice.id), 'receiver': str(bob.id)},
+            )
+            read = await inbox.receive_json_from()
+            # Carol is not in this room, so she can't be the other party
+            await chat.send_json_to({'type': 'read_receipt', 'sender': carol.id})
+            self.assertEqual((await chat.receive_json_from())['type'], 'error')
+            for communicator in (alice_chat, chat, carol_inbox, inbox):
+                await communicator.disconnect()
+            return summary, delta, read
+
+        summary, delta, read = async_to_sync(session)()
+        self.assertEqual(summary['total'], 3)
+        self.assertEqual(
+            {conversation['sender']: conversation['unread'] for conversation in summary['conversations']},
+            {str(alice.id): 2, str(carol.id): 1},
+        )
+        self.assertEqual((delta['type'], delta['sender'], delta['message']), ('inbox_message', str(alice.id), 'new'))
+        self.assertEqual(read, {'type': 'inbox_read', 'sender': str(alice.id)})
+        self.assertEqual(unread_summary(bob.id), {carol.id: (1, Message.objects.get(sender=carol).id)})
+
+
+class GroupChatTests(TransactionTestCase):
+    """Group messages are stored once, fanned out once and read through cursors."""
+
+    def test_store_once_and_read_cursor(self):
+        alice, bob, carol, dave = (User.objects.create_user(name, password='x') for name in ('alice', 'bob', 'carol', 'dave'))
+        for friend in (bob, carol):
+            FriendRequest.objects.create(from_user=alice, to_user=friend, is_accepted=True)
+        room = create_room(alice, 'Trip', [bob.id, carol.id, dave.id])
+        self.assertEqual(set(room.members.values_list('username', flat=True)), {'alice', 'bob', 'carol'})
+
+        def socket(user):
+            communicator = WebsocketCommunicator(URLRouter(routing.websocket_urlpatterns), f'/ws/rooms/{room.id}/')
+            communicator.scope['user'] = user
+            return communicator
+
+        async def session():
+            intruder = socket(dave)
+            connected, _ = await intruder.connect()
+            self.assertFalse(connected)
+
+            sockets = [socket(user) for user in (alice, bob, carol)]
+            for communicator in sockets:
+                await communicator.connect()
+            await sockets[0].send_json_to({'type': 'chat_message', 'message': 'hello all'})
+            received = [await communicator.receive_json_from() for communicator in sockets]
+            # A cursor past the newest message is clamped to it
+            await sockets[1].send_json_to({'type': 'read', 'cursor': received[1]['id'] + 1000})
+            cursor = await sockets[0].receive_json_from()
+            for communicator in sockets:
+                await communicator.disconnect()
+            return received, cursor
+
+        received, cursor = async_to_sync(session)()
+        message = RoomMessage.objects.get()
+        self.assertEqual({frame['id'] for frame in received}, {message.id})
+        self.assertEqual(received[2]['sender_name'], 'alice')
+        self.assertEqual(cursor, {'type': 'read_cursor', 'user': str(bob.id), 'cursor': message.id})
+        self.assertEqual(Membership.objects.get(room=room, user=bob).last_read_message_id, message.id)
+        unread = {membership.user_id: membership.unread for membership in get_rooms_with_unread(bob)}
+        self.assertEqual(unread, {bob.id: 0})
+        self.assertEqual([membership.unread for membership in get_rooms_with_unread(carol)], [1])
+
+
+class ReadCursorTests(TestCase):
+    """Marking a conversation read moves one cursor row; is_read is derived from it."""
+
+    def test_cursor_moves_forward_only(self):
+        alice = User.objects.create_user('alice', password='x')
+        bob = User.objects.create_user('bob', password='x')
+        first, second, third = (Message.objects.create(sender=alice, receiver=bob, content=f'm{i}') for i in range(3))
+        reply = Message.objects.create(sender=bob, receiver=alice, content='reply')
+
+        self.assertTrue(mark_read(bob.id, alice.id, second.id))
+        self.assertFalse(mark_read(bob.id, alice.id, first.id))
+        self.assertEqual(unread_summary(bob.id), {alice.id: (1, third.id)})
+        self.assertEqual(unread_summary(alice.id), {bob.id: (1, reply.id)})
+
+        with self.assertNumQueries(1):
+            states = {message.id: message.is_read for message in Message.objects.with_read_state()}
+        self.assertEqual(states, {first.id: True, second.id: True, third.id: False, reply.id: False})
+        self.assertFalse(Message.objects.get(id=third.id).is_read)
+
+        with self.assertNumQueries(2):
+            self.assertTrue(mark_read(bob.id, alice.id))
+        self.assertEqual(unread_summary(bob.id), {})
+        self.assertEqual(ReadCursor.objects.get(reader=bob, peer=alice).last_read_message_id, third.id)
+
+
+class MessageSearchTests(TestCase):
+    """Search is scoped to the user's conversations, highlighted, paginated and time-boxed."""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.alice = User.objects.create_user('alice', password='x')
+        cls.bob = User.objects.create_user('bob', password='x')
+        cls.carol = User.objects.create_user('carol', password='x')
+        Message.objects.create(sender=cls.alice, receiver=cls.bob, content='Lunch at <b>noon</b> tomorrow?')
+        Message.objects.create(sender=cls.bob, receiver=cls.alice, content='Lunch sounds great')
+        Message.objects.create(sender=cls.carol, receiver=cls.bob, content='Lunch with me instead')
+        Message.objects.create(sender=cls.alice, receiver=cls.carol, content='Dinner plans')
+
+    def test_scoped_highlighted_and_paginated(self):
+        page = search_messages(self.alice, 'lunch', page_size=1)
+        self.assertEqual(len(page['results']), 1)
+        self.assertEqual(page['results'][0]['message'].content, 'Lunch sounds great')
+        self.assertIn('<mark>Lunch</mark>', page['results'][0]['snippet'])
+
+        page = search_messages(self.alice, 'lunch', before_id=page['next_before'], page_size=1)
+        self.assertEqual([result['message'].content for result in page['results']], ['Lunch at <b>noon</b> tomorrow?'])
+        self.assertIn('&lt;b&gt;', page['results'][0]['snippet'])
+        self.assertIsNone(page['next_before'])
+
+        # Prefix match on the last word, and Carol's message to Bob stays out of Alice's results
+        self.assertEqual(len(search_messages(self.alice, 'lunch tomor')['results']), 1)
+        self.assertEqual(len(search_messages(self.bob, 'lunch')['results']), 3)
+        self.assertEqual(len(search_messages(self.bob, 'lunch', with_user_id=self.carol.id)['results']), 1)
+        self.assertEqual(search_messages(self.alice, '"*)(')['results'], [])
+
+    def test_time_budget(self):
+        Message.objects.bulk_create([
+            Message(sender=self.alice, receiver=self.bob, content=f'lunch note {i}') for i in range(300)
+        ])
+        with self.settings(MESSAGE_SEARCH_TIMEOUT_MS=-1000):
+            page = search_messages(self.alice, 'lunch')
+        self.assertTrue(page['timed_out'])
+        self.assertEqual(page['results'], [])
+
+
+class MessageArchiveTests(TestCase):
+    """Old messages move to archive segments and history pages read through to them."""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.alice = User.objects.create_user('alice', password='x')
+        cls.bob = User.objects.create_user('bob', password='x')
+        Profile.objects.create(user=cls.alice, full_name='Alice')
+        FriendRequest.objects.create(from_user=cls.alice, to_user=cls.bob, is_accepted=True)
+        messages = Message.objects.bulk_create([
+            Message(sender=cls.alice if i % 2 else cls.bob, receiver=cls.bob if i % 2 else cls.alice, content=f'note {i}')
+            for i in range(10)
+        ])
+        Message.objects.filter(id__in=[message.id for message in messages[:6]]).update(
+            timestamp=timezone.now() - timedelta(days=400)
+        )
+        cls.ids = [message.id for message in messages]
+
+    def setUp(self):
+        archive_root = tempfile.TemporaryDirectory()
+        self.addCleanup(archive_root.cleanup)
+        self.enterContext(override_settings(MESSAGE_ARCHIVE_ROOT=archive_root.name))
+
+    def test_history_reads_through_archive(self):
+        self.assertEqual(archive_messages(older_than_days=180, batch_size=4), 6)
+        self.assertEqual(sorted(Message.objects.values_list('id', flat=True)), self.ids[6:])
+
+        seen, before_id, has_more = [], None, True
+        while has_more:
+            page, has_more = get_history(self.alice, self.bob, before_id, limit=3)
+            seen = [message.id for message in page] + seen
+            before_id = page[0].id
+        self.assertEqual(seen, self.ids)
+        self.assertEqual(page[0].content, 'note 0')
+        self.assertEqual(page[0].sender, self.bob)
+
+        # Batches of 4 wrote segments for ids 0-3 and 4-5; the page just
+        # below the hot window only needs the newer one
+        with mock.patch('chat.archive._read_segment', wraps=archive._read_segment) as read_segment:
+            page, has_more = get_history(self.alice, self.bob, self.ids[6], limit=1)
+        self.assertEqual([message.id for message in page], self.ids[5:6])
+        self.assertTrue(has_more)
+        self.assertEqual([call.args[0].name for call in read_segment.call_args_list], [f'{self.ids[4]}-{self.ids[5]}.jsonl.gz'])
+
+    def test_history_endpoint(self):
+        archive_messages(older_than_days=180)
+        # A rerun after a crash between writing and deleting archives rows twice
+        Message.objects.bulk_create([
+            Message(id=message_id, sender=self.alice, receiver=self.bob, content='again') for message_id in self.ids[:6]
+        ])
+        Message.objects.filter(id__in=self.ids[:6]).update(timestamp=timezone.now() - timedelta(days=400))
+        self.assertEqual(archive_messages(older_than_days=180), 6)
+
+        self.client.force_login(self.alice)
+        url = reverse('chat_history', args=[self.bob.id])
+        data = self.client.get(url, {'before': self.ids[6]}, secure=True).json()
+        self.assertEqual([message['id'] for message in data['messages']], self.ids[:6])
+        self.assertFalse(data['has_more'])
+        self.assertEqual(data['messages'][0]['sender'], str(self.bob.id))
+
+
+@skipUnless(settings.REDIS_URL, 'REDIS_URL is not set; targets only share rooms through a Redis channel layer')
+class MultiTargetLoadTests(TransactionTestCase):
+    """With several targets each chat room spans two servers and reports cross deliveries."""
+
+    def setUp(self):
+        # Deliveries between targets go through Redis, as they would between
+        # two Daphne processes, never through an in-process layer
+        self.enterContext(override_settings(CHANNEL_LAYERS={
+            'default': {
+                'BACKEND': 'channels_redis.core.RedisChannelLayer',
+                'CONFIG': {'hosts': [settings.REDIS_URL], 'prefix': 'test_asgi', **settings.CHANNEL_LAYER_LIMITS},
+            },
+        }))
+        self.addCleanup(lambda: async_to_sync(get_channel_layer().flush)())
+
+    def test_rooms_span_targets(self):
+        sessions = prepare_sessions(2, posts_per_user=0)
+        runner = LoadRunner([InProcessTransport(), InProcessTransport()], sessions, [], {}, 0, 1, 0.1, 1)
+        elapsed = async_to_sync(runner.run)()
+
+        sent = len(runner.stats['ws:send'].latencies)
+        self.assertGreater(sent, 0)
+        self.assertEqual(len(runner.stats['ws:cross'].latencies), sent)
+        self.assertEqual(len(runner.stats['ws:deliver'].latencies), sent)
+        self.assertIn('ws:cross', runner.report(elapsed))
+
+
+class StagedUploadTests(TestCase):
+    """Staged images are claimed once, cleaned up on success and kept on failure."""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user('uploader', password='x')
+        cls.post = Post.objects.create(user=cls.user, content='With a picture')
+
+    def setUp(self):
+        for name in ('staging', 'media'):
+            directory = tempfile.TemporaryDirectory()
+            self.addCleanup(directory.cleanup)
+            setattr(self, name, directory.name)
+        self.enterContext(override_settings(UPLOAD_STAGING_ROOT=self.staging, MEDIA_ROOT=self.media))
+
+    def stage(self, content):
+        with self.captureOnCommitCallbacks():
+            uploads.schedule_image(self.post, 'image', SimpleUploadedFile('photo.png', content))
+        sidecar = next(name for name in os.listdir(self.staging) if name.endswith(uploads.QUEUED))
+        with open(os.path.join(self.staging, sidecar)) as meta:
+            return json.load(meta)
+
+    def png(self):
+        output = BytesIO()
+        Image.new('RGB', (40, 30), 'red').save(output, format='PNG')
+        return output.getvalue()
+
+    def test_processed_once_and_cleaned_up(self):
+        job = self.stage(self.png())
+        self.assertTrue(uploads.process_staged_image(job))
+        self.assertFalse(uploads.process_staged_image(job))
+        self.post.refresh_from_db()
+        self.assertTrue(self.post.image.name.endswith('.jpg'))
+        self.assertEqual(os.listdir(self.staging), [])
+
+    def test_failure_keeps_the_job_for_retry(self):
+        job = self.stage(b'not an image')
+        self.assertFalse(uploads.process_staged_image(job))
+        self.assertEqual(
+            sorted(os.listdir(self.staging)),
+            sorted([os.path.basename(job['path']), os.path.basename(job['path']) + uploads.FAILED])
+        )
+
+        with mock.patch.object(uploads, 'get_executor') as get_executor:
+            self.assertEqual(uploads.requeue_staged_uploads(), 0)
+            self.assertEqual(uploads.requeue_staged_uploads(retry_failed=True), 1)
+        get_executor.return_value.submit.assert_called_once_with(uploads.process_staged_image, job)
+        self.assertTrue(os.path.exists(job['path'] + uploads.QUEUED))
+
+    def test_requeue_skips_claimed_and_restores_stale_claims(self):
+        job = self.stage(self.png())
+        with mock.patch.object(uploads, 'get_executor') as get_executor:
+            # Still queued in this process: the second copy to run is a no-op
+            self.assertEqual(uploads.requeue_staged_uploads(), 1)
+            self.assertTrue(uploads.process_staged_image(job))
+            self.assertFalse(uploads.process_staged_image(job))
+
+            job = self.stage(self.png())
+            os.rename(job['path'] + uploads.QUEUED, job['path'] + uploads.CLAIMED)
+            self.assertEqual(uploads.requeue_staged_uploads(), 0)
+            stale = time.time() - uploads.STALE_CLAIM_SECONDS - 1
+            os.utime(job['path'] + uploads.CLAIMED, (stale, stale))
+            self.assertEqual(uploads.requeue_staged_uploads(), 1)
+        self.assertEqual(get_executor.return_value.submit.call_count, 2)
+        self.assertTrue(uploads.process_staged_image(job))
+
+
+@override_settings(MAX_IMAGE_UPLOAD_SIZE=1024)
+class ImageUploadHandlerTests(TestCase):
+    """Image views reject non-images and oversize files while the body streams in."""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user('poster', password='x')
+        Profile.objects.create(user=cls.user, full_name='Poster')
+
+    def setUp(self):
+        staging = tempfile.TemporaryDirectory()
+        self.addCleanup(staging.cleanup)
+        self.enterContext(override_settings(UPLOAD_STAGING_ROOT=staging.name))
+        self.client.force_login(self.user)
+
+    def post_image(self, content, name='photo.png'):
+        return self.client.post(
+            reverse('index'),
+            {'content': 'Look', 'image': SimpleUploadedFile(name, content, content_type='image/png')},
+            secure=True,
+            HTTP_X_REQUESTED_WITH='XMLHttpRequest',
+        )
+
+    def test_bad_magic_number(self):
+        response = self.post_image(b'<?php echo 1; ?>' + b'x' * 100)
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.json()['error'], IMAGE_TYPE_ERROR)
+        self.assertFalse(Post.objects.exists())
+
+    def test_oversize_file(self):
+        response = self.post_image(b'\x89PNG\r\n\x1a\n' + b'x' * 2048)
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.json()['error'], image_size_error())
+
+    def test_valid_file(self):
+        with self.captureOnCommitCallbacks():
+            response = self.post_image(b'GIF89a' + b'x' * 100, name='photo.gif')
+        self.assertEqual(response.json()['status'], 'success')
+        self.assertEqual(Post.objects.get().user, self.user)
+
+    def test_csrf_still_checked(self):
+        self.client.handler.enforce_csrf_checks = True
+        self.assertEqual(self.post_image(b'GIF89a' + b'x' * 100).status_code, 403)
+
+    def test_complete_profile_reports_rejected_file(self):
+        response = self.client.post(
+            reverse('complete_profile', args=[self.user.id]),
+            {'full_name': 'Poster', 'profile_pic': SimpleUploadedFile('notes.txt', b'plain text')},
+            secure=True,
+        )
+        self.assertContains(response, IMAGE_TYPE_ERROR)
+
+
+class PlatformStatsTests(TestCase):
+    """Dashboard headline counts come from three aggregate queries, then the cache."""
+
+    @classmethod
+    def setUpTestData(cls):
+        users = [User.objects.create_user(f'member{i}', password='x') for i in range(4)]
+        User.objects.filter(id=users[0].id).update(is_active=False)
+        posts = Post.objects.bulk_create([Post(user=users[1], content=f'Post {i}') for i in range(3)])
+        Comment.objects.create(user=users[2], post=posts[0], content='Nice')
+
+    def setUp(self):
+        caches['default'].clear()
+
+    def test_counts_and_query_count(self):
+        expected = {
+            'total_users': 4,
+            'active_users': 3,
+            'blocked_users': 1,
+            'total_posts': 3,
+            'total_comments': 1,
+        }
+        with self.assertNumQueries(3):
+            self.assertEqual(get_platform_stats(), expected)
+        with self.assertNumQueries(0):
+            self.assertEqual(get_platform_stats(), expected)
+
+
+class ActivityRollupTests(TestCase):
+    """The rollup catches rows committed late below the watermark and can be rerun safely."""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user('author', password='x')
+
+    def rollup(self):
+        rollup_source('posts', Post, 'timestamp')
+        return DailyActivity.objects.get(date=timezone.localdate()).posts
+
+    def test_late_rows_and_reruns(self):
+        posts = Post.objects.bulk_create([Post(user=self.user, content=f'Post {i}') for i in range(5)])
+        Post.objects.filter(id=posts[2].id).delete()
+        self.assertEqual(self.rollup(), 4)
+
+        # A row whose id was handed out before the watermark but committed after it
+        Post.objects.create(id=posts[2].id, user=self.user, content='Late')
+        self.assertEqual(self.rollup(), 5)
+        self.assertEqual(self.rollup(), 5)
+
+    def test_deletes_and_archiving_keep_counted_days(self):
+        Post.objects.bulk_create([Post(user=self.user, content=f'Post {i}') for i in range(3)])
+        alice = User.objects.create_user('alice', password='x')
+        Message.objects.bulk_create([Message(sender=alice, receiver=self.user, content=f'note {i}') for i in range(4)])
+        Message.objects.update(timestamp=timezone.now() - timedelta(days=400))
+        rollup_source('messages', Message, 'timestamp')
+        old_day = timezone.localdate(timezone.now() - timedelta(days=400))
+        self.assertEqual(self.rollup(), 3)
+        self.assertEqual(DailyActivity.objects.get(date=old_day).messages, 4)
+
+        # Both stay inside the safety window, which is re-scanned every run
+        list(bulk_delete_posts(list(Post.objects.values_list('id', flat=True)[:2])))
+        with tempfile.TemporaryDirectory() as archive_root, override_settings(MESSAGE_ARCHIVE_ROOT=archive_root):
+            self.assertEqual(archive_messages(older_than_days=180), 4)
+        Post.objects.create(user=self.user, content='One more')
+        self.assertEqual(self.rollup(), 4)
+        self.assertEqual(rollup_source('messages', Message, 'timestamp'), 0)
+        self.assertEqual(DailyActivity.objects.get(date=old_day).messages, 4)
+
+    def test_dashboard_only_reads_the_rollup(self):
+        Post.objects.create(user=self.user, content='Not rolled up yet')
+        caches['default'].clear()
+        activity = get_activity()
+        self.assertEqual(activity[-1]['posts'], 0)
+        self.assertFalse(DailyActivity.objects.exists())
+
+
+class BulkModerationTests(TestCase):
+    """Bulk deletes run one transaction per chunk and report how far they got."""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.admin = User.objects.create_user('moderator', password='x', is_staff=True)
+        Profile.objects.create(user=cls.admin, full_name='Moderator')
+        cls.posts = Post.objects.bulk_create([Post(user=cls.admin, content=f'Spam {i}') for i in range(5)])
+        Comment.objects.bulk_create([Comment(user=cls.admin, post=post, content='More spam') for post in cls.posts])
+        cls.post_ids = [post.id for post in cls.posts]
+
+    def fail_on_chunk(self, number):
+        """Make the post DELETE of the ``number``th chunk raise."""
+        real_filter = Post.objects.filter
+        calls = []
+
+        def filter(*args, **kwargs):
+            calls.append(kwargs)
+            if len(calls) == number:
+                raise DatabaseError('disk full')
+            return real_filter(*args, **kwargs)
+        return mock.patch.object(Post.objects, 'filter', side_effect=filter)
+
+    def test_progress_per_chunk(self):
+        with CaptureQueriesContext(connection) as queries:
+            progress = list(bulk_delete_posts(self.post_ids, chunk_size=2))
+        self.assertEqual([update['processed'] for update in progress], [2, 4, 5])
+        self.assertEqual(progress[-1], {'processed': 5, 'deleted': 5, 'total': 5})
+        self.assertFalse(Post.objects.exists())
+
+        # One transaction (a savepoint inside the test's) per chunk of at most two posts
+        statements = [query['sql'] for query in queries.captured_queries]
+        self.assertEqual(len([sql for sql in statements if sql.startswith('SAVEPOINT')]), 3)
+        post_deletes = [sql for sql in statements if sql.startswith('DELETE FROM "chat_post"')]
+        self.assertEqual([sql.count(',') + 1 for sql in post_deletes], [2, 2, 1])
+
+    def test_failed_chunk_rolls_back_alone(self):
+        progress = bulk_delete_posts(self.post_ids, chunk_size=2)
+        with self.fail_on_chunk(2), self.assertRaises(DatabaseError):
+            list(progress)
+        # The first chunk committed; the second's comment deletes were rolled back
+        self.assertEqual(sorted(Post.objects.values_list('id', flat=True)), self.post_ids[2:])
+        self.assertEqual(Comment.objects.count(), 3)
+
+    @override_settings(MODERATION_CHUNK_SIZE=2)
+    def test_stream_reports_partial_failure(self):
+        self.client.force_login(self.admin)
+        with self.fail_on_chunk(2):
+            response = self.client.post(
+                reverse('bulk_delete_posts_admin'),
+                json.dumps({'ids': self.post_ids}),
+                content_type='application/json',
+                secure=True,
+            )
+            lines = [json.loads(line) for line in b''.join(response).decode().splitlines()]
+        self.assertEqual(lines[0], {'processed': 2, 'deleted': 2, 'total': 5})
+        self.assertEqual(lines[-1]['status'], 'error')
+        self.assertEqual(lines[-1]['processed'], 2)
+        self.assertEqual(Post.objects.count(), 3)
+
+
+class QueryMetricsTests(TestCase):
+    """Requests are measured per view, and /metrics needs staff or the bearer token."""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user('member', password='x')
+        cls.staff = User.objects.create_user('operator', password='x', is_staff=True)
+        Profile.objects.create(user=cls.user, full_name='Member')
+        Profile.objects.create(user=cls.staff, full_name='Operator')
+
+    def observed(self, view):
+        return sum(request_queries.samples.get((('view', view),), [0, 0])[:-1])
+
+    def test_middleware_records_queries_per_view(self):
+        self.client.force_login(self.user)
+        before = self.observed('about')
+        requests_before = requests_total.samples.get((('status', 200), ('view', 'about')), 0)
+        exceeded_before = query_budget_exceeded.samples.get((('view', 'about'),), 0)
+
+        with self.settings(QUERY_BUDGET=0), self.assertLogs('core.middleware', 'WARNING') as logs:
+            self.assertEqual(self.client.get(reverse('about'), secure=True).status_code, 200)
+
+        self.assertEqual(self.observed('about'), before + 1)
+        self.assertEqual(requests_total.samples[(('status', 200), ('view', 'about'))], requests_before + 1)
+        self.assertEqual(query_budget_exceeded.samples[(('view', 'about'),)], exceeded_before + 1)
+        self.assertIn('over the budget of 0', logs.output[0])
+
+    @override_settings(METRICS_TOKEN='s3cret')
+    def test_metrics_access(self):
+        url = reverse('metrics')
+        self.assertEqual(self.client.get(url).status_code, 403)
+        self.assertEqual(self.client.get(url, REMOTE_ADDR='127.0.0.1').status_code, 403)
+        self.assertEqual(self.client.get(url, HTTP_AUTHORIZATION='Bearer wrong').status_code, 403)
+        response = self.client.get(url, HTTP_AUTHORIZATION='Bearer s3cret')
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('http_request_db_queries', response.content.decode())
+
+        self.client.force_login(self.user)
+        self.assertEqual(self.client.get(url).status_code, 403)
+        self.client.force_login(self.staff)
+        self.assertEqual(self.client.get(url).status_code, 200)
+
+    @override_settings(METRICS_TOKEN='')
+    def test_no_token_configured(self):
+        self.assertEqual(self.client.get(reverse('metrics'), HTTP_AUTHORIZATION='Bearer ').status_code, 403)
@@ -0,0 +1,203 @@
+"""
+Off-request processing of image uploads.
+
+Each staged upload is an image file plus a JSON sidecar describing the job.
+The sidecar's suffix records the job's state::
+
+    <id>.json      queued, waiting for a worker
+    <id>.claimed   taken by a worker; the rename is the claim, so a job
+                   submitted twice is only processed once
+    <id>.failed    processing raised; the staged image is kept for a retry
+
+Both files are removed once the image has been stored.
+"""
+import json
+import logging
+import os
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
+
+from django.apps import apps
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.db import close_old_connections, transaction
+from PIL import Image, ImageOps
+
+from .fragments import bump_post_version, invalidate_user_cards
+
+logger = logging.getLogger(__name__)
+
+_executor = None
+
+QUEUED = '.json'
+CLAIMED = '.claimed'
+FAILED = '.failed'
+# A claim this old belongs to a worker that died mid-job
+STALE_CLAIM_SECONDS = 3600
+
+
+def get_executor():
+    global _executor
+    if _executor is None:
+        _executor = ThreadPoolExecutor(
+            max_workers=settings.UPLOAD_WORKERS,
+            thread_name_prefix='upload-worker'
+        )
+    return _executor
+
+
+def stage_upload(uploaded_file):
+    """
+    Copy an uploaded file to the local staging directory.
+
+    Args:
+        uploaded_file (UploadedFile): File taken from request.FILES
+
+    Returns:
+        str: Path of the staged copy on local disk
+    """
+    os.makedirs(settings.UPLOAD_STAGING_ROOT, exist_ok=True)
+    path = os.path.join(settings.UPLOAD_STAGING_ROOT, uuid.uuid4().hex)
+    with open(path, 'wb') as staged:
+        for chunk in uploaded_file.chunks():
+            staged.write(chunk)
+    return path
+
+
+def schedule_image(instance, field_name, uploaded_file):
+    """
+    Stage an image upload and process it off the request.
+
+    The instance is saved without the image; a worker thread resizes the
+    staged copy, strips EXIF data, pushes it to the field's storage and
+    then points ``field_name`` at the stored file.
+    """
+    path = stage_upload(uploaded_file)
+    job = {
+        'model': instance._meta.label,
+        'pk': instance.pk,
+        'field': field_name,
+        'name': os.path.basename(uploaded_file.name),
+        'path': path,
+    }
+    with open(path + QUEUED, 'w') as meta:
+        json.dump(job, meta)
+    transaction.on_commit(lambda: get_executor().submit(process_staged_image, job))
+
+
+def _encode(image):
+    image = ImageOps.exif_transpose(image)
+    max_dimension = settings.UPLOAD_MAX_DIMENSION
+    image.thumbnail((max_dimension, max_dimension))
+
+    output = BytesIO()
+    has_alpha = image.mode in ('RGBA', 'LA') or (image.mode == 'P' and 'transparency' in image.info)
+    if has_alpha:
+        image.convert('RGBA').save(output, format='PNG', optimize=True)
+        extension = 'png'
+    else:
+        image.convert('RGB').save(output, format='JPEG', quality=85, optimize=True)
+        extension = 'jpg'
+    return output.getvalue(), extension
+
+
+def _claim(path):
+    """Move a queued job to claimed; False if another worker got there first."""
+    try:
+        os.rename(path + QUEUED, path + CLAIMED)
+    except FileNotFoundError:
+        return False
+    # The rename keeps the sidecar's mtime; restart the clock for staleness
+    os.utime(path + CLAIMED)
+    return True
+
+
+def _remove_job(path):
+    for leftover in (path, path + CLAIMED):
+        try:
+            os.remove(leftover)
+        except OSError:
+            pass
+
+
+def process_staged_image(job):
+    """
+    Resize, re-encode and store one staged image, then swap the reference.
+
+    Returns:
+        bool: True if the image was stored (or its instance is gone), False
+        if it failed or was already claimed by another worker
+    """
+    path = job['path']
+    if not _claim(path):
+        logger.debug(f"Staged upload {path} already claimed")
+        return False
+    try:
+        model = apps.get_model(job['model'])
+        instance = model.objects.filter(pk=job['pk']).first()
+        if instance is None:
+            logger.info(f"Dropping staged upload for deleted {job['model']} {job['pk']}")
+            _remove_job(path)
+            return True
+
+        with Image.open(job['path']) as image:
+            data, extension = _encode(image)
+
+        field = getattr(instance, job['field'])
+        stem = os.path.splitext(job['name'])[0] or 'image'
+        field.save(f"{stem}.{extension}", ContentFile(data), save=False)
+        model.objects.filter(pk=job['pk']).update(**{job['field']: field.name})
+        if job['model'] == 'chat.Post':
+            bump_post_version(instance.pk)
+        elif job['model'] == 'chat.Profile':
+            invalidate_user_cards(instance.user_id)
+        logger.info(f"Stored {job['model']} {job['pk']} {job['field']} as {field.name}")
+        _remove_job(path)
+        return True
+    except Exception as e:
+        logger.error(f"Failed to process staged upload {path}: {str(e)}")
+        os.rename(path + CLAIMED, path + FAILED)
+        return False
+    finally:
+        close_old_connections()
+
+
+def requeue_staged_uploads(retry_failed=False):
+    """
+    Resubmit staged uploads left behind by a restarted process.
+
+    Queued jobs are submitted as they are; a job still waiting in this
+    process's executor is skipped by whichever copy claims it second.
+    Claims older than STALE_CLAIM_SECONDS are returned to the queue.
+
+    Args:
+        retry_failed: Also requeue jobs whose processing failed
+
+    Returns:
+        int: Number of jobs submitted
+    """
+    root = settings.UPLOAD_STAGING_ROOT
+    if not os.path.isdir(root):
+        return 0
+    stale_before = time.time() - STALE_CLAIM_SECONDS
+    count = 0
+    for entry in os.listdir(root):
+        stem, suffix = os.path.splitext(entry)
+        path = os.path.join(root, stem)
+        try:
+            if suffix == CLAIMED and os.path.getmtime(path + CLAIMED) < stale_before:
+                os.rename(path + CLAIMED, path + QUEUED)
+            elif suffix == FAILED and retry_failed:
+                os.rename(path + FAILED, path + QUEUED)
+            elif suffix != QUEUED:
+                continue
+            with open(path + QUEUED) as meta:
+                job = json.load(meta)
+        except FileNotFoundError:
+            # Claimed by a worker while we looked
+            continue
+        get_executor().submit(process_staged_image, job)
+        count += 1
+    return count
@@ -12,6 +12,9 @@ urlpatterns = [
     path('friends/', views.friends_list_view, name='friends'),
     path('find-friends/', views.find_friends_view, name='find_friends'),
     path('chat/<int:friend_id>/', views.chat_with_friend, name='chat_with_friend'),
+    path('chat/<int:friend_id>/history/', views.chat_history_view, name='chat_history'),
+    path('rooms/', views.chat_rooms_view, name='chat_rooms'),
+    path('rooms/<int:room_id>/', views.group_chat_view, name='group_chat'),
     path('send-request/<int:user_id>/', views.send_friend_request, name='send_request'),
     path('cancel-request/<int:user_id>/', views.cancel_friend_request, name='cancel_request'),
     path('accept-request/<int:request_id>/', views.accept_friend_request, name='accept_request'),
@@ -32,10 +35,14 @@ urlpatterns = [
     path('comment/<int:comment_id>/delete/', views.delete_comment, name='delete_comment'),
     path('dashboard/', views.admin_dashboard, name='admin_dashboard'),
     path('messages/', views.messages_view, name='messages'),
+    path('messages/search/', views.search_messages_view, name='search_messages'),
     path('account/', views.account_view, name='account'),
     path('admin-dashboard/', views.admin_dashboard, name='admin_dashboard_alt'),
     path('dashboard/toggle-user/<int:user_id>/', views.toggle_block_user, name='toggle_block_user'),
     path('dashboard/delete-post/<int:post_id>/', views.delete_post_admin, name='delete_post_admin'),
+    path('dashboard/bulk/delete-posts/', views.bulk_delete_posts_admin, name='bulk_delete_posts_admin'),
+    path('dashboard/bulk/block-users/', views.bulk_block_users, {'action': 'block'}, name='bulk_block_users'),
+    path('dashboard/bulk/unblock-users/', views.bulk_block_users, {'action': 'unblock'}, name='bulk_unblock_users'),
     path('notifications/delete/<int:notif_id>/', views.delete_notification, name='delete_notification'),
     path('notifications/clear-all/', views.clear_all_notifications, name='clear_all_notifications'),
     path('verify-otp/', views.verify_otp_view, name='verify_otp'),
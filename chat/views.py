@@ -5,10 +5,10 @@ from .forms import RegisterForm, ProfileForm, ProfileCompletionForm, PostForm, C
 from .models import Profile, Post, Like, Comment, Notification, EmailVerification
 from django.contrib.auth.decorators import login_required
 from django.contrib.auth.models import User
-from .models import FriendRequest, Message
-from django.http import HttpResponse, JsonResponse
+from .models import FriendRequest, Message, Membership, RoomMessage
+from django.http import HttpResponse, JsonResponse, StreamingHttpResponse
 from django.urls import reverse
-from django.db.models import Q
+from django.db.models import Q, Exists, OuterRef, Subquery
 from django.views.generic import TemplateView
 from django.core.mail import send_mail
 from django.views.decorators.csrf import csrf_exempt
@@ -17,10 +17,28 @@ from django.views.decorators.http import require_POST
 from django.utils import timezone
 from datetime import timedelta
 from django.template.loader import render_to_string
+from core.db import replica_reads
 from core.utils import generate_otp, send_otp_email
+from .uploads import schedule_image
+from .upload_handlers import add_upload_errors, get_upload_errors, image_uploads
+from .dashboard import get_platform_stats, get_activity, invalidate_dashboard_stats
+from .fragments import get_post_cards, layer_viewer_state, bump_post_version, invalidate_user_cards
+from .moderation import bulk_delete_posts, bulk_set_user_active, moderation_chunks
+from .archive import get_history
+from .presence import get_presence
+from .read_state import mark_read, unread_summary
+from .rooms import create_room, friend_ids, get_rooms_with_unread, mark_room_read
+from .search import search_messages
 import json
+import logging
+from asgiref.sync import sync_to_async
 from django.utils.dateparse import parse_datetime
 from django.db import transaction
+from django.core.paginator import Paginator
+from django.conf import settings
+from django.core.exceptions import ValidationError
+
+logger = logging.getLogger(__name__)
 
 def unread_notifications_count(request):
     if request.user.is_authenticated:
@@ -29,27 +47,39 @@ def unread_notifications_count(request):
         }
     return {'unread_notifications': 0}
 
+@image_uploads
 @login_required
+@replica_reads
 def index_view(request):
     if request.method == 'POST':
         content = request.POST.get('content')
         image = request.FILES.get('image')
-        
+        upload_error = get_upload_errors(request).get('image')
+
+        if upload_error:
+            if request.headers.get('X-Requested-With') == 'XMLHttpRequest':
+                return JsonResponse({
+                    'status': 'error',
+                    'error': upload_error
+                }, status=400)
+
+            messages.error(request, upload_error)
+            return redirect('index')
+
         if content or image:
             post = Post.objects.create(
                 user=request.user,
-                content=content,
-                image=image
+                content=content
             )
+            if image:
+                schedule_image(post, 'image', image)
             
             # If it's an AJAX request, return the rendered post
             if request.headers.get('X-Requested-With') == 'XMLHttpRequest':
-                post.likes_count = post.likes.count()
-                post.comments_count = post.comments.count()
-                post.is_liked = False
+                card = layer_viewer_state(get_post_cards([post.id])[post.id], is_liked=False)
                 return JsonResponse({
                     'status': 'success',
-                    'html': render_to_string('chat/partials/post_card.html', {'post': post}, request=request)
+                    'html': render_to_string('chat/partials/post_card.html', {'post': card}, request=request)
                 })
             
             return redirect('index')
@@ -63,21 +93,17 @@ def index_view(request):
             messages.error(request, 'Content or image is required')
             return redirect('index')
 
-    # Get all posts ordered by timestamp (newest first)
-    posts = Post.objects.select_related('user__profile').prefetch_related('comments', 'likes').order_by('-timestamp')
-    
-    # Annotate posts with additional information
-    for post in posts:
-        post.likes_count = post.likes.count()
-        post.comments_count = post.comments.count()
-        post.is_liked = post.likes.filter(user=request.user).exists()
-
-    # Get unread notifications count
-    unread_notifications = request.user.notifications.filter(is_read=False).count()
+    # Get all posts ordered by timestamp (newest first) with the viewer's like
+    # state; the rest of each card comes from the fragment cache
+    feed = list(Post.objects.annotate(
+        is_liked=Exists(Like.objects.filter(post=OuterRef('pk'), user=request.user)),
+    ).order_by('-timestamp').values_list('id', 'is_liked'))
+    cards = get_post_cards([post_id for post_id, _ in feed])
+    posts = [layer_viewer_state(cards[post_id], is_liked) for post_id, is_liked in feed if post_id in cards]
 
+    # unread_notifications comes from the notifications context processor
     context = {
         'posts': posts,
-        'unread_notifications': unread_notifications,
     }
     
     return render(request, 'chat/index.html', context)
@@ -96,6 +122,7 @@ def handle_comment(request):
         post=post,
         content=request.POST.get('comment_content')
     )
+    bump_post_version(post.id)
     if post.user != request.user:
         Notification.objects.create(
             user=post.user,
@@ -108,10 +135,15 @@ def handle_comment(request):
 
 def handle_post_creation(request):
     form = PostForm(request.POST, request.FILES)
+    add_upload_errors(request, form)
     if form.is_valid():
         post = form.save(commit=False)
         post.user = request.user
         post.save()
+    else:
+        for errors in form.errors.values():
+            for error in errors:
+                messages.error(request, error)
     return redirect('index')
 
 def handle_search(query, current_user):
@@ -220,7 +252,9 @@ def login_view(request):
             messages.error(request, "Invalid Credentials.")
     return render(request, 'chat/login.html')
 
+@image_uploads
 @login_required
+@replica_reads
 def profile_view(request):
     try:
         profile = request.user.profile
@@ -228,10 +262,21 @@ def profile_view(request):
         return redirect('complete_profile', user_id=request.user.id)
         
     if request.method == 'POST':
+        previous_pic = profile.profile_pic.name
         form = ProfileForm(request.POST, request.FILES, instance=profile)
-        if form.is_valid():
+        upload_errors = get_upload_errors(request)
+        if form.is_valid() and not upload_errors:
+            new_pic = request.FILES.get('profile_pic')
+            if new_pic:
+                # Keep the current picture until the worker has stored the new one
+                profile.profile_pic = previous_pic
             form.save()
+            if new_pic:
+                schedule_image(profile, 'profile_pic', new_pic)
+            invalidate_user_cards(request.user.id)
             messages.success(request, "Profile updated!")
+        for field, error in upload_errors.items():
+            form.add_error(field, error)
     else:
         form = ProfileForm(instance=profile)
     
@@ -422,6 +467,7 @@ def friends_list_view(request):
 
 
 @login_required
+@replica_reads
 def find_friends_view(request):
     query = request.GET.get('q')
     
@@ -453,18 +499,20 @@ def find_friends_view(request):
         # Get random selection when no query
         results = base_query.order_by('?')[:10]
     
-    # Add friend request status for each user
+    results = results.select_related('profile')
+
+    # Add friend request status for each user from two set lookups
+    sent_to = set(FriendRequest.objects.filter(
+        from_user=request.user,
+        is_accepted=False
+    ).values_list('to_user_id', flat=True))
+    received_from = set(FriendRequest.objects.filter(
+        to_user=request.user,
+        is_accepted=False
+    ).values_list('from_user_id', flat=True))
     for user in results:
-        user.friend_request_sent = FriendRequest.objects.filter(
-            from_user=request.user,
-            to_user=user,
-            is_accepted=False
-        ).exists()
-        user.friend_request_received = FriendRequest.objects.filter(
-            from_user=user,
-            to_user=request.user,
-            is_accepted=False
-        ).exists()
+        user.friend_request_sent = user.id in sent_to
+        user.friend_request_received = user.id in received_from
 
     return render(request, 'chat/find_friends.html', {
         'results': results,
@@ -473,14 +521,15 @@ def find_friends_view(request):
 
 def get_user_friends(user):
     # Get all accepted friend requests where user is either sender or receiver
-    sent_requests = FriendRequest.objects.filter(from_user=user, is_accepted=True)
-    received_requests = FriendRequest.objects.filter(to_user=user, is_accepted=True)
+    sent_requests = FriendRequest.objects.filter(from_user=user, is_accepted=True).select_related('to_user__profile')
+    received_requests = FriendRequest.objects.filter(to_user=user, is_accepted=True).select_related('from_user__profile')
     
     # Combine friends from both sent and received requests
     friends = [req.to_user for req in sent_requests] + [req.from_user for req in received_requests]
     return friends
 
 @login_required
+@replica_reads
 def user_profile_view(request, user_id):
     other_user = get_object_or_404(User, id=user_id)
     
@@ -533,7 +582,7 @@ def user_profile_view(request, user_id):
 def chat_with_friend(request, friend_id):
     try:
         friend = get_object_or_404(User, id=friend_id)
-        print(f"Found friend with ID {friend_id}: {friend.username}")
+        logger.debug(f"Found friend with ID {friend_id}: {friend.username}")
 
         # Ensure they're friends
         is_friend = FriendRequest.objects.filter(
@@ -542,61 +591,119 @@ def chat_with_friend(request, friend_id):
             is_accepted=True
         ).exists()
         
-        print(f"Friendship status with {friend.username}: {is_friend}")
+        logger.debug(f"Friendship status with {friend.username}: {is_friend}")
 
         if not is_friend:
-            print(f"No friendship found between {request.user.username} and {friend.username}")
+            logger.info(f"No friendship found between {request.user.username} and {friend.username}")
             messages.error(request, "You are not friends with this user.")
             return redirect('friends')
 
-        # Get chat history
-        messages_qs = Message.objects.filter(
-            Q(sender=request.user, receiver=friend) |
-            Q(sender=friend, receiver=request.user)
-        ).order_by('timestamp')
-
-        print(f"Found {messages_qs.count()} messages in chat history")
+        # Newest page of history; older pages come from chat_history
+        chat_messages, has_more = get_history(request.user, friend)
 
         # Create a unique room name based on user IDs
         room_name = f"{min(request.user.id, friend.id)}_{max(request.user.id, friend.id)}"
 
-        # Mark unread messages as read
-        unread_count = Message.objects.filter(sender=friend, receiver=request.user, is_read=False).update(is_read=True)
-        print(f"Marked {unread_count} messages as read")
+        # Mark the conversation read by moving the read cursor
+        if mark_read(request.user.id, friend.id):
+            logger.debug(f"Moved read cursor for {friend.username}")
 
         return render(request, 'chat/chat_room.html', {
             'friend': friend,
-            'chat_messages': messages_qs,
+            'friend_online': get_presence([friend.id])[friend.id],
+            'chat_messages': chat_messages,
+            'has_more_history': has_more,
             'room_name': room_name
         })
     except Exception as e:
-        print(f"Error in chat_with_friend: {str(e)}")
+        logger.exception(f"Error in chat_with_friend: {str(e)}")
         messages.error(request, "An error occurred while loading the chat. Please try again.")
         return redirect('messages')
 
+@login_required
+def chat_history_view(request, friend_id):
+    """
+    Older messages with a friend as JSON, one page before ``?before=<id>``.
+    Reads through to the message archive past the hot window.
+    """
+    friend = get_object_or_404(User, id=friend_id)
+    if friend.id not in friend_ids(request.user):
+        return JsonResponse({'status': 'error', 'error': 'You are not friends with this user.'}, status=403)
+    before_id = request.GET.get('before', '')
+    before_id = int(before_id) if before_id.isdigit() else None
+
+    chat_messages, has_more = get_history(request.user, friend, before_id)
+    return JsonResponse({
+        'messages': [
+            {
+                'id': message.id,
+                'sender': str(message.sender_id),
+                'message': message.content,
+                'timestamp': message.timestamp.isoformat(),
+            }
+            for message in chat_messages
+        ],
+        'has_more': has_more,
+    })
+
+@login_required
+def chat_rooms_view(request):
+    """List the user's group chats with unread counts, and create new ones."""
+    if request.method == 'POST':
+        member_ids = {int(user_id) for user_id in request.POST.getlist('members') if user_id.isdigit()}
+        try:
+            room = create_room(request.user, request.POST.get('name', ''), member_ids)
+        except ValidationError as e:
+            messages.error(request, ' '.join(e.messages))
+            return redirect('chat_rooms')
+        return redirect('group_chat', room_id=room.id)
+
+    return render(request, 'chat/chat_rooms.html', {
+        'memberships': get_rooms_with_unread(request.user),
+        'friends': get_user_friends(request.user),
+    })
+
+@login_required
+def group_chat_view(request, room_id):
+    membership = get_object_or_404(
+        Membership.objects.select_related('room'), room_id=room_id, user=request.user
+    )
+    # Newest page of history; older pages aren't needed to join the live room
+    room_messages = list(
+        RoomMessage.objects.filter(room_id=room_id).select_related('sender').order_by('-id')[:settings.ROOM_HISTORY_SIZE]
+    )[::-1]
+    if room_messages:
+        mark_room_read(room_id, request.user.id, room_messages[-1].id)
+
+    return render(request, 'chat/group_chat.html', {
+        'room': membership.room,
+        'room_messages': room_messages,
+    })
+
+@image_uploads
 def complete_profile_view(request, user_id):
     if user_id != 0 and not request.user.is_authenticated:
         messages.error(request, "You must be logged in to edit your profile.")
         return redirect('login')
     if user_id == 0:  # New user completing profile
-        print("[DEBUG] Session keys:", list(request.session.keys()))
+        logger.debug(f"Session keys: {list(request.session.keys())}")
         if not all(key in request.session for key in ['verified_email', 'verified_username', 'verified_password']):
-            print("[DEBUG] Session missing required keys for new user registration.")
+            logger.debug("Session missing required keys for new user registration.")
             messages.error(request, "Session expired. Please register again.")
             return redirect('register')
         
         # Check if session data is empty
         if not all([request.session['verified_email'], request.session['verified_username'], request.session['verified_password']]):
-            print("[DEBUG] Session data is empty")
+            logger.debug("Session data is empty")
             messages.error(request, "Invalid session data. Please register again.")
             return redirect('register')
             
-        print("[DEBUG] Session data present and valid")
+        logger.debug("Session data present and valid")
         
         if request.method == 'POST':
             try:
                 form = ProfileCompletionForm(request.POST, request.FILES)
-                print("[DEBUG] Form data:", request.POST)
+                add_upload_errors(request, form)
                 if form.is_valid():
                     try:
                         # Check if user already exists
@@ -613,14 +720,14 @@ def complete_profile_view(request, user_id):
                             email=request.session['verified_email'],
                             password=request.session['verified_password']
                         )
-                        print("[DEBUG] User created successfully:", user.username)
+                        logger.info(f"User created successfully: {user.username}")
                         
                         # Then create the profile
                         profile = form.save(commit=False)
                         profile.user = user
                         try:
                             profile.save()
-                            print("[DEBUG] Profile saved successfully")
+                            logger.debug("Profile saved successfully")
                             # Clean up session
                             request.session.pop('verified_email', None)
                             request.session.pop('verified_username', None)
@@ -630,25 +737,25 @@ def complete_profile_view(request, user_id):
                         except Exception as e:
                             # If profile creation fails, delete the user and show error
                             user.delete()
-                            print("[ERROR] Error creating profile:", str(e))
+                            logger.error(f"Error creating profile: {str(e)}")
                             messages.error(request, f"Error creating profile: {str(e)}")
                             return redirect('register')
                     except Exception as e:
-                        print("[ERROR] Error creating user:", str(e))
+                        logger.error(f"Error creating user: {str(e)}")
                         messages.error(request, f"Error creating user: {str(e)}")
                         return redirect('register')
                 else:
-                    print("[DEBUG] Form validation errors:", form.errors)
+                    logger.debug(f"Form validation errors: {form.errors.as_json()}")
                     for field, errors in form.errors.items():
                         for error in errors:
                             messages.error(request, f"{field}: {error}")
             except Exception as e:
-                print("[ERROR] Unexpected error in form processing:", str(e))
+                logger.exception(f"Unexpected error in form processing: {str(e)}")
                 messages.error(request, "An unexpected error occurred. Please try again.")
                 return redirect('register')
         else:
             form = ProfileCompletionForm()
-            print("[DEBUG] Displaying empty form for new profile")
+            logger.debug("Displaying empty form for new profile")
     else:  # Existing user updating profile
         if request.user.id != user_id and not request.user.is_staff:
             messages.error(request, "You don't have permission to edit this profile.")
@@ -657,16 +764,18 @@ def complete_profile_view(request, user_id):
             profile = get_object_or_404(Profile, user_id=user_id)
             if request.method == 'POST':
                 form = ProfileForm(request.POST, request.FILES, instance=profile)
+                add_upload_errors(request, form)
                 if form.is_valid():
                     form.save()
+                    invalidate_user_cards(user_id)
                     messages.success(request, "Profile updated successfully.")
                     return redirect('profile', user_id=user_id)
                 else:
-                    print("[DEBUG] Form validation errors for existing user:", form.errors)
+                    logger.debug(f"Form validation errors for existing user: {form.errors.as_json()}")
             else:
                 form = ProfileForm(instance=profile)
         except Exception as e:
-            print("[ERROR] Error handling existing profile:", str(e))
+            logger.exception(f"Error handling existing profile: {str(e)}")
             messages.error(request, "An error occurred while accessing your profile.")
             return redirect('home')
             
@@ -683,16 +792,18 @@ def like_post(request, post_id):
     try:
         post = Post.objects.get(id=post_id)
         like, created = Like.objects.get_or_create(user=request.user, post=post)
-        
+
         if not created:
             # User already liked the post, so unlike it
             like.delete()
+            bump_post_version(post.id)
             return JsonResponse({
                 'status': 'success',
                 'action': 'unliked',
                 'likes_count': post.likes.count()
             })
         else:
+            bump_post_version(post.id)
             # Create notification for the post owner if it's not the same user
             if post.user != request.user:
                 Notification.objects.create(
@@ -728,6 +839,7 @@ def edit_post(request, post_id):
         new_content = request.POST.get('content')
         post.content = new_content
         post.save()
+        bump_post_version(post.id)
         return redirect('index')
 
     return render(request, 'chat/edit_post.html', {'post': post})
@@ -757,11 +869,15 @@ def delete_post(request, post_id):
 def delete_comment(request, comment_id):
     comment = get_object_or_404(Comment, id=comment_id, user=request.user)
     comment.delete()
+    bump_post_version(comment.post_id)
     return redirect('index')
 
 @login_required
+@replica_reads
 def notifications_view(request):
-    notifs = Notification.objects.filter(user=request.user).order_by('-timestamp')
+    notifs = Notification.objects.filter(user=request.user).select_related(
+        'sender__profile', 'post', 'profile_user'
+    ).order_by('-timestamp')
     unread_count = notifs.filter(is_read=False).count()
 
     # If it's an AJAX call, mark all as read
@@ -793,41 +909,24 @@ def contact_view(request):
         email = request.POST.get('email')
         message = request.POST.get('message')
         # Optional: send email (or store in DB/log)
-        print(f"Message from {name} ({email}): {message}")
+        logger.info(f"Message from {name} ({email}): {message}")
         success = True
     return render(request, 'chat/contact.html', {'success': success})
 
 @staff_member_required
+@replica_reads
 def admin_dashboard(request):
-    users = User.objects.all()
+    users = User.objects.order_by('id')
     posts = Post.objects.select_related('user').order_by('-timestamp')
-    
-    # Basic counts
-    total_users = users.count()
-    total_posts = posts.count()
-    total_comments = Comment.objects.count()
-    active_users = users.filter(is_active=True).count()
-    blocked_users = total_users - active_users
-
-    # Posts this week (last 7 days)
-    today = timezone.now()
-    last_7_days = [today - timedelta(days=i) for i in range(6, -1, -1)]
-    posts_per_day = []
-    for day in last_7_days:
-        count = Post.objects.filter(
-            timestamp__date=day.date()
-        ).count()
-        posts_per_day.append({'date': day.strftime("%b %d"), 'count': count})
+
+    users_page = Paginator(users, settings.DASHBOARD_PAGE_SIZE).get_page(request.GET.get('users_page'))
+    posts_page = Paginator(posts, settings.DASHBOARD_PAGE_SIZE).get_page(request.GET.get('posts_page'))
 
     context = {
-        'users': users,
-        'posts': posts,
-        'total_users': total_users,
-        'total_posts': total_posts,
-        'total_comments': total_comments,
-        'active_users': active_users,
-        'blocked_users': blocked_users,
-        'posts_per_day': posts_per_day,
+        'users_page': users_page,
+        'posts_page': posts_page,
+        'activity': get_activity(),
+        **get_platform_stats(),
     }
     return render(request, 'chat/admin_dashboard.html', context)
 
@@ -837,6 +936,7 @@ def toggle_block_user(request, user_id):
     user = User.objects.get(id=user_id)
     user.is_active = not user.is_active
     user.save()
+    invalidate_dashboard_stats()
     return redirect('admin_dashboard')
 
 @require_POST
@@ -844,8 +944,67 @@ def toggle_block_user(request, user_id):
 def delete_post_admin(request, post_id):
     post = Post.objects.get(id=post_id)
     post.delete()
+    invalidate_dashboard_stats()
     return redirect('admin_dashboard')
 
+def parse_id_list(request):
+    """Return the list of integer ids posted as {"ids": [...]}, or None if invalid."""
+    try:
+        ids = json.loads(request.body).get('ids')
+    except (json.JSONDecodeError, AttributeError):
+        return None
+    if not isinstance(ids, list) or len(ids) > settings.MODERATION_MAX_IDS:
+        return None
+    try:
+        return [int(i) for i in ids]
+    except (TypeError, ValueError):
+        return None
+
+def stream_moderation_progress(action, progress):
+    """
+    Stream one JSON line per processed chunk, then a final status line.
+
+    The body is an async iterator, so an ASGI server sends each line as
+    soon as its chunk has committed; the chunks themselves run through
+    sync_to_async. They run after the view has returned, so a failing
+    chunk is reported in the stream: the last line then has status
+    'error' and the progress made before it.
+    """
+    next_chunk = sync_to_async(next)
+
+    async def lines():
+        last = {}
+        try:
+            while (update := await next_chunk(progress, None)) is not None:
+                last = update
+                moderation_chunks.inc(action=action, status='ok')
+                yield json.dumps(last) + '\n'
+        except Exception as e:
+            moderation_chunks.inc(action=action, status='error')
+            logger.exception(f"Bulk {action} stopped after {last.get('processed', 0)} items: {str(e)}")
+            status = {'status': 'error', 'error': 'The action stopped early; processed items were saved'}
+        else:
+            status = {'status': 'success'}
+        await sync_to_async(invalidate_dashboard_stats)()
+        yield json.dumps({**status, **last}) + '\n'
+    return StreamingHttpResponse(lines(), content_type='application/x-ndjson')
+
+@require_POST
+@staff_member_required
+def bulk_delete_posts_admin(request):
+    post_ids = parse_id_list(request)
+    if post_ids is None:
+        return JsonResponse({'status': 'error', 'error': 'Invalid id list'}, status=400)
+    return stream_moderation_progress('delete_posts', bulk_delete_posts(post_ids))
+
+@require_POST
+@staff_member_required
+def bulk_block_users(request, action):
+    user_ids = parse_id_list(request)
+    if user_ids is None:
+        return JsonResponse({'status': 'error', 'error': 'Invalid id list'}, status=400)
+    return stream_moderation_progress(f'{action}_users', bulk_set_user_active(user_ids, is_active=(action == 'unblock')))
+
 @login_required
 @require_POST
 def delete_notification(request, notif_id):
@@ -870,6 +1029,23 @@ def messages_view(request):
         'friends_with_messages': friends_with_messages
     })
 
+@login_required
+@replica_reads
+def search_messages_view(request):
+    """Search the user's conversations, optionally with one friend."""
+    query = request.GET.get('q', '').strip()
+    with_user_id = request.GET.get('with', '')
+    with_user_id = int(with_user_id) if with_user_id.isdigit() else None
+    before_id = request.GET.get('before', '')
+    before_id = int(before_id) if before_id.isdigit() else None
+
+    page = search_messages(request.user, query, with_user_id, before_id)
+    return render(request, 'chat/message_search.html', {
+        'query': query,
+        'with_user_id': with_user_id,
+        **page
+    })
+
 @login_required
 def account_view(request):
     """View and manage account settings."""
@@ -945,6 +1121,7 @@ def add_comment(request, post_id):
             post=post,
             content=content
         )
+        bump_post_version(post.id)
         
         # Create notification for post owner if it's not the same user
         if post.user != request.user:
@@ -994,6 +1171,7 @@ def delete_comment(request, comment_id):
         comment = Comment.objects.get(id=comment_id, user=request.user)
         post = comment.post
         comment.delete()
+        bump_post_version(post.id)
         
         return JsonResponse({
             'status': 'success',
@@ -1048,23 +1226,42 @@ def resend_otp_view(request):
 def get_friends_with_unread_messages(user):
     """
     Returns a list of friends with their unread message count and last message.
+
+    Uses a fixed number of queries regardless of how many friends the user has.
     """
     # Get all accepted friends
-    sent_requests = FriendRequest.objects.filter(from_user=user, is_accepted=True)
-    received_requests = FriendRequest.objects.filter(to_user=user, is_accepted=True)
-    friends = [req.to_user for req in sent_requests] + [req.from_user for req in received_requests]
+    friend_ids = set()
+    for from_id, to_id in FriendRequest.objects.filter(
+        Q(from_user=user) | Q(to_user=user),
+        is_accepted=True
+    ).values_list('from_user_id', 'to_user_id'):
+        friend_ids.add(to_id if from_id == user.id else from_id)
+
+    # Unread messages from each friend to the user, past the user's read cursors
+    unread_counts = {
+        sender_id: unread for sender_id, (unread, _) in unread_summary(user.id, friend_ids).items()
+    }
+
+    # The last message between user and each friend
+    last_message_id = Message.objects.filter(
+        Q(sender=user, receiver=OuterRef('pk')) | Q(sender=OuterRef('pk'), receiver=user)
+    ).order_by('-timestamp').values('id')[:1]
+    friends = User.objects.filter(id__in=friend_ids).select_related('profile').annotate(
+        last_message_id=Subquery(last_message_id)
+    )
+    friends = list(friends)
+    last_messages = Message.objects.in_bulk(
+        [friend.last_message_id for friend in friends if friend.last_message_id]
+    )
+
+    online = get_presence(friend_ids)
 
     friends_data = []
     for friend in friends:
-        # Get unread messages from this friend to the user
-        unread_count = Message.objects.filter(sender=friend, receiver=user, is_read=False).count()
-        # Get the last message between user and friend
-        last_message = Message.objects.filter(
-            Q(sender=user, receiver=friend) | Q(sender=friend, receiver=user)
-        ).order_by('-timestamp').first()
         friends_data.append({
             'user': friend,
-            'unread_count': unread_count,
-            'last_message': last_message,
+            'unread_count': unread_counts.get(friend.id, 0),
+            'last_message': last_messages.get(friend.last_message_id),
+            'online': online.get(friend.id, False),
         })
     return friends_data
@@ -0,0 +1,71 @@
+"""
+Cache backends that record hits and misses per namespace.
+
+Each alias in CACHES is one namespace (sessions, fragments, counters,
+ratelimit, presence) with its own KEY_PREFIX. Against Redis every alias shares the
+server configured by REDIS_URL; without it each alias gets its own local
+memory store. Hits and misses are exported through /metrics as
+``cache_hits_total`` and ``cache_misses_total``.
+"""
+from django.core.cache.backends.locmem import LocMemCache
+from django.core.cache.backends.redis import RedisCache
+
+from .metrics import registry
+
+cache_hits = registry.counter('cache_hits_total', 'Cache lookups that found a value, per namespace')
+cache_misses = registry.counter('cache_misses_total', 'Cache lookups that found nothing, per namespace')
+
+_missing = object()
+
+
+class InstrumentedCacheMixin:
+    """Count hits and misses for get, get_many and get_or_set."""
+
+    def __init__(self, server, params):
+        super().__init__(server, params)
+        self.namespace = self.key_prefix or 'default'
+        # BaseCache.get_many calls get() per key; count those lookups once
+        self._counting = True
+
+    def get(self, key, default=None, version=None):
+        value = super().get(key, _missing, version=version)
+        if self._counting:
+            (cache_misses if value is _missing else cache_hits).inc(namespace=self.namespace)
+        return default if value is _missing else value
+
+    def get_many(self, keys, version=None):
+        keys = list(keys)
+        self._counting = False
+        try:
+            found = super().get_many(keys, version=version)
+        finally:
+            self._counting = True
+        if found:
+            cache_hits.inc(len(found), namespace=self.namespace)
+        if len(keys) > len(found):
+            cache_misses.inc(len(keys) - len(found), namespace=self.namespace)
+        return found
+
+
+class InstrumentedLocMemCache(InstrumentedCacheMixin, LocMemCache):
+    pass
+
+
+class InstrumentedRedisCache(InstrumentedCacheMixin, RedisCache):
+    clear_batch_size = 1000
+
+    def clear(self):
+        """
+        Delete this namespace's keys only. RedisCache.clear() flushes the
+        whole database, which would take every other namespace and the
+        channel layer with it.
+        """
+        client = self._cache.get_client(write=True)
+        batch = []
+        for key in client.scan_iter(match=f'{self.key_prefix}:*', count=self.clear_batch_size):
+            batch.append(key)
+            if len(batch) >= self.clear_batch_size:
+                client.delete(*batch)
+                batch = []
+        if batch:
+            client.delete(*batch)
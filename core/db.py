@@ -0,0 +1,116 @@
+"""
+Read-replica routing.
+
+Views decorated with ``@replica_reads`` run their reads against one of the
+DATABASE_REPLICAS aliases; everything else, all writes and the chat
+consumer use the primary. ReplicaRoutingMiddleware decides per request:
+a client that wrote recently carries a short-lived pin cookie and reads
+from the primary until the replicas have caught up (read-your-writes).
+"""
+import functools
+import random
+from contextvars import ContextVar
+
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS, connections
+
+from .metrics import registry
+
+replica_requests = registry.counter(
+    'db_replica_requests_total', 'Requests whose reads were routed to a replica, per alias'
+)
+pinned_requests = registry.counter(
+    'db_replica_pinned_requests_total', 'Replica-eligible requests kept on the primary after a recent write'
+)
+
+
+class RoutingState:
+    def __init__(self, read_alias=None):
+        self.read_alias = read_alias
+        self.wrote = False
+
+
+_state = ContextVar('db_routing_state', default=None)
+
+
+def replica_reads(view_func):
+    """Mark a view whose GET/HEAD reads may be served by a replica."""
+    @functools.wraps(view_func)
+    def wrapped_view(*args, **kwargs):
+        return view_func(*args, **kwargs)
+    wrapped_view.replica_reads = True
+    return wrapped_view
+
+
+class ReplicaRouter:
+    """Route reads to the request's replica, if any, and writes to the primary."""
+
+    def db_for_read(self, model, **hints):
+        instance = hints.get('instance')
+        if instance is not None and instance._state.db:
+            return instance._state.db
+        state = _state.get()
+        if state is None or state.read_alias is None:
+            return DEFAULT_DB_ALIAS
+        # Reads inside a transaction must see its own uncommitted writes
+        if connections[DEFAULT_DB_ALIAS].in_atomic_block:
+            return DEFAULT_DB_ALIAS
+        return state.read_alias
+
+    def db_for_write(self, model, **hints):
+        state = _state.get()
+        if state is not None:
+            state.wrote = True
+        return DEFAULT_DB_ALIAS
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # Replicas hold the same data as the primary
+        return True
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        return db == DEFAULT_DB_ALIAS
+
+
+class ReplicaRoutingMiddleware:
+    """
+    Pick the read database for each request and pin clients that just
+    wrote to the primary for REPLICA_PIN_SECONDS.
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        state = RoutingState()
+        token = _state.set(state)
+        try:
+            response = self.get_response(request)
+        finally:
+            _state.reset(token)
+
+        if request.method not in ('GET', 'HEAD') or state.wrote:
+            response.set_cookie(
+                settings.REPLICA_PIN_COOKIE,
+                '1',
+                max_age=settings.REPLICA_PIN_SECONDS,
+                secure=settings.SESSION_COOKIE_SECURE,
+                httponly=True,
+                samesite='Lax',
+            )
+        return response
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        state = _state.get()
+        if (
+            state is None
+            or not settings.DATABASE_REPLICAS
+            or request.method not in ('GET', 'HEAD')
+            or not getattr(view_func, 'replica_reads', False)
+        ):
+            return None
+        if request.COOKIES.get(settings.REPLICA_PIN_COOKIE):
+            pinned_requests.inc()
+            return None
+        state.read_alias = random.choice(settings.DATABASE_REPLICAS)
+        replica_requests.inc(alias=state.read_alias)
+        return None
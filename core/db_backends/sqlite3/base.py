@@ -0,0 +1,7 @@
+from django.db.backends.sqlite3 import base
+
+from core.pool import BoundedConnectionMixin
+
+
+class DatabaseWrapper(BoundedConnectionMixin, base.DatabaseWrapper):
+    pass
@@ -0,0 +1,79 @@
+import logging
+import time
+from contextlib import ExitStack
+
+from django.conf import settings
+from django.db import connections
+
+from .metrics import registry, COUNT_BUCKETS
+
+logger = logging.getLogger(__name__)
+
+request_duration = registry.histogram(
+    'http_request_duration_seconds', 'Wall time spent handling a request, per view'
+)
+request_queries = registry.histogram(
+    'http_request_db_queries', 'SQL queries executed per request, per view', buckets=COUNT_BUCKETS
+)
+request_db_time = registry.histogram(
+    'http_request_db_seconds', 'Time spent in SQL per request, per view'
+)
+requests_total = registry.counter(
+    'http_requests_total', 'Requests handled, per view and status code'
+)
+query_budget_exceeded = registry.counter(
+    'http_query_budget_exceeded_total', 'Requests that ran more queries than QUERY_BUDGET, per view'
+)
+
+
+class QueryRecorder:
+    """execute_wrapper that counts queries and accumulates their run time."""
+
+    def __init__(self):
+        self.count = 0
+        self.duration = 0.0
+
+    def __call__(self, execute, sql, params, many, context):
+        start = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.count += 1
+            self.duration += time.perf_counter() - start
+
+
+class QueryMetricsMiddleware:
+    """
+    Record query count, DB time and latency for every request.
+
+    Samples are labelled with the resolved view name and exported through
+    the /metrics endpoint. Requests running more than QUERY_BUDGET queries
+    are logged as warnings.
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        recorder = QueryRecorder()
+        start = time.perf_counter()
+        with ExitStack() as stack:
+            for connection in connections.all():
+                stack.enter_context(connection.execute_wrapper(recorder))
+            response = self.get_response(request)
+        elapsed = time.perf_counter() - start
+
+        match = request.resolver_match
+        view = match.view_name if match else 'unresolved'
+        request_duration.observe(elapsed, view=view)
+        request_queries.observe(recorder.count, view=view)
+        request_db_time.observe(recorder.duration, view=view)
+        requests_total.inc(view=view, status=response.status_code)
+
+        if recorder.count > settings.QUERY_BUDGET:
+            query_budget_exceeded.inc(view=view)
+            logger.warning(
+                f"{request.method} {request.path} ({view}) ran {recorder.count} queries "
+                f"in {recorder.duration * 1000:.1f}ms, over the budget of {settings.QUERY_BUDGET}"
+            )
+        return response
@@ -0,0 +1,95 @@
+"""
+Bounded, instrumented database connections.
+
+Under Daphne every request and every ``database_sync_to_async`` call runs
+in a worker thread, and each thread opens its own connection, so the
+number of connections grows with concurrency rather than with the number
+of processes. Each process holds at most DB_POOL_SIZE open connections
+per alias, shared by request, consumer and upload threads alike (20 by
+default; 0 disables the cap). A thread that needs one waits up to
+DB_POOL_TIMEOUT seconds for a slot. Connections are then closed after
+every request (CONN_MAX_AGE=0), which pairs with PgBouncer in transaction
+mode doing the real pooling.
+
+Slot wait time, connect time and open connections are exported on
+/metrics.
+"""
+import threading
+import time
+
+from django.conf import settings
+from django.db import OperationalError
+
+from .metrics import registry
+
+pool_wait_seconds = registry.histogram(
+    'db_pool_wait_seconds', 'Time a thread waited for a free connection slot, per alias'
+)
+connect_seconds = registry.histogram(
+    'db_connect_seconds', 'Time spent opening a database connection, per alias'
+)
+connections_open = registry.gauge(
+    'db_connections_open', 'Database connections currently open in this process, per alias'
+)
+pool_timeouts = registry.counter(
+    'db_pool_timeouts_total', 'Connection attempts that gave up waiting for a slot, per alias'
+)
+
+_slots = {}
+_slots_lock = threading.Lock()
+
+
+def get_slots(alias):
+    """Return the process-wide semaphore for ``alias``, or None if unbounded."""
+    if not settings.DB_POOL_SIZE:
+        return None
+    with _slots_lock:
+        if alias not in _slots:
+            _slots[alias] = threading.BoundedSemaphore(settings.DB_POOL_SIZE)
+        return _slots[alias]
+
+
+class BoundedConnectionMixin:
+    """DatabaseWrapper mixin that takes a pool slot for every open connection."""
+
+    pool_slot = None
+    pool_counted = False
+
+    def connect(self):
+        started = time.perf_counter()
+        if not self.pool_counted:
+            slots = get_slots(self.alias)
+            if slots is not None:
+                if not slots.acquire(timeout=settings.DB_POOL_TIMEOUT):
+                    pool_timeouts.inc(alias=self.alias)
+                    raise OperationalError(
+                        f"Timed out after {settings.DB_POOL_TIMEOUT}s waiting for one of "
+                        f"{settings.DB_POOL_SIZE} connection slots for '{self.alias}'"
+                    )
+                self.pool_slot = slots
+        acquired = time.perf_counter()
+        pool_wait_seconds.observe(acquired - started, alias=self.alias)
+        try:
+            super().connect()
+        except Exception:
+            if not self.pool_counted:
+                self.release_slot()
+            raise
+        connect_seconds.observe(time.perf_counter() - acquired, alias=self.alias)
+        if not self.pool_counted:
+            self.pool_counted = True
+            connections_open.inc(alias=self.alias)
+
+    def close(self):
+        try:
+            super().close()
+        finally:
+            if self.pool_counted and self.connection is None:
+                self.pool_counted = False
+                connections_open.dec(alias=self.alias)
+                self.release_slot()
+
+    def release_slot(self):
+        if self.pool_slot is not None:
+            self.pool_slot.release()
+            self.pool_slot = None
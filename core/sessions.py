@@ -0,0 +1,29 @@
+from django.contrib.sessions.models import Session
+from django.db import transaction
+from django.utils import timezone
+
+
+def clear_expired_sessions(chunk_size=1000):
+    """
+    Delete expired rows from django_session in chunks.
+
+    Unlike ``manage.py clearsessions`` this never holds one long DELETE
+    over the whole table, so it can run while the site is busy.
+
+    Args:
+        chunk_size: Maximum rows deleted per transaction
+
+    Returns:
+        int: Number of sessions deleted
+    """
+    now = timezone.now()
+    deleted = 0
+    while True:
+        keys = list(
+            Session.objects.filter(expire_date__lt=now).values_list('session_key', flat=True)[:chunk_size]
+        )
+        if not keys:
+            return deleted
+        with transaction.atomic():
+            count, _ = Session.objects.filter(session_key__in=keys).delete()
+        deleted += count
@@ -49,6 +49,7 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'core.middleware.QueryMetricsMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'whitenoise.middleware.WhiteNoiseMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
@@ -57,6 +58,7 @@ MIDDLEWARE = [
     'django.contrib.auth.middleware.AuthenticationMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
+    'core.db.ReplicaRoutingMiddleware',
 ]
 
 ROOT_URLCONF = 'core.urls'
@@ -82,13 +84,138 @@ WSGI_APPLICATION = 'core.wsgi.application'
 ASGI_APPLICATION = 'core.asgi.application'
 
 # Database
-DATABASES = {
-    'default': dj_database_url.config(
-        default='sqlite:///db.sqlite3',
-        conn_max_age=600
+# DB_POOL_MODE=persistent keeps each thread's connection open for
+# DB_CONN_MAX_AGE seconds. DB_POOL_MODE=pgbouncer closes connections after
+# every request and disables server-side cursors, for PgBouncer in
+# transaction mode. DB_POOL_SIZE caps the connections one process holds per
+# database, across every thread that queries it: Daphne runs each sync view
+# on a thread of its own per in-flight request, WebSocket consumers use
+# their CONSUMER_DB_WORKERS threads and image processing its UPLOAD_WORKERS
+# threads. Nothing else bounds the request threads, so under load the cap is
+# what limits connections, and a thread beyond it waits up to
+# DB_POOL_TIMEOUT seconds for one to free up. Keep it well above
+# CONSUMER_DB_WORKERS + UPLOAD_WORKERS so requests still get a share. A
+# bounded pool also closes connections after every request, since a Daphne
+# request thread exits when the request ends; DB_POOL_SIZE=0 lifts the cap
+# and keeps DB_CONN_MAX_AGE.
+DB_POOL_MODE = os.getenv('DB_POOL_MODE', 'persistent')
+DB_POOL_SIZE = int(os.getenv('DB_POOL_SIZE', '20'))
+DB_POOL_TIMEOUT = float(os.getenv('DB_POOL_TIMEOUT', '10'))
+DB_CONN_MAX_AGE = 0 if DB_POOL_MODE == 'pgbouncer' or DB_POOL_SIZE else int(os.getenv('DB_CONN_MAX_AGE', '600'))
+DB_ENGINES = {
+    'django.db.backends.postgresql': 'core.db_backends.postgresql',
+    'django.db.backends.sqlite3': 'core.db_backends.sqlite3',
+}
+
+
+def database_config(url):
+    config = dj_database_url.parse(
+        url,
+        conn_max_age=DB_CONN_MAX_AGE,
+        conn_health_checks=True,
+        disable_server_side_cursors=DB_POOL_MODE == 'pgbouncer',
     )
+    config['ENGINE'] = DB_ENGINES.get(config['ENGINE'], config['ENGINE'])
+    return config
+
+
+DATABASES = {
+    'default': database_config(os.getenv('DATABASE_URL', 'sqlite:///db.sqlite3')),
 }
 
+# Read replicas, as comma-separated database URLs. Views marked with
+# @replica_reads read from them; clients that just wrote are pinned to the
+# primary for REPLICA_PIN_SECONDS.
+DATABASE_REPLICAS = []
+for index, url in enumerate(filter(None, os.getenv('DATABASE_REPLICA_URLS', '').split(',')), start=1):
+    alias = f'replica{index}'
+    DATABASES[alias] = database_config(url)
+    DATABASES[alias]['TEST'] = {'MIRROR': 'default'}
+    DATABASE_REPLICAS.append(alias)
+DATABASE_ROUTERS = ['core.db.ReplicaRouter']
+REPLICA_PIN_SECONDS = int(os.getenv('REPLICA_PIN_SECONDS', '5'))
+REPLICA_PIN_COOKIE = 'read_primary'
+
+# Cache. One alias per namespace, shared through Redis when REDIS_URL is set
+# (by default the same server as CHANNEL_LAYERS, separated by KEY_PREFIX)
+# and falling back to a local memory store per alias otherwise. Hits and
+# misses per namespace are exported on /metrics.
+REDIS_URL = os.getenv('REDIS_URL')
+CACHE_REDIS_URL = os.getenv('CACHE_REDIS_URL', REDIS_URL)
+CACHE_NAMESPACES = ['default', 'sessions', 'fragments', 'counters', 'ratelimit', 'presence']
+if CACHE_REDIS_URL:
+    CACHES = {
+        namespace: {
+            'BACKEND': 'core.cache.InstrumentedRedisCache',
+            'LOCATION': CACHE_REDIS_URL,
+            'KEY_PREFIX': namespace,
+        }
+        for namespace in CACHE_NAMESPACES
+    }
+else:
+    # The locmem default only keeps 300 entries, fewer than one feed's
+    # worth of post-card versions
+    CACHES = {
+        namespace: {
+            'BACKEND': 'core.cache.InstrumentedLocMemCache',
+            'LOCATION': namespace,
+            'KEY_PREFIX': namespace,
+            'OPTIONS': {'MAX_ENTRIES': 20000},
+        }
+        for namespace in CACHE_NAMESPACES
+    }
+
+# Sessions. cached_db reads through the 'sessions' cache and keeps the
+# database as the source of truth; 'cache' drops the table entirely. With
+# only per-process local memory caches a cached session could go stale
+# across workers, so the database engine stays the default without Redis.
+SESSION_BACKEND = os.getenv('SESSION_BACKEND', 'cached_db' if CACHE_REDIS_URL else 'db')
+SESSION_ENGINE = f'django.contrib.sessions.backends.{SESSION_BACKEND}'
+SESSION_CACHE_ALIAS = 'sessions'
+
+# WebSocket consumers run DB calls on their own bounded thread pool; when
+# CONSUMER_DB_QUEUE_LIMIT calls are already waiting, clients get a "busy"
+# error frame asking them to retry after CONSUMER_DB_RETRY_AFTER seconds
+CONSUMER_DB_WORKERS = int(os.getenv('CONSUMER_DB_WORKERS', '4'))
+CONSUMER_DB_QUEUE_LIMIT = int(os.getenv('CONSUMER_DB_QUEUE_LIMIT', '100'))
+CONSUMER_DB_RETRY_AFTER = 1
+
+# Reconnecting chat clients send a "sync" frame with their last seen message
+# id and get the missing messages back in batches of CHAT_SYNC_BATCH_SIZE,
+# at most CHAT_SYNC_MAX_MESSAGES per sync frame
+CHAT_SYNC_BATCH_SIZE = int(os.getenv('CHAT_SYNC_BATCH_SIZE', '100'))
+CHAT_SYNC_MAX_MESSAGES = int(os.getenv('CHAT_SYNC_MAX_MESSAGES', '500'))
+# Per-connection window of recent client_msg_ids acknowledged without a DB
+# lookup; older resends are caught by the unique constraint instead
+CHAT_CLIENT_ID_WINDOW = int(os.getenv('CHAT_CLIENT_ID_WINDOW', '256'))
+
+# Presence lives in the 'presence' cache: chat and inbox sockets count their user
+# online for PRESENCE_TTL seconds and clients send a "ping" frame every
+# PRESENCE_HEARTBEAT seconds to keep it alive
+PRESENCE_TTL = int(os.getenv('PRESENCE_TTL', '60'))
+PRESENCE_HEARTBEAT = int(os.getenv('PRESENCE_HEARTBEAT', '25'))
+
+# Messages rendered when a group chat page opens
+ROOM_HISTORY_SIZE = int(os.getenv('ROOM_HISTORY_SIZE', '50'))
+
+# Message search: results per page and the per-query time budget
+MESSAGE_SEARCH_PAGE_SIZE = int(os.getenv('MESSAGE_SEARCH_PAGE_SIZE', '20'))
+MESSAGE_SEARCH_TIMEOUT_MS = int(os.getenv('MESSAGE_SEARCH_TIMEOUT_MS', '500'))
+
+# Message archive: one-to-one messages older than MESSAGE_ARCHIVE_AFTER_DAYS
+# are moved into compressed segments under MESSAGE_ARCHIVE_ROOT by the
+# archive_messages command; chat history pages CHAT_HISTORY_PAGE_SIZE at a time
+MESSAGE_ARCHIVE_ROOT = os.getenv('MESSAGE_ARCHIVE_ROOT', os.path.join(BASE_DIR, 'message_archive'))
+MESSAGE_ARCHIVE_AFTER_DAYS = int(os.getenv('MESSAGE_ARCHIVE_AFTER_DAYS', '180'))
+CHAT_HISTORY_PAGE_SIZE = int(os.getenv('CHAT_HISTORY_PAGE_SIZE', '50'))
+
+# Request instrumentation
+QUERY_BUDGET = int(os.getenv('QUERY_BUDGET', '30'))
+# /metrics is served to staff users and to scrapers sending
+# "Authorization: Bearer <METRICS_TOKEN>". Behind the platform's proxy
+# REMOTE_ADDR is the proxy's, so client addresses can't be trusted.
+METRICS_TOKEN = os.getenv('METRICS_TOKEN', '')
+
 # Password validation
 AUTH_PASSWORD_VALIDATORS = [
     {
@@ -120,6 +247,15 @@ STATICFILES_STORAGE = 'whitenoise.storage.CompressedManifestStaticFilesStorage'
 MEDIA_URL = '/media/'
 MEDIA_ROOT = os.path.join(BASE_DIR, 'media')
 
+# Image uploads are validated while streaming and spooled to temporary
+# files by the views wrapped in chat.upload_handlers.image_uploads
+MAX_IMAGE_UPLOAD_SIZE = 5 * 1024 * 1024  # 5MB
+
+# Uploaded images are staged here and processed by a background worker pool
+UPLOAD_STAGING_ROOT = os.getenv('UPLOAD_STAGING_ROOT', os.path.join(BASE_DIR, 'upload_staging'))
+UPLOAD_WORKERS = int(os.getenv('UPLOAD_WORKERS', '2'))
+UPLOAD_MAX_DIMENSION = int(os.getenv('UPLOAD_MAX_DIMENSION', '1600'))
+
 # Serve media files in production
 if not DEBUG:
     MIDDLEWARE.append('whitenoise.middleware.WhiteNoiseMiddleware')
@@ -131,6 +267,24 @@ MEDIA_ROOT_PATH = os.path.join(BASE_DIR, 'media')
 if not os.path.exists(MEDIA_ROOT_PATH):
     os.makedirs(MEDIA_ROOT_PATH)
 
+# Admin dashboard
+DASHBOARD_CACHE_SECONDS = int(os.getenv('DASHBOARD_CACHE_SECONDS', '60'))
+DASHBOARD_PAGE_SIZE = 25
+# Ids below the rollup watermark that rollup_activity re-scans on each run,
+# to catch rows whose transaction committed after a higher id was seen.
+# Daily activity counts rows once, when rolled up; later deletes and
+# archiving don't lower it.
+ROLLUP_SAFETY_WINDOW = int(os.getenv('ROLLUP_SAFETY_WINDOW', '1000'))
+MODERATION_CHUNK_SIZE = int(os.getenv('MODERATION_CHUNK_SIZE', '100'))
+MODERATION_MAX_IDS = 5000
+
+# Rendered post cards: per-process LRU in front of the shared cache
+FRAGMENT_CACHE_SECONDS = int(os.getenv('FRAGMENT_CACHE_SECONDS', '120'))
+FRAGMENT_LRU_SIZE = int(os.getenv('FRAGMENT_LRU_SIZE', '5000'))
+# Per-post card versions; long-lived, but finite so posts nobody reads
+# stop holding a key in the shared cache
+FRAGMENT_VERSION_SECONDS = int(os.getenv('FRAGMENT_VERSION_SECONDS', str(7 * 24 * 3600)))
+
 # Authentication URLs
 LOGIN_URL = '/register/'
 LOGIN_REDIRECT_URL = '/'
@@ -150,25 +304,61 @@ EMAIL_SUBJECT_PREFIX = ''
 # CSRF Settings
 CSRF_TRUSTED_ORIGINS = ['https://unisphere-esms.onrender.com']
 
-# Channels
-if os.getenv("REDIS_URL"):
+# Channels. CHANNEL_REDIS_URLS is a comma-separated list of Redis servers
+# (REDIS_URL by default); with more than one, channels and groups are
+# sharded across them by a hash of their name, so every worker must list the
+# same servers in the same order. CHANNEL_LAYER_BACKEND picks:
+#   redis  - RedisChannelLayer: a queue per channel holding up to
+#            CHANNEL_CAPACITY messages, each dropped after CHANNEL_EXPIRY
+#            seconds if nobody reads it
+#   pubsub - RedisPubSubChannelLayer: Redis PUB/SUB, one less round trip per
+#            message but no queueing, so frames sent while a socket
+#            reconnects are lost (the chat sync frame recovers them).
+#            Capacity and expiry don't apply.
+# Group memberships expire after CHANNEL_GROUP_EXPIRY seconds; keep it above
+# the longest a socket stays open. Without Redis the in-memory layer takes
+# the same limits but only delivers within one process.
+CHANNEL_REDIS_URLS = [url for url in os.getenv('CHANNEL_REDIS_URLS', REDIS_URL or '').split(',') if url]
+CHANNEL_LAYER_BACKEND = os.getenv('CHANNEL_LAYER_BACKEND', 'redis')
+CHANNEL_CAPACITY = int(os.getenv('CHANNEL_CAPACITY', '100'))
+CHANNEL_EXPIRY = int(os.getenv('CHANNEL_EXPIRY', '60'))
+CHANNEL_GROUP_EXPIRY = int(os.getenv('CHANNEL_GROUP_EXPIRY', '86400'))
+CHANNEL_LAYER_LIMITS = {
+    "capacity": CHANNEL_CAPACITY,
+    "expiry": CHANNEL_EXPIRY,
+    "group_expiry": CHANNEL_GROUP_EXPIRY,
+}
+if CHANNEL_REDIS_URLS and CHANNEL_LAYER_BACKEND == 'pubsub':
+    CHANNEL_LAYERS = {
+        "default": {
+            "BACKEND": "channels_redis.pubsub.RedisPubSubChannelLayer",
+            "CONFIG": {
+                "hosts": CHANNEL_REDIS_URLS,
+            },
+        },
+    }
+elif CHANNEL_REDIS_URLS:
     CHANNEL_LAYERS = {
         "default": {
             "BACKEND": "channels_redis.core.RedisChannelLayer",
             "CONFIG": {
-                "hosts": [os.getenv("REDIS_URL")],
+                "hosts": CHANNEL_REDIS_URLS,
+                **CHANNEL_LAYER_LIMITS,
             },
         },
     }
 else:
     CHANNEL_LAYERS = {
         "default": {
-            "BACKEND": "channels.layers.InMemoryChannelLayer"
+            "BACKEND": "channels.layers.InMemoryChannelLayer",
+            "CONFIG": CHANNEL_LAYER_LIMITS,
         },
     }
 
 # Security Settings
-SECURE_SSL_REDIRECT = True
+# Set to False to run `manage.py loadtest --target` against a plain-HTTP local server
+SECURE_SSL_REDIRECT = os.getenv('SECURE_SSL_REDIRECT', 'True') == 'True'
+SECURE_REDIRECT_EXEMPT = [r'^metrics$']
 SESSION_COOKIE_SECURE = True
 CSRF_COOKIE_SECURE = True
 SECURE_BROWSER_XSS_FILTER = True
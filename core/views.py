@@ -1,4 +1,22 @@
+from django.conf import settings
+from django.http import HttpResponse, HttpResponseForbidden
 from django.shortcuts import render
+from django.utils.crypto import constant_time_compare
+
+from .metrics import registry
 
 def home(request):
-    return render(request, 'core/home.html') 
\ No newline at end of file
+    return render(request, 'core/home.html')
+
+def has_metrics_token(request):
+    """True if the request carries ``Authorization: Bearer <METRICS_TOKEN>``."""
+    scheme, _, token = request.headers.get('Authorization', '').partition(' ')
+    return bool(settings.METRICS_TOKEN) and scheme.lower() == 'bearer' and constant_time_compare(
+        token.strip(), settings.METRICS_TOKEN
+    )
+
+def metrics_view(request):
+    """Expose in-process metrics to scrapers holding METRICS_TOKEN and to staff users."""
+    if not has_metrics_token(request) and not request.user.is_staff:
+        return HttpResponseForbidden()
+    return HttpResponse(registry.render(), content_type='text/plain; version=0.0.4')